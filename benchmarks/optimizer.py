@@ -0,0 +1,97 @@
+"""
+AdaBound step: the per-parameter loop against the multi-tensor update.
+
+    python -m benchmarks.optimizer
+    python -m benchmarks.optimizer --amsbound --weight_decay 1e-4 --device cuda
+
+Two copies of the VoiceFilter model get identical random gradients for --parity_steps
+steps, one per optimizer, and their parameters are compared after every step. Then the
+step alone is timed on fixed gradients, as in benchmarks.run.
+"""
+import sys
+import json
+import argparse
+import torch
+from utils.hparams import HParam
+from utils.adabound import AdaBound
+from model.model import VoiceFilter
+from benchmarks.run import measure, CONF_FILE
+
+
+def optimizer(model, args, multi_tensor):
+    return AdaBound(model.parameters(), lr=args.lr, final_lr=args.final_lr, weight_decay=args.weight_decay,
+                    amsbound=args.amsbound, multi_tensor=multi_tensor)
+
+
+def parity(models, optimizers, steps, seed):
+    """Largest parameter difference over `steps` steps, 0.0 when bit-identical."""
+    generator = torch.Generator().manual_seed(seed)
+    worst = 0.0
+    for _ in range(steps):
+        grads = [torch.randn(p.shape, generator=generator) for p in models[0].parameters()]
+        for model in models:
+            for p, grad in zip(model.parameters(), grads):
+                p.grad = grad.to(p.device).clone()
+        for opt in optimizers:
+            opt.step()
+        for p, q in zip(models[0].parameters(), models[1].parameters()):
+            worst = max(worst, (p.data - q.data).abs().max().item())
+    return worst
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    hp = HParam(CONF_FILE)
+    device = torch.device(args.device)
+    reference = VoiceFilter(hp).to(device)
+    # not deepcopy: the hparams Dotdict raises KeyError for the __deepcopy__ lookup
+    twin = VoiceFilter(hp).to(device)
+    twin.load_state_dict(reference.state_dict())
+    models = [reference, twin]
+    optimizers = [optimizer(models[0], args, False), optimizer(models[1], args, True)]
+
+    params = list(reference.parameters())
+    print('{} parameter tensors, {} values, {}'.format(len(params), sum(p.numel() for p in params), device))
+    worst = parity(models, optimizers, args.parity_steps, args.seed)
+    print('max |difference| after {} steps: {:.3g}{}'.format(
+        args.parity_steps, worst, ' (bit-identical)' if worst == 0.0 else ''))
+
+    def step(opt):
+        opt.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    results = {}
+    for name, opt in (('per_parameter', optimizers[0]), ('multi_tensor', optimizers[1])):
+        results[name] = measure(lambda opt=opt: step(opt), args.min_time, args.min_iters, args.max_iters)
+        r = results[name]
+        print('adabound_step[{:13s}] p50 {:9.3f} ms  p90 {:9.3f} ms  p99 {:9.3f} ms  alloc {:9.1f} KB'.format(
+            name, r['p50_ms'], r['p90_ms'], r['p99_ms'], r['alloc_peak_kb']))
+    speedup = results['per_parameter']['p50_ms'] / max(results['multi_tensor']['p50_ms'], 1e-9)
+    print('speedup {:.2f}x'.format(speedup))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'threads': args.threads, 'torch': torch.__version__, 'device': str(device),
+                       'max_difference': worst, 'speedup': speedup, 'results': results}, fp, indent=2)
+    if args.exact and worst != 0.0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=1, help="torch intra-op threads")
+    parser.add_argument('--amsbound', action='store_true')
+    parser.add_argument('--weight_decay', type=float, default=0.0)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--final_lr', type=float, default=0.05)
+    parser.add_argument('--parity_steps', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--exact', action='store_true', help="fail unless both updates are bit-identical")
+    parser.add_argument('--min_time', type=float, default=1.0, help="seconds spent per case at least")
+    parser.add_argument('--min_iters', type=int, default=5)
+    parser.add_argument('--max_iters', type=int, default=200)
+    parser.add_argument('--output', type=str, default=None, help="write results as JSON")
+    main(parser.parse_args())
@@ -0,0 +1,184 @@
+"""
+Micro-benchmarks for the identification hot paths.
+
+    python -m benchmarks.run                                  # run and print
+    python -m benchmarks.run --save benchmarks/baseline.json  # record a baseline
+    python -m benchmarks.run --compare benchmarks/baseline.json --tolerance 0.2
+
+Each case is timed at several input or gallery sizes on synthetic data. Reported are
+latency percentiles, the peak of Python-tracked allocations (numpy included) for one
+call, and the process peak RSS after the case. A case that raises is reported with its
+error and the run goes on, but exits non-zero at the end. With --compare the run also
+fails when a case's median latency regressed by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import numpy as np
+import torch
+from scipy.io.wavfile import write
+from utils.hparams import HParam
+from utils.audio import Audio
+from model.embedder import SpeechEmbedder
+from voice_authentication import load_embeddings, stack_embeddings, score_gallery, decide, \
+    load_speaker, score_speaker, stream2wavfile_int16
+from voice_service import vad_audio_segment
+from benchmarks.synthetic import synthetic_speech, synthetic_pcm, synthetic_gallery, write_gallery
+
+CONF_FILE = os.path.join('config', 'default.yaml')
+
+
+def measure(fn, min_time, min_iters, max_iters):
+    fn() # warm-up
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_iters and (len(times) < min_iters or time.perf_counter() - start < min_time):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = np.array(times) * 1000.0
+    return {
+        'iterations': len(times),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'mean_ms': float(times.mean()),
+        'alloc_peak_kb': peak / 1024.0,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def cases(hp, tmp_dir):
+    """Yields (name, size, fn). Setup happens here, outside the timed call."""
+    audio = Audio(hp)
+    torch.manual_seed(0)
+    embedder = SpeechEmbedder(hp)
+    embedder.eval()
+
+    for seconds in (1, 5, 30):
+        wav = synthetic_speech(seconds)
+        yield 'get_mel', '{}s'.format(seconds), lambda wav=wav: audio.get_mel(wav)
+
+    for seconds in (1, 5, 30):
+        mel = torch.from_numpy(audio.get_mel(synthetic_speech(seconds))).float()
+
+        def forward(mel=mel):
+            with torch.no_grad():
+                embedder(mel)
+        yield 'embedder_forward', '{}s'.format(seconds), forward
+
+    probe = synthetic_gallery(1, seed=1)['spk_00000.pth']
+    for speakers in (10, 100, 1000):
+        folder = write_gallery(os.path.join(tmp_dir, 'gallery_{}'.format(speakers)), speakers)
+        yield 'load_embeddings', '{}spk'.format(speakers), lambda folder=folder: load_embeddings(folder)
+
+        # verification reads the claimed speaker only: flat in the gallery size
+        def verify(folder=folder):
+            score_speaker(probe, load_speaker('spk_00000', folder))
+        yield 'verify_speaker', '{}spk'.format(speakers), verify
+
+    for speakers in (10, 1000, 50000):
+        embeddings = synthetic_gallery(speakers)
+
+        # the scoring half of audio_authentication, after the probe is embedded
+        def authenticate(embeddings=embeddings):
+            names, matrix = stack_embeddings(embeddings)
+            decide(names, score_gallery(probe, matrix)[0])
+        yield 'audio_authentication_scoring', '{}spk'.format(speakers), authenticate
+
+    for seconds in (5, 30, 120):
+        path = os.path.join(tmp_dir, 'vad_{}.wav'.format(seconds))
+        write(path, hp.audio.sample_rate, synthetic_pcm(seconds))
+        yield 'vad_audio_segment', '{}s'.format(seconds), lambda path=path: vad_audio_segment(path)
+
+    for seconds in (1, 7, 30):
+        # stream_server hands over the samples as a python list
+        samples = synthetic_pcm(seconds).tolist()
+        path = os.path.join(tmp_dir, 'stream_{}.wav'.format(seconds))
+        yield 'stream2wavfile_int16', '{}s'.format(seconds), \
+            lambda samples=samples, path=path: stream2wavfile_int16(samples, path)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline or 'error' in result or 'error' in baseline[key]:
+            continue
+        ratio = result['p50_ms'] / max(baseline[key]['p50_ms'], 1e-9)
+        result['vs_baseline'] = ratio
+        if ratio > 1.0 + tolerance:
+            regressions.append('{}: {:.3f} ms -> {:.3f} ms ({:+.0%})'.format(
+                key, baseline[key]['p50_ms'], result['p50_ms'], ratio - 1.0))
+    return regressions
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    hp = HParam(CONF_FILE)
+    tmp_dir = tempfile.mkdtemp(prefix='speaker_bench_')
+    results = {}
+    failures = []
+    try:
+        for name, size, fn in cases(hp, tmp_dir):
+            key = '{}[{}]'.format(name, size)
+            if args.filter and args.filter not in key:
+                continue
+            try:
+                results[key] = measure(fn, args.min_time, args.min_iters, args.max_iters)
+            except Exception as error:
+                results[key] = {'error': repr(error)}
+                failures.append('{}: {!r}'.format(key, error))
+                print('{:42s} FAILED {!r}'.format(key, error))
+                continue
+            r = results[key]
+            print('{:42s} p50 {:9.3f} ms  p90 {:9.3f} ms  p99 {:9.3f} ms  alloc {:9.1f} KB  rss {:7.1f} MB'.format(
+                key, r['p50_ms'], r['p90_ms'], r['p99_ms'], r['alloc_peak_kb'], r['max_rss_mb']))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp)['results'], args.tolerance)
+    report = {'threads': args.threads, 'torch': torch.__version__, 'results': results}
+    # a baseline with failed cases would silently stop guarding them
+    for path in (None if failures else args.save, args.output):
+        if path:
+            with open(path, 'w') as fp:
+                json.dump(report, fp, indent=2)
+
+    if failures:
+        print('Failed cases:')
+        print('\n'.join(failures))
+    if regressions:
+        print('Regressions beyond {:.0%}:'.format(args.tolerance))
+        print('\n'.join(regressions))
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', type=str, default=None, help="only cases whose name contains this")
+    parser.add_argument('--threads', type=int, default=1, help="torch intra-op threads")
+    parser.add_argument('--min_time', type=float, default=1.0, help="seconds spent per case at least")
+    parser.add_argument('--min_iters', type=int, default=5)
+    parser.add_argument('--max_iters', type=int, default=200)
+    parser.add_argument('--save', type=str, default=None, help="write results as the new baseline")
+    parser.add_argument('--compare', type=str, default=None, help="baseline to check against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed median slowdown against the baseline")
+    parser.add_argument('--output', type=str, default=None, help="write results as JSON")
+    main(parser.parse_args())
@@ -0,0 +1,45 @@
+"""
+Deterministic synthetic inputs for the benchmarks, no datasets needed.
+"""
+import os
+import numpy as np
+import torch
+
+
+def synthetic_speech(seconds, sample_rate=16000, seed=0):
+    """
+    Speech-like float32 signal: a harmonic source with a gliding pitch, shaped by a
+    syllable-rate envelope with pauses, over a low noise floor.
+    """
+    rng = np.random.RandomState(seed)
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+    f0 = 120.0 + 30.0 * np.sin(2 * np.pi * 0.5 * t + rng.uniform(0, 2 * np.pi))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 16))
+    envelope = np.clip(np.sin(2 * np.pi * 4.0 * t + rng.uniform(0, 2 * np.pi)), 0, None)
+    # roughly one 0.3 s pause every 1.5 s
+    pauses = np.ones(n)
+    for start in np.arange(0, seconds, 1.5) + rng.uniform(0, 1.2, size=len(np.arange(0, seconds, 1.5))):
+        pauses[int(start * sample_rate):int((start + 0.3) * sample_rate)] = 0
+    wav = 0.3 * voiced / np.abs(voiced).max() * envelope * pauses + 0.01 * rng.randn(n)
+    return wav.astype(np.float32)
+
+
+def synthetic_pcm(seconds, sample_rate=16000, seed=0):
+    return (synthetic_speech(seconds, sample_rate, seed) * 32767).astype(np.int16)
+
+
+def synthetic_gallery(num_speakers, emb_dim=256, seed=0):
+    """{'spk_00000.pth': (1, emb_dim) unit d-vector} like load_embeddings returns."""
+    generator = torch.Generator().manual_seed(seed)
+    dvecs = torch.randn(num_speakers, emb_dim, generator=generator)
+    dvecs = dvecs / torch.norm(dvecs, p=2, dim=1, keepdim=True)
+    return {'spk_{:05d}.pth'.format(i): dvecs[i:i + 1] for i in range(num_speakers)}
+
+
+def write_gallery(folder, num_speakers, emb_dim=256, seed=0):
+    os.makedirs(folder, exist_ok=True)
+    for name, dvec in synthetic_gallery(num_speakers, emb_dim, seed).items():
+        torch.save(dvec, os.path.join(folder, name))
+    return folder
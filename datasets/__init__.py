@@ -0,0 +1 @@
+# cython: language_level=3
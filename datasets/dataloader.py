@@ -0,0 +1,114 @@
+import os
+import glob
+import inspect
+import torch
+import librosa
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from utils.audio import Audio
+from utils.dvec_cache import DvecCache, cache_key, reference_path
+from utils.distributed import rank, world_size
+from .shards import ShardedSpecDataset, ShardShuffleSampler, is_sharded, reference_dvec
+from .mixing import OnTheFlyMixDataset, MixCollate
+
+
+def find_all(data_dir, file_format):
+    return sorted(glob.glob(os.path.join(data_dir, file_format)))
+
+
+def load_dvec_cache(hp, args):
+    if not hp.data.get('dvec_cache'):
+        return None
+    cache = DvecCache(hp.data.dvec_cache, cache_key(args.embedder_path, hp))
+    return cache if len(cache) else None
+
+
+def train_collate(batch):
+    dvecs = [dvec for dvec, _, _ in batch]
+    # cached d-vectors are stacked, reference mels differ in length and stay a list
+    if all(dvec.dim() == 1 for dvec in dvecs):
+        dvecs = torch.stack(dvecs, dim=0)
+    target_mag = torch.stack([target for _, target, _ in batch], dim=0)
+    mixed_mag = torch.stack([mixed for _, _, mixed in batch], dim=0)
+    return dvecs, target_mag, mixed_mag
+
+
+def test_collate(batch):
+    return batch
+
+
+class FileSpecDataset(Dataset):
+    """
+    One '*-target.pt' / '*-mixed.pt' pair per sample, as written by the original mixing
+    scripts. Training from shards (pack_shards.py) avoids the two small loads per sample.
+    """
+    def __init__(self, hp, data_dir, train, dvec_cache=None):
+        self.hp = hp
+        self.train = train
+        self.dvec_cache = dvec_cache
+        self.audio = Audio(hp)
+        self.dvec_list = find_all(data_dir, hp.form.dvec)
+        self.target_wav_list = find_all(data_dir, hp.form.target.wav)
+        self.mixed_wav_list = find_all(data_dir, hp.form.mixed.wav)
+        self.target_mag_list = find_all(data_dir, hp.form.target.mag)
+        self.mixed_mag_list = find_all(data_dir, hp.form.mixed.mag)
+
+        assert len(self.dvec_list) == len(self.target_wav_list) == len(self.mixed_wav_list), \
+            "number of training files must match"
+        assert len(self.dvec_list) != 0, \
+            "no training file found"
+
+    def __len__(self):
+        return len(self.dvec_list)
+
+    def __getitem__(self, idx):
+        dvec = reference_dvec(self, os.path.abspath(reference_path(self.dvec_list[idx])))
+
+        if self.train:
+            target_mag = torch.load(self.target_mag_list[idx])
+            mixed_mag = torch.load(self.mixed_mag_list[idx])
+            return dvec, target_mag, mixed_mag
+
+        target_wav, _ = librosa.load(self.target_wav_list[idx], sr=self.hp.audio.sample_rate)
+        mixed_wav, _ = librosa.load(self.mixed_wav_list[idx], sr=self.hp.audio.sample_rate)
+        target_mag, _ = self.audio.wav2spec(target_wav)
+        mixed_mag, mixed_phase = self.audio.wav2spec(mixed_wav)
+        target_mag = torch.from_numpy(target_mag)
+        mixed_mag = torch.from_numpy(mixed_mag)
+        return dvec, target_wav, mixed_wav, target_mag, mixed_mag, mixed_phase
+
+
+def create_dataloader(hp, args, train):
+    """
+    Training mixes on-the-fly from data.mix_source when it is set, else reads packed
+    shards from '<train_dir>/shards' when they exist, per-sample files otherwise.
+    The test set is always read from files, one sample per batch.
+    In data-parallel training each process loads its own part of every epoch.
+    """
+    dvec_cache = load_dvec_cache(hp, args)
+    if not train:
+        return DataLoader(dataset=FileSpecDataset(hp, hp.data.test_dir, False, dvec_cache),
+                          collate_fn=test_collate, batch_size=1, shuffle=False, num_workers=0)
+
+    shard_dir = os.path.join(hp.data.train_dir, 'shards')
+    workers = hp.train.num_workers
+    loader_args = dict(batch_size=hp.train.batch_size, num_workers=workers, collate_fn=train_collate,
+                       pin_memory=torch.cuda.is_available(), drop_last=True)
+    # persistent workers and prefetch_factor need torch >= 1.7
+    if workers > 0 and 'prefetch_factor' in inspect.signature(DataLoader.__init__).parameters:
+        loader_args.update(persistent_workers=True, prefetch_factor=hp.train.get('prefetch_factor', 4))
+    if hp.data.get('mix_source'):
+        dataset = OnTheFlyMixDataset(hp, hp.data.mix_source, hp.data.mix_samples,
+                                     hp.data.get('snr'), dvec_cache)
+        loader_args['collate_fn'] = MixCollate(hp)
+    elif is_sharded(shard_dir):
+        dataset = ShardedSpecDataset(hp, shard_dir, dvec_cache)
+        sampler = ShardShuffleSampler(dataset, window=hp.train.get('shard_window', 4),
+                                      num_replicas=world_size(), rank=rank())
+        return DataLoader(dataset=dataset, sampler=sampler, **loader_args)
+    else:
+        dataset = FileSpecDataset(hp, hp.data.train_dir, True, dvec_cache)
+    if world_size() > 1:
+        sampler = DistributedSampler(dataset, num_replicas=world_size(), rank=rank(), shuffle=True)
+        return DataLoader(dataset=dataset, sampler=sampler, **loader_args)
+    return DataLoader(dataset=dataset, shuffle=True, **loader_args)
@@ -0,0 +1,46 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from utils.audio import Audio
+from utils.mixing import random_mixture
+from utils.speakers import speaker_files
+from .shards import reference_dvec
+
+
+class OnTheFlyMixDataset(Dataset):
+    """
+    Mixes a fresh (reference, target, interferer) triple from a folder-per-speaker tree
+    for every sample, so mixtures never touch disk. Items are waveforms; MixCollate
+    turns a whole batch into magnitudes with one batched STFT inside the worker.
+    """
+    def __init__(self, hp, data_path, length, snr_range=None, dvec_cache=None):
+        self.hp = hp
+        self.length = length
+        self.snr_range = snr_range
+        self.dvec_cache = dvec_cache
+        self.audio = Audio(hp)
+        self.speakers = speaker_files(data_path)
+        self.names = [spk for spk, files in self.speakers.items() if len(files) >= 2]
+        assert len(self.names) >= 2, "need at least two speakers with two files each"
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        # torch seeds every worker differently on each epoch, so mixtures never repeat
+        rng = np.random.RandomState(int(torch.randint(2 ** 31 - 1, (1,)).item()))
+        ref, target_wav, mixed_wav, _ = random_mixture(self.hp, rng, self.speakers, self.names, self.snr_range)
+        return reference_dvec(self, ref), target_wav, mixed_wav
+
+
+class MixCollate():
+    def __init__(self, hp):
+        self.audio = Audio(hp)
+
+    def __call__(self, batch):
+        dvecs = [dvec for dvec, _, _ in batch]
+        if all(dvec.dim() == 1 for dvec in dvecs):
+            dvecs = torch.stack(dvecs, dim=0)
+        mags = torch.from_numpy(self.audio.wav2spec_batch(
+            np.stack([w for _, w, _ in batch] + [w for _, _, w in batch])))
+        return dvecs, mags[:len(batch)], mags[len(batch):]
@@ -0,0 +1,207 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+# one row per sample, offsets in elements of the shard dtype
+INDEX_DTYPE = np.dtype([('shard', np.int32), ('target', np.int64), ('mixed', np.int64), ('frames', np.int32)])
+
+
+class ShardWriter():
+    """
+    Packs (target_mag, mixed_mag, reference wav) samples into large raw shard files
+    plus one index, instead of two small torch files per sample. Magnitudes are
+    [time, freq] arrays with freq == num_freq.
+    """
+    def __init__(self, root, num_freq, dtype='float32', shard_bytes=256 << 20, prefix='shard'):
+        self.root = root
+        self.prefix = prefix # writers sharing a folder need distinct prefixes
+        self.num_freq = num_freq
+        self.dtype = np.dtype(dtype)
+        self.shard_elements = shard_bytes // self.dtype.itemsize
+        self.shards = []
+        self.rows = []
+        self.dvecs = []
+        self.fp = None
+        self.written = 0 # elements in the open shard
+        os.makedirs(root, exist_ok=True)
+
+    def _next_shard(self):
+        if self.fp is not None:
+            self.fp.close()
+        name = '{}-{:05d}.bin'.format(self.prefix, len(self.shards))
+        self.shards.append(name)
+        self.fp = open(os.path.join(self.root, name), 'wb')
+        self.written = 0
+
+    def _write(self, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        offset = self.written
+        self.fp.write(array.tobytes())
+        self.written += array.size
+        return offset
+
+    def add(self, target_mag, mixed_mag, dvec_path):
+        target_mag, mixed_mag = np.asarray(target_mag), np.asarray(mixed_mag)
+        if target_mag.shape != mixed_mag.shape or target_mag.shape[1] != self.num_freq:
+            raise ValueError('Expected two [time, {}] magnitudes, got {} and {}.'.format(
+                self.num_freq, target_mag.shape, mixed_mag.shape))
+        if self.fp is None or self.written + 2 * target_mag.size > self.shard_elements:
+            self._next_shard()
+        self.rows.append((len(self.shards) - 1, self._write(target_mag), self._write(mixed_mag),
+                          target_mag.shape[0]))
+        self.dvecs.append(os.path.abspath(dvec_path))
+
+    def part(self):
+        """Closes the open shard, returns the samples written for write_index."""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        return {'shards': self.shards, 'rows': self.rows, 'dvec': self.dvecs}
+
+    def close(self):
+        write_index(self.root, self.num_freq, self.dtype, [self.part()])
+
+
+def write_index(root, num_freq, dtype, parts):
+    """Writes one index over the shards of several writers (e.g. one per process)."""
+    shards, rows, dvecs = [], [], []
+    for part in parts:
+        base = len(shards)
+        shards.extend(part['shards'])
+        rows.extend((base + shard, target, mixed, frames) for shard, target, mixed, frames in part['rows'])
+        dvecs.extend(part['dvec'])
+    np.save(os.path.join(root, 'index.npy'), np.array(rows, dtype=INDEX_DTYPE))
+    # meta.json is written last and marks the shards as complete
+    with open(os.path.join(root, 'meta.json.tmp'), 'w') as fp:
+        json.dump({'num_freq': num_freq, 'dtype': np.dtype(dtype).name, 'shards': shards, 'dvec': dvecs}, fp)
+    os.replace(os.path.join(root, 'meta.json.tmp'), os.path.join(root, 'meta.json'))
+
+
+def is_sharded(root):
+    return os.path.isfile(os.path.join(root, 'meta.json'))
+
+
+class ShardedSpecDataset(torch.utils.data.Dataset):
+    """
+    Serves (dvec, target_mag, mixed_mag) from packed shards. Shards are memory-mapped
+    copy-on-write the first time a worker touches them, and magnitudes are tensors over
+    the mapped pages, so nothing is read or copied before the batch is collated.
+    dvec is the cached d-vector when the reference is in dvec_cache, else its mel.
+    """
+    def __init__(self, hp, root, dvec_cache=None):
+        self.hp = hp
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as fp:
+            meta = json.load(fp)
+        self.num_freq = meta['num_freq']
+        self.dtype = np.dtype(meta['dtype'])
+        self.shards = [os.path.join(root, name) for name in meta['shards']]
+        self.dvec_paths = meta['dvec']
+        self.index = np.load(os.path.join(root, 'index.npy'))
+        self.dvec_cache = dvec_cache
+        self.audio = None
+        self.maps = {} # per worker, opened lazily after the fork
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, i):
+        if i not in self.maps:
+            self.maps[i] = np.memmap(self.shards[i], dtype=self.dtype, mode='c')
+        return self.maps[i]
+
+    def magnitude(self, data, offset, frames):
+        mag = torch.from_numpy(data[offset:offset + frames * self.num_freq].reshape(frames, self.num_freq))
+        return mag if self.dtype == np.float32 else mag.float()
+
+    def dvec(self, idx):
+        return reference_dvec(self, self.dvec_paths[idx])
+
+    def __getitem__(self, idx):
+        shard, target, mixed, frames = self.index[idx]
+        data = self.shard(int(shard))
+        return self.dvec(idx), self.magnitude(data, target, frames), self.magnitude(data, mixed, frames)
+
+
+def reference_dvec(dataset, path):
+    """Cached d-vector of a reference wav, or its mel for the trainer to embed."""
+    if dataset.dvec_cache is not None and path in dataset.dvec_cache:
+        return torch.from_numpy(dataset.dvec_cache[path])
+    import librosa
+    from utils.audio import Audio
+    if dataset.audio is None:
+        dataset.audio = Audio(dataset.hp)
+    wav, _ = librosa.load(path, sr=dataset.hp.audio.sample_rate)
+    return torch.from_numpy(dataset.audio.get_mel(wav)).float()
+
+
+class ShardShuffleSampler(Sampler):
+    """
+    Shuffles the shard order, then the samples within groups of `window` shards, so an
+    epoch is random while reads stay within a few shards at a time. The next group is
+    handed to the kernel readahead (posix_fadvise) while the current one is consumed;
+    the page cache is shared by every dataloader worker.
+    In data-parallel training every replica draws the same order (same seed and epoch)
+    and takes its own contiguous part of it, padded so all parts have the same length.
+    """
+    def __init__(self, dataset, window=4, seed=0, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.window = window
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0 # advanced by every pass, so each epoch has its own order
+        self.by_shard = [np.flatnonzero(dataset.index['shard'] == i) for i in range(len(dataset.shards))]
+        self.num_samples = -(-len(dataset) // num_replicas)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def groups(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.by_shard))
+        for start in range(0, len(order), self.window):
+            shards = order[start:start + self.window]
+            yield shards, rng.permutation(np.concatenate([self.by_shard[i] for i in shards]))
+
+    def __iter__(self):
+        groups = list(self.groups())
+        self.epoch += 1
+        if self.num_replicas > 1:
+            groups = self.replica_part(groups)
+        if groups:
+            prefetch([self.dataset.shards[i] for i in groups[0][0]])
+        for g, (shards, samples) in enumerate(groups):
+            if g + 1 < len(groups):
+                prefetch([self.dataset.shards[i] for i in groups[g + 1][0]])
+            yield from samples.tolist()
+
+    def replica_part(self, groups):
+        """The groups cut down to this replica's num_samples samples of the epoch."""
+        total = self.num_samples * self.num_replicas
+        # pad by wrapping around, like DistributedSampler
+        order = np.concatenate([samples for _, samples in groups])
+        order = np.resize(order, total)
+        group_of = np.resize(np.repeat(np.arange(len(groups)), [len(samples) for _, samples in groups]), total)
+        start = self.rank * self.num_samples
+        mine, mine_group = order[start:start + self.num_samples], group_of[start:start + self.num_samples]
+        part = []
+        for g in np.unique(mine_group):
+            part.append((groups[g][0], mine[mine_group == g]))
+        return part
+
+
+def prefetch(paths):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Bulk speaker enrollment.
+
+Walks a folder-per-speaker tree (folder name = speaker ID), decodes and computes mels in a
+process pool, embeds them in large batches, averages the file embeddings of each speaker and
+writes them to the gallery in batched transactions; with --channels, each sub-folder of a
+speaker is a channel (device, microphone, ...) with its own template. Speakers written are
+appended to a progress file in the gallery, so a crashed run resumes where it stopped; a
+finished run removes it. By default the served embedder and gallery (or --tenant's) are used
+and the source files are copied to the enrollment store, from which reembed.py rebuilds the
+gallery for a new embedder.
+"""
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from utils.hparams import HParam
+from utils.audio import Audio
+from utils.speakers import speaker_files, speaker_channels, channel_files, audio_files
+from voice_authentication import load_model, load_wav, min_samples, save_embedding, bump_generation, \
+    pcm2float, float2pcm, read_version, model_fingerprint, gallery_tag, tag_gallery, store_enrollment, \
+    merge_templates, tenant_path, speaker_name, DEFAULT_CHANNEL
+from voice_service import speech_vad, VAD_ENABLED
+
+# the first files of a run all failing with one error is a broken setup, not bad files
+FAILURE_LIMIT = 8
+TOO_SHORT = 'too short'
+PROGRESS_FILE = '.enroll_progress' # in the gallery folder, speakers written by an unfinished run
+
+_hp = None
+_audio = None
+
+
+def init_worker(conf_file):
+    global _hp, _audio
+    torch.set_num_threads(1)
+    _hp = HParam(conf_file)
+    _audio = Audio(_hp)
+
+
+def file_mel(job):
+    """Decodes, gates and computes the mel of one file. Returns ((spk, channel), path, mel or error)."""
+    key, path = job
+    try:
+        wav = load_wav(path)
+        if VAD_ENABLED:
+            wav = pcm2float(speech_vad().gate(float2pcm(wav)), dtype='float32')
+        if len(wav) < min_samples(_hp):
+            return key, path, TOO_SHORT
+        return key, path, _audio.get_mel(wav).astype(np.float32)
+    except Exception as error:
+        return key, path, repr(error)
+
+
+class FailureGuard():
+    """
+    Tells a systematic failure from bad files: raises SystemExit when the first `limit`
+    files all fail with the same error, or when no file of the run could be used.
+    """
+    def __init__(self, limit=FAILURE_LIMIT):
+        self.limit = limit
+        self.used = 0
+        self.errors = []
+
+    def check(self, path, mel):
+        if not isinstance(mel, str):
+            self.used += 1
+        elif mel != TOO_SHORT and not self.used:
+            self.errors.append(mel)
+            if len(self.errors) >= self.limit and len(set(self.errors)) == 1:
+                raise SystemExit('The first {} files failed with {}, aborting (last: {}).'.format(
+                    len(self.errors), mel, path))
+
+    def finish(self):
+        if not self.used and self.errors:
+            raise SystemExit('No file could be processed, {} failed with {}.'.format(
+                len(self.errors), ', '.join(sorted(set(self.errors)))))
+
+
+def load_progress(progress_path):
+    if not os.path.isfile(progress_path):
+        return set()
+    with open(progress_path) as fp:
+        return set(line.strip() for line in fp if line.strip())
+
+
+class Enroller():
+    """Accumulates mels into embedder batches and per-channel sums, commits speakers in groups."""
+    def __init__(self, args, embedder, speakers):
+        self.args = args
+        self.embedder = embedder
+        self.speakers = speakers # {spk: {channel: files}}
+        self.total_files = sum(len(files) for channels in speakers.values() for files in channels.values())
+        self.batch = [] # [((spk, channel), mel)]
+        self.batch_windows = 0
+        self.sums = {}
+        self.counts = {}
+        self.finished = [] # speakers whose files are all embedded
+        self.uncommitted = []
+        self.files_done = 0
+        self.start = time.time()
+
+    def add(self, key, mel):
+        self.batch.append((key, torch.from_numpy(mel)))
+        self.batch_windows += max(0, (mel.shape[1] - self.embedder.hp.embedder.window)
+                                  // self.embedder.hp.embedder.stride + 1)
+        if self.batch_windows >= self.args.batch_windows:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            with torch.no_grad():
+                dvecs = self.embedder.forward_batch([mel for _, mel in self.batch])
+            for (key, _), dvec in zip(self.batch, dvecs):
+                self.sums[key] = self.sums.get(key, 0) + dvec
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.files_done += len(self.batch)
+            self.batch, self.batch_windows = [], 0
+        # only speakers whose last file has been embedded can be written
+        self.uncommitted.extend(self.finished)
+        self.finished = []
+        if len(self.uncommitted) >= self.args.commit_every:
+            self.commit()
+
+    def speaker_done(self, spk):
+        self.finished.append(spk)
+
+    def commit(self):
+        written = []
+        for spk in self.uncommitted:
+            channels = [channel for channel in self.speakers[spk] if (spk, channel) in self.counts]
+            if not channels:
+                print("Spk: {} skipped, no usable audio".format(spk))
+            else:
+                templates = torch.stack([self.sums.pop((spk, channel)) / self.counts.pop((spk, channel))
+                                         for channel in channels])
+                if self.args.store_audio:
+                    for channel in channels:
+                        store_enrollment(spk, files=self.speakers[spk][channel], channel=channel,
+                                         tenant=self.args.tenant)
+                path = os.path.join(self.args.embeddings_path, spk + '.pth')
+                save_embedding(merge_templates(path, channels, templates), path, bump=False)
+                written.append(spk)
+        if written:
+            bump_generation(self.args.embeddings_path)
+            with open(self.args.progress, 'a') as fp:
+                fp.write(''.join(spk + '\n' for spk in written))
+                fp.flush()
+                os.fsync(fp.fileno())
+        self.uncommitted = []
+        elapsed = time.time() - self.start
+        print("{}/{} files, {:.1f} files/s, {} speakers committed".format(
+            self.files_done, self.total_files, self.files_done / max(elapsed, 1e-6), len(written)))
+
+
+def check_gallery(args, hp):
+    """Tags a new gallery with the embedder, refuses one built with another."""
+    fingerprint = model_fingerprint(args.embedder_path, hp)
+    tag = gallery_tag(args.embeddings_path)
+    if tag is None:
+        tag_gallery(args.embeddings_path, fingerprint, args.embedder_path)
+    elif tag['fingerprint'] != fingerprint:
+        raise SystemExit('{} was built with embedder {}, {} is {}. Use reembed.py.'.format(
+            args.embeddings_path, tag['fingerprint'], args.embedder_path, fingerprint))
+    return fingerprint
+
+
+def enroll_speakers(args, speakers, done=()):
+    """
+    Enrolls {speaker: {channel: files}} except the speakers in done, with args.embedder_path
+    into args.embeddings_path. Each channel becomes one template, other channels are kept.
+    """
+    for spk in speakers:
+        speaker_name(spk)
+    os.makedirs(args.embeddings_path, exist_ok=True)
+    todo = {spk: channels for spk, channels in speakers.items() if spk not in done}
+    jobs = [((spk, channel), path) for spk, channels in todo.items()
+            for channel, files in channels.items() for path in files]
+    last_job = {spk: path for (spk, _), path in jobs} # the last path of each speaker wins
+    last_file = {path: spk for spk, path in last_job.items()}
+    print("{} speakers ({} already enrolled), {} files".format(len(speakers), len(speakers) - len(todo), len(jobs)))
+    if not jobs:
+        return
+
+    # fork the decoders before torch creates any thread pool in this process
+    pool = multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(args.config,))
+    hp, audio, embedder = load_model(args.config, args.embedder_path)
+    check_gallery(args, hp)
+    enroller = Enroller(args, embedder, todo)
+    guard = FailureGuard()
+    try:
+        for key, path, mel in pool.imap(file_mel, jobs, chunksize=args.chunksize):
+            guard.check(path, mel)
+            if isinstance(mel, str):
+                print("Skipped {}: {}".format(path, mel))
+            else:
+                enroller.add(key, mel)
+            if path in last_file:
+                enroller.speaker_done(key[0])
+        guard.finish()
+        enroller.flush()
+        enroller.commit()
+    except BaseException:
+        pool.terminate() # do not decode the rest of an aborted run
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def main(args):
+    if args.spk_path:
+        spk_path = os.path.normpath(args.spk_path)
+        if args.channels:
+            speakers = {os.path.basename(spk_path): channel_files(spk_path)}
+        else:
+            speakers = {os.path.basename(spk_path): {DEFAULT_CHANNEL: audio_files(spk_path)}}
+    elif args.channels:
+        speakers = speaker_channels(args.data_path)
+    else:
+        speakers = {spk: {DEFAULT_CHANNEL: files} for spk, files in speaker_files(args.data_path).items()}
+    version = read_version()
+    args.embedder_path = args.embedder_path or version.embedder
+    args.embeddings_path = args.embeddings_path or tenant_path(version.gallery, args.tenant)
+    args.store_audio = not args.no_store_audio
+    args.progress = args.progress or os.path.join(args.embeddings_path, PROGRESS_FILE)
+    # a single speaker is always enrolled again, there is nothing to resume
+    restart = args.restart or args.spk_path
+    if restart and os.path.isfile(args.progress):
+        os.remove(args.progress)
+    enroll_speakers(args, speakers, set() if restart else load_progress(args.progress))
+    if os.path.isfile(args.progress):
+        os.remove(args.progress) # finished, the next run enrolls its speakers again
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/default.yaml',
+                        help="yaml file for configuration")
+    parser.add_argument('-e', '--embedder_path', type=str, default=None,
+                        help="path of embedder model pt file, default: the served one")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--spk_path', type=str,
+                       help="folder with the files of one speaker, the folder name is the speaker ID")
+    group.add_argument('--data_path', type=str,
+                       help="folder with one sub-folder per speaker")
+    parser.add_argument('--embeddings_path', type=str, default=None,
+                        help="gallery folder the d-vectors are written to, default: the served one")
+    parser.add_argument('--tenant', type=str, default=None,
+                        help="enroll into this tenant's gallery and enrollment store")
+    parser.add_argument('--channels', action='store_true',
+                        help="sub-folders of a speaker are channels, each enrolled as its own template")
+    parser.add_argument('--no_store_audio', action='store_true',
+                        help="do not copy the files to the enrollment store (reembed.py cannot redo them)")
+    parser.add_argument('--progress', type=str, default=None,
+                        help="speakers written by this run, appended after every commit, "
+                             "default: {} in the gallery folder".format(PROGRESS_FILE))
+    parser.add_argument('--restart', action='store_true',
+                        help="ignore the progress of an unfinished run and enroll every speaker")
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help="decoding/mel processes")
+    parser.add_argument('--chunksize', type=int, default=8,
+                        help="files handed to a decoding process at once")
+    parser.add_argument('--batch_windows', type=int, default=2048,
+                        help="embedder windows per forward pass")
+    parser.add_argument('--commit_every', type=int, default=256,
+                        help="speakers written per gallery transaction")
+    main(parser.parse_args())
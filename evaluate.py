@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Accuracy and speed evaluation.
+
+Embeds an enrollment set and a test set (folder per speaker) with batched inference,
+scores every test file against every enrolled speaker in one matrix product and reports
+identification accuracy, verification EER/minDCF, the best threshold against the service
+threshold, and per-stage timing, as JSON so runs can be compared across model versions
+and quantization modes.
+"""
+import time
+import json
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from enroll import init_worker, file_mel, FailureGuard
+from voice_authentication import load_model
+from voice_service import THRESHOLD
+from utils.speakers import speaker_files
+from utils.scoring import compute_eer, compute_min_dcf, error_rates
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_mels(pool, speakers, chunksize):
+    jobs = [(spk, path) for spk, files in speakers.items() for path in files]
+    mels, skipped = [], 0
+    guard = FailureGuard()
+    for spk, path, mel in pool.imap(file_mel, jobs, chunksize=chunksize):
+        guard.check(path, mel)
+        if isinstance(mel, str):
+            skipped += 1
+        else:
+            mels.append((spk, mel))
+    guard.finish()
+    return mels, skipped
+
+
+def check_trials(labels):
+    """EER and minDCF need target and non-target trials, SystemExit rather than a meaningless report."""
+    targets = int(labels.sum())
+    if targets == 0 or targets == len(labels):
+        raise SystemExit('No metrics: {} target and {} non-target trials survived.'.format(
+            targets, len(labels) - targets))
+
+
+def embed(embedder, mels, batch_files):
+    dvecs = []
+    with torch.no_grad():
+        for i in range(0, len(mels), batch_files):
+            dvecs.append(embedder.forward_batch([torch.from_numpy(mel) for _, mel in mels[i:i + batch_files]]))
+    return F.normalize(torch.cat(dvecs, dim=0), p=2, dim=1)
+
+
+def main(args):
+    timing = {}
+    report = {
+        'embedder': args.embedder_path,
+        'embedder_sha256': file_checksum(args.embedder_path),
+        'quantize': args.quantize,
+        'threads': torch.get_num_threads(),
+    }
+
+    pool = multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(args.config,))
+    hp, audio, embedder = load_model(args.config, args.embedder_path)
+    if args.quantize == 'dynamic':
+        embedder = torch.quantization.quantize_dynamic(embedder, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+    try:
+        start = time.time()
+        enroll_mels, enroll_skipped = compute_mels(pool, speaker_files(args.enroll_path), args.chunksize)
+        test_mels, test_skipped = compute_mels(pool, speaker_files(args.test_path), args.chunksize)
+        timing['decode_mel'] = time.time() - start
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    if not enroll_mels or not test_mels:
+        raise SystemExit('No trials: {} enrollment and {} test files usable ({} skipped).'.format(
+            len(enroll_mels), len(test_mels), enroll_skipped + test_skipped))
+
+    start = time.time()
+    enroll_dvecs = embed(embedder, enroll_mels, args.batch_files)
+    test_dvecs = embed(embedder, test_mels, args.batch_files)
+    timing['embed'] = time.time() - start
+
+    start = time.time()
+    names = sorted(set(spk for spk, _ in enroll_mels))
+    enroll_labels = torch.tensor([names.index(spk) for spk, _ in enroll_mels])
+    gallery = torch.zeros(len(names), enroll_dvecs.size(1)).index_add_(0, enroll_labels, enroll_dvecs)
+    gallery = F.normalize(gallery, p=2, dim=1)
+    scores = torch.mm(test_dvecs, gallery.t()) # (test files, speakers)
+    timing['score'] = time.time() - start
+
+    start = time.time()
+    test_spk = [spk for spk, _ in test_mels]
+    known = np.array([spk in names for spk in test_spk])
+    truth = np.array([names.index(spk) if spk in names else -1 for spk in test_spk])
+    best_score, best = scores.max(dim=1)
+    best_score, best = best_score.numpy(), best.numpy()
+    target = (truth[:, None] == np.arange(len(names))[None, :])
+    flat_scores, flat_labels = scores.numpy().ravel(), target.ravel()
+    check_trials(flat_labels)
+
+    eer, eer_threshold = compute_eer(flat_scores, flat_labels)
+    min_dcf, dcf_threshold = compute_min_dcf(flat_scores, flat_labels, p_target=args.p_target)
+    far, frr = error_rates(flat_scores, flat_labels, args.threshold)
+    eer_far, eer_frr = error_rates(flat_scores, flat_labels, eer_threshold)
+    timing['metrics'] = time.time() - start
+
+    audio_seconds = sum(mel.shape[1] for _, mel in enroll_mels + test_mels) * hp.audio.hop_length \
+        / hp.audio.sample_rate
+    files = len(enroll_mels) + len(test_mels)
+    report.update({
+        'speakers': len(names),
+        'enroll_files': len(enroll_mels),
+        'test_files': len(test_mels),
+        'skipped_files': enroll_skipped + test_skipped,
+        'identification': {
+            'accuracy': float((best[known] == truth[known]).mean()) if known.any() else 0.0,
+            'accuracy_at_threshold': float(((best == truth) & (best_score >= args.threshold))[known].mean())
+            if known.any() else 0.0,
+            'unknown_rejected': float((best_score[~known] < args.threshold).mean()) if (~known).any() else None,
+        },
+        'verification': {
+            'eer': eer,
+            'eer_threshold': eer_threshold,
+            'min_dcf': min_dcf,
+            'min_dcf_threshold': dcf_threshold,
+            'p_target': args.p_target,
+            'service_threshold': args.threshold,
+            'far_at_service_threshold': far,
+            'frr_at_service_threshold': frr,
+            'far_at_eer_threshold': eer_far,
+            'frr_at_eer_threshold': eer_frr,
+        },
+        'timing': timing,
+        'throughput': {
+            'files_per_second': files / max(timing['decode_mel'] + timing['embed'], 1e-9),
+            'embed_real_time_factor': timing['embed'] / max(audio_seconds, 1e-9),
+            'audio_seconds': audio_seconds,
+        },
+    })
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/default.yaml',
+                        help="yaml file for configuration")
+    parser.add_argument('-e', '--embedder_path', type=str, default='embedder.pt',
+                        help="path of embedder model pt file")
+    parser.add_argument('--enroll_path', type=str, required=True,
+                        help="folder per speaker with the enrollment audio")
+    parser.add_argument('--test_path', type=str, required=True,
+                        help="folder per speaker with the test audio")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="acceptance threshold used by the service")
+    parser.add_argument('--p_target', type=float, default=0.01,
+                        help="target prior for minDCF")
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'dynamic'],
+                        help="dynamic: int8 LSTM/Linear weights")
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help="decoding/mel processes")
+    parser.add_argument('--chunksize', type=int, default=8)
+    parser.add_argument('--batch_files', type=int, default=64,
+                        help="files per embedder forward pass")
+    parser.add_argument('--output', type=str, default=None, help="write the report as JSON")
+    main(parser.parse_args())
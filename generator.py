@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+VoiceFilter training data generation.
+
+Samples (reference, target, interferer) triples from a folder-per-speaker tree (e.g.
+LibriSpeech), mixes them at the recorded levels or at random SNRs and computes the
+magnitudes in a process pool, one batched STFT per group of mixtures. Training mixtures
+are written straight into shards (<out_dir>/train/shards, one writer per process, no
+wav or .pt files); the test set is written as per-sample files for validation.
+
+    python3 generator.py -c config/default.yaml -d LibriSpeech/train-clean-100 -o voicefilter_data \
+        --train_num 100000 --test_num 100 --snr_min -5 --snr_max 5
+"""
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from scipy.io.wavfile import write
+from utils.hparams import HParam
+from utils.audio import Audio
+from utils.mixing import random_mixture
+from utils.speakers import speaker_files
+from datasets.shards import ShardWriter, write_index
+
+
+def usable_speakers(speakers):
+    return [spk for spk, files in speakers.items() if len(files) >= 2]
+
+
+def generate_shards(job):
+    """Writes `count` training mixtures into shards of its own. Returns the part for write_index."""
+    part, count, seed, args, speakers = job
+    hp = HParam(args.config)
+    audio = Audio(hp)
+    rng = np.random.RandomState(seed)
+    names = usable_speakers(speakers)
+    writer = ShardWriter(os.path.join(args.out_dir, 'train', 'shards'), hp.audio.num_freq,
+                         dtype=args.dtype, shard_bytes=args.shard_mb << 20, prefix='part{:03d}'.format(part))
+    for start in range(0, count, args.batch):
+        mixtures = [random_mixture(hp, rng, speakers, names, snr_range(args))
+                    for _ in range(min(args.batch, count - start))]
+        mags = audio.wav2spec_batch(np.stack([m[1] for m in mixtures] + [m[2] for m in mixtures]))
+        for i, (ref, _, _, _) in enumerate(mixtures):
+            writer.add(mags[i], mags[len(mixtures) + i], ref)
+    return part, writer.part()
+
+
+def generate_files(job):
+    """Writes test mixtures as '<num>-*.wav/.pt/-dvec.txt' files."""
+    first, count, seed, args, speakers = job
+    hp = HParam(args.config)
+    audio = Audio(hp)
+    rng = np.random.RandomState(seed)
+    names = usable_speakers(speakers)
+    out_dir = os.path.join(args.out_dir, 'test')
+    for num in range(first, first + count):
+        ref, target_wav, mixed_wav, _ = random_mixture(hp, rng, speakers, names, snr_range(args))
+        target_mag, mixed_mag = audio.wav2spec_batch(np.stack([target_wav, mixed_wav]))
+
+        def path(form):
+            return os.path.join(out_dir, form.replace('*', '%06d' % num))
+        write(path(hp.form.target.wav), hp.audio.sample_rate, target_wav)
+        write(path(hp.form.mixed.wav), hp.audio.sample_rate, mixed_wav)
+        torch.save(torch.from_numpy(target_mag), path(hp.form.target.mag))
+        torch.save(torch.from_numpy(mixed_mag), path(hp.form.mixed.mag))
+        with open(path(hp.form.dvec), 'w') as f:
+            f.write(os.path.abspath(ref))
+    return count
+
+
+def snr_range(args):
+    return None if args.snr_min is None else (args.snr_min, args.snr_max)
+
+
+def split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def main(args):
+    if (args.snr_min is None) != (args.snr_max is None):
+        raise SystemExit('--snr_min and --snr_max go together.')
+    speakers = speaker_files(args.data_path)
+    if args.test_path:
+        train_speakers, test_speakers = speakers, speaker_files(args.test_path)
+    else:
+        # hold out the last speakers, never mixed into the training set
+        held_out = max(2, len(speakers) // 20)
+        names = sorted(speakers)
+        train_speakers = {spk: speakers[spk] for spk in names[:-held_out]}
+        test_speakers = {spk: speakers[spk] for spk in names[-held_out:]}
+    for subset, name in ((train_speakers, 'train'), (test_speakers, 'test')):
+        if len(usable_speakers(subset)) < 2:
+            raise SystemExit('The {} set needs two speakers with two files each.'.format(name))
+    os.makedirs(os.path.join(args.out_dir, 'train', 'shards'), exist_ok=True)
+    os.makedirs(os.path.join(args.out_dir, 'test'), exist_ok=True)
+
+    # several parts per process so slow parts do not leave processes idle
+    counts = split(args.train_num, args.num_workers * 4)
+    train_jobs = [(i, count, args.seed + i, args, train_speakers) for i, count in enumerate(counts) if count]
+    test_counts = split(args.test_num, args.num_workers)
+    firsts = np.cumsum([0] + test_counts[:-1])
+    test_jobs = [(int(first), count, args.seed + 100000 + i, args, test_speakers)
+                 for i, (first, count) in enumerate(zip(firsts, test_counts)) if count]
+
+    start = time.time()
+    done = 0
+    parts = {}
+    with multiprocessing.Pool(args.num_workers) as pool:
+        for part, written in pool.imap_unordered(generate_shards, train_jobs):
+            parts[part] = written
+            done += len(written['rows'])
+            print("{}/{} training mixtures, {:.1f}/s".format(done, args.train_num, done / (time.time() - start)))
+        for count in pool.imap_unordered(generate_files, test_jobs):
+            print("{} test mixtures".format(count))
+
+    hp = HParam(args.config)
+    write_index(os.path.join(args.out_dir, 'train', 'shards'), hp.audio.num_freq, args.dtype,
+                [parts[part] for part in sorted(parts)])
+    print("Set data.train_dir: {} and data.test_dir: {} in the config.".format(
+        os.path.join(args.out_dir, 'train'), os.path.join(args.out_dir, 'test')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help="yaml file for configuration")
+    parser.add_argument('-d', '--data_path', type=str, required=True,
+                        help="folder with one sub-folder per speaker")
+    parser.add_argument('--test_path', type=str, default=None,
+                        help="speakers for the test set, default: 5%% of --data_path held out")
+    parser.add_argument('-o', '--out_dir', type=str, required=True,
+                        help="directory of output")
+    parser.add_argument('-p', '--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes")
+    parser.add_argument('--train_num', type=int, default=100000)
+    parser.add_argument('--test_num', type=int, default=100)
+    parser.add_argument('--snr_min', type=float, default=None,
+                        help="dB of the target over the interferer, default: recorded levels")
+    parser.add_argument('--snr_max', type=float, default=None)
+    parser.add_argument('--batch', type=int, default=32,
+                        help="mixtures per batched STFT")
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float32', 'float16'],
+                        help="magnitudes are in [0, 1], float16 halves the disk use")
+    parser.add_argument('--shard_mb', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
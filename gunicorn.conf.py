@@ -0,0 +1,55 @@
+# production server for main.py: gunicorn -c gunicorn.conf.py main:app
+#
+# Pre-fork: the master loads the embedder into shared memory and maps the gallery
+# snapshot before forking, workers attach to the same pages read-only. Each worker
+# gets cores // workers intra-op threads so workers do not oversubscribe the CPU.
+# Workers write their metrics to PROMETHEUS_MULTIPROC_DIR, so /metrics on any
+# worker reports the whole server.
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 7000))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = 120
+keepalive = 5
+preload_app = True
+
+# must be set before prometheus_client is imported by the preloaded app, and emptied
+# on every start so counters of a previous run are not added in
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'speaker_id_metrics'))
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir)
+
+torch_threads = int(os.environ.get('TORCH_THREADS', max(1, multiprocessing.cpu_count() // workers)))
+
+
+def when_ready(server):
+    import torch
+    from utils import startup
+    from voice_authentication import share_model, load_gallery
+    # a single thread in the master, so no OpenMP pool exists when workers are forked
+    torch.set_num_threads(1)
+    share_model()
+    with startup.phase('gallery'):
+        load_gallery()
+    server.log.info('Embedder and gallery loaded in the master, {} torch threads per worker'.format(
+        torch_threads))
+    server.log.info(startup.report())
+
+
+def post_fork(server, worker):
+    import torch
+    from voice_authentication import watch_version
+    torch.set_num_threads(torch_threads)
+    # each worker loads a newly activated embedder/gallery in the background, then switches
+    watch_version()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
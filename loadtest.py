@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Load generator for stream_server.py.
+
+Simulates concurrent websocket clients speaking the client.js protocol: int16 chunks of
+4096 samples at 44.1 kHz resampled to 16 kHz, sent at real-time pace (--speed 2 sends twice as
+fast), followed by a 'stop' message. Audio comes from a folder-per-speaker tree, from
+synthetic speech, or from sessions recorded by a server started with SESSION_RECORD_DIR.
+
+    python3 loadtest.py --start_server --synthetic 8 --task identify --clients 4 --sessions 40 --enroll_first
+    python3 loadtest.py --uri wss://host:5555 --data_path customers/ --task verify --clients 16
+    python3 loadtest.py --start_server --replay recorded_sessions/ --clients 8 --speed 4
+
+Reported are time-to-decision (session start to final answer) and decision latency (last
+message sent to final answer) percentiles, throughput and error rates.
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import base64
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import websockets
+
+SAMPLE_RATE = 16000
+CHUNK_SAMPLES = int(round(4096 * SAMPLE_RATE / 44100)) # one client.js ScriptProcessor buffer
+CHUNK_SECONDS = 4096 / 44100
+AUDIO_TASKS = ('enroll', 'verify', 'identify')
+
+
+class LocalS3():
+    """
+    Minimal S3 stand-in for upload_to_bucket: PUT/GET/HEAD/DELETE of objects under a
+    folder, no authentication, so a local server never touches the real bucket.
+    """
+    def __init__(self, root, port=0):
+        storage = root
+
+        class Handler(BaseHTTPRequestHandler):
+            def path_of(self):
+                return os.path.join(storage, self.path.split('?')[0].lstrip('/'))
+
+            def do_PUT(self):
+                path = self.path_of()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as fp:
+                    fp.write(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.send_response(200)
+                self.send_header('ETag', '"0"')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                path = self.path_of()
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                with open(path, 'rb') as fp:
+                    body = fp.read()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command == 'GET':
+                    self.wfile.write(body)
+
+            do_HEAD = do_GET
+
+            def do_DELETE(self):
+                if os.path.isfile(self.path_of()):
+                    os.remove(self.path_of())
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, s3_url):
+    port = free_port()
+    env = dict(os.environ, WS_SSL='0', WS_PORT=str(port), MAX_CONNECTION=str(args.clients + 1),
+               S3_ENDPOINT_URL=s3_url, ACCESS_KEY='local', SECRET_KEY='local')
+    proc = subprocess.Popen([sys.executable, 'stream_server.py'], env=env,
+                            cwd=os.path.dirname(os.path.realpath(__file__)))
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('stream_server.py exited with code {}'.format(proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, 'ws://127.0.0.1:{}'.format(port)
+        except OSError:
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError('stream_server.py did not start listening')
+
+
+def session_messages(pcm, task, spk_name, mode=None):
+    """
+    The (send offset in seconds, message) sequence client.js produces for one recording.
+    """
+    command = {'task': task, 'spk_name': spk_name}
+    if mode:
+        command['mode'] = mode
+    messages = []
+    for i, start in enumerate(range(0, len(pcm), CHUNK_SAMPLES)):
+        chunk = pcm[start:start + CHUNK_SAMPLES]
+        # JSON.stringify of an Int16Array
+        data = {str(k): int(v) for k, v in enumerate(chunk)}
+        messages.append(((i + 1) * CHUNK_SECONDS, json.dumps(dict(command, record='start', data=data))))
+    stop_at = messages[-1][0] if messages else 0.0
+    messages.append((stop_at, json.dumps(dict(command, record='stop', data=[]))))
+    return messages
+
+
+def load_recording(path):
+    # binary entries are the compressed audio of a client streaming Opus
+    with open(path) as fp:
+        return [(entry['t'], entry['message'] if 'message' in entry else base64.b64decode(entry['binary']))
+                for entry in map(json.loads, fp) if entry]
+
+
+def load_audio(path, max_seconds):
+    import librosa
+    wav, _ = librosa.load(path, sr=SAMPLE_RATE, duration=max_seconds)
+    return (np.clip(wav, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def build_sessions(args):
+    """Returns ({speaker: session} of enrollments, [session] of the load)."""
+    if args.replay:
+        names = sorted(x for x in os.listdir(args.replay) if x.endswith('.jsonl'))
+        return {}, [plan_session(load_recording(os.path.join(args.replay, x))) for x in names]
+
+    if args.data_path:
+        from utils.speakers import speaker_files
+        clips = {spk: [load_audio(path, args.max_seconds) for path in files[:args.files_per_speaker]]
+                 for spk, files in speaker_files(args.data_path).items()}
+    else:
+        from benchmarks.synthetic import synthetic_pcm
+        clips = {'load_{:03d}'.format(k): [synthetic_pcm(args.max_seconds, seed=1000 * k + i)
+                                           for i in range(args.files_per_speaker)]
+                 for k in range(args.synthetic)}
+
+    task, mode = args.task, None
+    if task == 'identify_continuous':
+        task, mode = 'identify', 'continuous'
+    elif task == 'verify_sequential':
+        task, mode = 'verify', 'sequential'
+    enrollments = {spk: plan_session(session_messages(pcms[0], 'enroll', spk)) for spk, pcms in clips.items()}
+    sessions = [plan_session(session_messages(pcm, task, spk, mode)) for spk, pcms in clips.items() for pcm in pcms]
+    return enrollments, sessions
+
+
+def is_final(response):
+    return response.get('task') in AUDIO_TASKS and not response.get('partial', False)
+
+
+def plan_session(messages):
+    """
+    Wraps a message sequence with what the player needs to know about it: the index
+    of the last 'stop', whether it is a sequential verification and the audio it streams.
+    """
+    last_stop, sequential, audio = len(messages) - 1, False, 0.0
+    for i, (_, message) in enumerate(messages):
+        if isinstance(message, bytes):
+            continue
+        command = json.loads(message)
+        if command.get('record') == 'start':
+            audio += len(command.get('data') or []) / SAMPLE_RATE
+        elif command.get('record') == 'stop':
+            last_stop = i
+            sequential = command.get('task') == 'verify' and command.get('mode') == 'sequential'
+    return {'messages': messages, 'last_stop': last_stop, 'sequential': sequential, 'audio': audio}
+
+
+async def run_session(uri, session, speed, timeout, ssl_context):
+    """
+    Plays one session. Returns a dict with the timings of its final decisions, or the error.
+    """
+    messages, last_stop = session['messages'], session['last_stop']
+    result = {'decisions': [], 'error': None, 'audio': session['audio']}
+    sent = [] # send times
+    stop_sent = asyncio.Event()
+    done = asyncio.Event()
+    try:
+        async with websockets.connect(uri, ssl=ssl_context, max_size=None) as ws:
+            start = time.perf_counter()
+
+            async def send():
+                for i, (offset, message) in enumerate(messages):
+                    delay = start + offset / speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await ws.send(message)
+                    sent.append(time.perf_counter())
+                    if i == last_stop:
+                        stop_sent.set()
+                        # an early sequential answer is not repeated after 'stop'
+                        if session['sequential'] and result['decisions']:
+                            done.set()
+
+            async def receive():
+                async for raw in ws:
+                    now = time.perf_counter()
+                    response = json.loads(raw)
+                    if response.get('task') == 'alert':
+                        result['error'] = 'alert: {}'.format(response.get('message'))
+                        done.set()
+                        return
+                    if is_final(response):
+                        result['decisions'].append({
+                            'time_to_decision': now - start,
+                            'latency': now - sent[-1] if sent else 0.0,
+                            'status': response.get('status'),
+                        })
+                        if stop_sent.is_set() or session['sequential']:
+                            done.set()
+
+            sender = asyncio.ensure_future(send())
+            receiver = asyncio.ensure_future(receive())
+            try:
+                await asyncio.wait_for(done.wait(), timeout=timeout + messages[-1][0] / speed)
+            except asyncio.TimeoutError:
+                result['error'] = 'timeout'
+            finally:
+                sender.cancel()
+                receiver.cancel()
+    except (OSError, websockets.WebSocketException) as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {name: float(np.percentile(values, q)) for name, q in
+            (('p50', 50), ('p90', 90), ('p95', 95), ('p99', 99), ('max', 100))}
+
+
+async def run_load(args, uri, sessions, ssl_context):
+    queue = asyncio.Queue()
+    for i in range(args.sessions or len(sessions)):
+        queue.put_nowait(sessions[i % len(sessions)])
+    results = []
+
+    async def client():
+        while not queue.empty():
+            session = queue.get_nowait()
+            results.append(await run_session(uri, session, args.speed, args.timeout, ssl_context))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.clients)])
+    return results, time.perf_counter() - start
+
+
+def report(results, elapsed):
+    decisions = [d for r in results for d in r['decisions']]
+    errors = Counter(r['error'].split(':')[0] for r in results if r['error'])
+    return {
+        'sessions': len(results),
+        'errors': sum(errors.values()),
+        'error_rate': sum(errors.values()) / max(len(results), 1),
+        'errors_by_kind': dict(errors),
+        'decisions': len(decisions),
+        'accepted': sum(d['status'] in ('true', 'success') for d in decisions),
+        'elapsed': elapsed,
+        'decisions_per_second': len(decisions) / elapsed,
+        'sessions_per_second': len(results) / elapsed,
+        'audio_seconds_per_second': sum(r['audio'] for r in results) / elapsed,
+        'time_to_decision': percentiles([d['time_to_decision'] for d in decisions]),
+        'decision_latency': percentiles([d['latency'] for d in decisions]),
+    }
+
+
+def main(args):
+    enrollments, sessions = build_sessions(args)
+    if not sessions:
+        raise SystemExit('No sessions to play.')
+    ssl_context = None
+    if args.uri and args.uri.startswith('wss'):
+        ssl_context = ssl.create_default_context()
+        if args.insecure:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+
+    s3, server, uri = None, None, args.uri
+    if args.start_server:
+        s3 = LocalS3(args.s3_path or tempfile.mkdtemp(prefix='local_s3_')).start()
+        server, uri = start_server(args, s3.url)
+        print("Started stream_server.py at {}, S3 stand-in at {}".format(uri, s3.url))
+    loop = asyncio.get_event_loop()
+    try:
+        if args.enroll_first:
+            for spk, session in enrollments.items():
+                result = loop.run_until_complete(run_session(uri, session, args.speed, args.timeout, ssl_context))
+                print("Enrolled {}: {}".format(spk, result['error'] or 'ok'))
+        results, elapsed = loop.run_until_complete(run_load(args, uri, sessions, ssl_context))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if s3 is not None:
+            s3.stop()
+
+    summary = report(results, elapsed)
+    print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, 'w') as fp:
+            json.dump(dict(summary, args=vars(args)), fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', type=str, default=None,
+                        help="server to load, e.g. wss://host:5555 (or use --start_server)")
+    parser.add_argument('--start_server', action='store_true',
+                        help="start stream_server.py locally without SSL, with a local S3 stand-in")
+    parser.add_argument('--s3_path', type=str, default=None,
+                        help="folder of the S3 stand-in, default a temporary folder")
+    parser.add_argument('--insecure', action='store_true',
+                        help="do not verify the server certificate")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--data_path', type=str, default=None,
+                        help="folder with one sub-folder per speaker")
+    source.add_argument('--synthetic', type=int, default=4,
+                        help="number of synthetic speakers")
+    source.add_argument('--replay', type=str, default=None,
+                        help="folder of sessions recorded with SESSION_RECORD_DIR")
+    parser.add_argument('--task', type=str, default='identify',
+                        choices=['enroll', 'verify', 'identify', 'identify_continuous', 'verify_sequential'])
+    parser.add_argument('--enroll_first', action='store_true',
+                        help="enroll every speaker (first file) before the load")
+    parser.add_argument('--files_per_speaker', type=int, default=2)
+    parser.add_argument('--max_seconds', type=float, default=6.5,
+                        help="audio per session, the server decides by itself at 7 s")
+    parser.add_argument('--clients', type=int, default=4,
+                        help="concurrent websocket clients")
+    parser.add_argument('--sessions', type=int, default=None,
+                        help="sessions to play in total, default one per recording")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="1 sends at real-time pace, 2 twice as fast")
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help="seconds to wait for a decision after the last message")
+    parser.add_argument('--report', type=str, default=None,
+                        help="also write the summary as JSON to this file")
+    args = parser.parse_args()
+    if not args.uri and not args.start_server:
+        parser.error('--uri or --start_server is required')
+    main(args)
@@ -1,18 +1,288 @@
 #!/usr/bin/env python3
 
-from flask_restful import Api
-from flask import Flask, render_template
+import io
+import os
+import json
+import time
+import base64
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from flask_restful import Api, Resource
+from flask import Flask, Response, render_template, request, g
+from utils import metrics, profiling, startup
+with startup.phase('import voice_service'):
+    from voice_service import voice_database, remove_voice, enroll_voices, auth_wav, auth_voices, \
+        decode_audio, verify_sequential, speaker_timeline, separate_voice, float2pcm, SAMPLE_RATE, \
+        SEPARATE_BEFORE_VERIFY, DEFAULT_CHANNEL, speaker_name
 
 app = Flask(__name__)
 api = Api()
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
+
+DECODE_WORKERS = 4
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') # without it, admin endpoints only answer localhost
+profiling.watch()
+
+
+def json_response(response, status=200):
+    """
+    response: string (json dumped)
+    """
+    return Response(response, status=status, mimetype='application/json')
+
+
+def request_clips():
+    """
+    Collects the audio clips of a request, accepted as:
+        * multipart/form-data: one or more 'audio_data' file parts, fields in the form
+        * raw audio body (audio/*, application/octet-stream), fields in the query string
+        * JSON with base64 'audio_data', or a 'clips' list of such objects (bulk)
+    Returns (params, spk_names, streams). File parts and raw bodies are handed to
+    the decoder as streams and never read into memory whole.
+    """
+    if request.mimetype == 'multipart/form-data':
+        params = request.form
+        streams = [f.stream for f in request.files.getlist('audio_data')]
+        spk_names = request.form.getlist('spk_name')
+    elif request.is_json:
+        params = request.get_json()
+        clips = params.get('clips', [params])
+        streams = [io.BytesIO(base64.b64decode(clip['audio_data'])) for clip in clips]
+        spk_names = [clip.get('spk_name', '') for clip in clips]
+    else:
+        params = request.args
+        streams = [request.stream]
+        spk_names = request.args.getlist('spk_name')
+
+    if len(spk_names) <= 1:
+        spk_names = [spk_names[0] if spk_names else ''] * len(streams)
+    if len(spk_names) != len(streams):
+        raise ValueError('Expected one spk_name per audio clip.')
+    return params, spk_names, streams
+
+
+def decode_clips(streams):
+    # ffmpeg runs out of process, so clips of a bulk request decode in parallel
+    return list(decode_pool.map(profiling.in_span(decode_audio), streams))
+
+
+def is_admin():
+    if ADMIN_TOKEN:
+        return request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def error_response(task, error, status=200):
+    metrics.ERRORS.labels('http').inc()
+    return json_response(json.dumps({
+        'status': 'false',
+        'task': task,
+        'message': repr(error)
+    }, indent=2), status)
+
+
+def invalid_name(task, spk_names):
+    """A 400 response for the first spk_name that cannot name a speaker, None if all can."""
+    for spk_name in spk_names:
+        try:
+            speaker_name(spk_name)
+        except ValueError as error:
+            return error_response(task, error, 400)
+    return None
+
+
+class VoiceEnroll(Resource):
+    def post(self):
+        try:
+            params, spk_names, streams = request_clips()
+            if len(streams) == 0:
+                raise ValueError('spk_name and audio_data are required.')
+            invalid = invalid_name('enroll', spk_names)
+            if invalid is not None:
+                return invalid
+            channel = params.get('channel') or DEFAULT_CHANNEL
+            return json_response(enroll_voices(decode_clips(streams), spk_names, channel, params.get('tenant')))
+        except Exception as error:
+            return error_response('enroll', error)
+
+
+class VoiceAuth(Resource):
+    def post(self):
+        task = 'identify'
+        try:
+            params, spk_names, streams = request_clips()
+            task = params.get('task_flag', task)
+            if len(streams) != 1:
+                raise ValueError('Expected exactly one audio clip, use /voice_auth_bulk for more.')
+            invalid = invalid_name(task, spk_names) if task == 'verify' else None
+            if invalid is not None:
+                return invalid
+            wav = decode_audio(streams[0])
+            if task == 'verify' and params.get('mode') == 'sequential':
+                return json_response(verify_sequential(wav, spk_names[0], params.get('tenant')))
+            separate = str(params.get('separate', SEPARATE_BEFORE_VERIFY)).lower() == 'true'
+            return json_response(auth_wav(wav, task, spk_names[0], separate=separate, tenant=params.get('tenant')))
+        except Exception as error:
+            return error_response(task, error)
+
+
+class VoiceAuthBulk(Resource):
+    def post(self):
+        task = 'identify'
+        try:
+            params, spk_names, streams = request_clips()
+            task = params.get('task_flag', task)
+            invalid = invalid_name(task, spk_names) if task == 'verify' else None
+            if invalid is not None:
+                return invalid
+            return json_response(auth_voices(decode_clips(streams), task, spk_names, params.get('tenant')))
+        except Exception as error:
+            return error_response(task, error)
+
+
+class VoiceTimeline(Resource):
+    def post(self):
+        try:
+            params, spk_names, streams = request_clips()
+            if len(streams) != 1:
+                raise ValueError('Expected exactly one audio clip.')
+            return json_response(speaker_timeline(decode_audio(streams[0]), tenant=params.get('tenant')))
+        except Exception as error:
+            return error_response('timeline', error)
+
+
+class VoiceSeparate(Resource):
+    def post(self):
+        """
+        Keeps the voice of the enrolled spk_name. Answers a 16-bit WAV with the timings
+        in X-Separation-* headers, or JSON with base64 'audio_data' when format=json.
+        """
+        try:
+            params, spk_names, streams = request_clips()
+            if len(streams) != 1:
+                raise ValueError('Expected one audio clip and its spk_name.')
+            invalid = invalid_name('separate', spk_names)
+            if invalid is not None:
+                return invalid
+            result_json, separated = separate_voice(decode_audio(streams[0]), spk_names[0], params.get('tenant'))
+            if separated is None:
+                return json_response(json.dumps(result_json, indent=2))
+            from scipy.io.wavfile import write
+            buffer = io.BytesIO()
+            write(buffer, SAMPLE_RATE, float2pcm(separated))
+            if params.get('format') == 'json':
+                result_json['audio_data'] = base64.b64encode(buffer.getvalue()).decode('ascii')
+                return json_response(json.dumps(result_json, indent=2))
+            stats = result_json['message']
+            return Response(buffer.getvalue(), mimetype='audio/wav', headers={
+                'X-Separation-Seconds': str(stats['seconds']),
+                'X-Separation-Elapsed': str(stats['elapsed']),
+                'X-Separation-Real-Time-Factor': str(stats['real_time_factor']),
+            })
+        except Exception as error:
+            return error_response('separate', error)
+
+
+class VoiceDataBase(Resource):
+    def get(self):
+        return json_response(voice_database(request.values.get('tenant')))
+
+    def post(self):
+        return self.get()
+
+
+class Profile(Resource):
+    def post(self):
+        """
+        Starts a profiling capture in every worker, for the next `requests` requests
+        of each worker or `seconds` seconds (default 30 s).
+        """
+        if not is_admin():
+            return error_response('profile', PermissionError('Admin token required.'))
+        try:
+            params = request.get_json(silent=True) or request.values
+            requests = params.get('requests')
+            seconds = params.get('seconds')
+            capture_id = profiling.request_capture(
+                requests=None if requests is None else int(requests),
+                seconds=None if seconds is None else float(seconds),
+                interval=float(params.get('interval', 0.005)),
+                torch_trace=str(params.get('torch', 'true')).lower() != 'false')
+            return json_response(json.dumps({
+                'status': 'true',
+                'task': 'profile',
+                'message': {
+                    'capture_id': capture_id,
+                    'path': os.path.join(profiling.PROFILE_DIR, capture_id)
+                }
+            }, indent=2))
+        except Exception as error:
+            return error_response('profile', error)
+
+
+class VoiceRemove(Resource):
+    def post(self):
+        try:
+            params = request.get_json(silent=True) or request.values
+            invalid = invalid_name('remove_voice', [params.get('spk_name')])
+            if invalid is not None:
+                return invalid
+            return json_response(remove_voice(params['spk_name'], params.get('tenant')))
+        except Exception as error:
+            return error_response('remove_voice', error)
+
+
+api.add_resource(VoiceEnroll, '/voice_enroll')
+api.add_resource(VoiceAuth, '/voice_auth')
+api.add_resource(VoiceAuthBulk, '/voice_auth_bulk')
+api.add_resource(VoiceTimeline, '/voice_timeline')
+api.add_resource(VoiceSeparate, '/voice_separate')
+api.add_resource(VoiceDataBase, '/get_voice_list')
+api.add_resource(VoiceRemove, '/voice_remove')
+api.add_resource(Profile, '/admin/profile')
 api.init_app(app)
 
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or profiling.new_request_id()
+    g.span = ExitStack()
+    g.span.enter_context(profiling.request_span(g.request_id))
+    metrics.QUEUE_DEPTH.labels('http').inc()
+
+
+@app.after_request
+def add_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+@app.teardown_request
+def stop_timer(error=None):
+    if 'start' in g:
+        g.span.close()
+        metrics.QUEUE_DEPTH.labels('http').dec()
+        metrics.REQUEST_SECONDS.labels('http', request.endpoint or 'unknown').observe(
+            time.perf_counter() - g.start)
+
+
+@app.route('/metrics')
+def Metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
 @app.route('/')
 def RenderMainIndex():
     return render_template('index.html')
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True, port=7000)
+    # development only, use `gunicorn -c gunicorn.conf.py main:app` in production
+    from voice_authentication import watch_version
+    watch_version()
+    app.run(host='0.0.0.0', debug=False, port=7000)
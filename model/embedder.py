@@ -21,13 +21,29 @@ class SpeechEmbedder(nn.Module):
         self.proj = LinearNorm(hp)
         self.hp = hp
 
-    def forward(self, mel):
+    def frames(self, mel):
         # (num_mels, T)
         mels = mel.unfold(1, self.hp.embedder.window, self.hp.embedder.stride) # (num_mels, T', window)
         mels = mels.permute(1, 2, 0) # (T', window, num_mels)
+        return mels
+
+    def embed_frames(self, mels):
+        # (T', window, num_mels)
         x, _ = self.lstm(mels) # (T', window, lstm_hidden)
         x = x[:, -1, :] # (T', lstm_hidden), use last frame only
         x = self.proj(x) # (T', emb_dim)
         x = x / torch.norm(x, p=2, dim=1, keepdim=True) # (T', emb_dim)
+        return x
+
+    def forward(self, mel):
+        x = self.embed_frames(self.frames(mel)) # (T', emb_dim)
         x = x.sum(0) / x.size(0) # (emb_dim), average pooling over time frames
         return x
+
+    def forward_batch(self, mel_list, max_windows=1024):
+        # list of (num_mels, T_i) -> (B, emb_dim), one LSTM pass over all windows
+        frames = [self.frames(mel) for mel in mel_list]
+        counts = [f.size(0) for f in frames]
+        mels = torch.cat(frames, dim=0) # (sum T_i', window, num_mels)
+        x = torch.cat([self.embed_frames(chunk) for chunk in mels.split(max_windows)], dim=0)
+        return torch.stack([chunk.sum(0) / chunk.size(0) for chunk in x.split(counts)], dim=0)
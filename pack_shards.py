@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Packs a VoiceFilter training folder of per-sample '*-target.pt' / '*-mixed.pt' magnitudes
+into memory-mapped shards in '<train_dir>/shards', which create_dataloader then prefers.
+"""
+import os
+import argparse
+import torch
+from utils.hparams import HParam
+from utils.dvec_cache import reference_path
+from datasets.dataloader import find_all
+from datasets.shards import ShardWriter
+
+
+def main(args):
+    hp = HParam(args.config)
+    data_dir = args.data_dir or hp.data.train_dir
+    dvec_list = find_all(data_dir, hp.form.dvec)
+    target_list = find_all(data_dir, hp.form.target.mag)
+    mixed_list = find_all(data_dir, hp.form.mixed.mag)
+    assert len(dvec_list) == len(target_list) == len(mixed_list) != 0, \
+        "number of training files must match"
+
+    writer = ShardWriter(args.output or os.path.join(data_dir, 'shards'), hp.audio.num_freq,
+                         dtype=args.dtype, shard_bytes=args.shard_mb << 20)
+    for i, (dvec, target, mixed) in enumerate(zip(dvec_list, target_list, mixed_list)):
+        writer.add(torch.load(target).numpy(), torch.load(mixed).numpy(), reference_path(dvec))
+        if (i + 1) % 10000 == 0:
+            print("{}/{} samples packed".format(i + 1, len(dvec_list)))
+    writer.close()
+    print("{} samples in {} shards".format(len(dvec_list), len(writer.shards)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help="yaml file for configuration")
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help="overrides data.train_dir of the config")
+    parser.add_argument('--output', type=str, default=None,
+                        help="shard folder, default <data_dir>/shards")
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help="float16 halves the size, magnitudes are in [0, 1]")
+    parser.add_argument('--shard_mb', type=int, default=256)
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Precomputes the reference d-vectors of a VoiceFilter dataset.
+
+Every '*-dvec.txt' under data.train_dir and data.test_dir, every sample of the training
+shards and, for on-the-fly mixing, every file under data.mix_source is a reference wav. Their mels
+are computed in a process pool, embedded in large batches and appended to the d-vector
+cache in data.dvec_cache (or --cache_dir), keyed by the embedder checksum. References that
+are already cached are skipped, so the command can be re-run after adding data.
+"""
+import os
+import json
+import glob
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import librosa
+from utils.hparams import HParam
+from utils.audio import Audio
+from utils.dvec_cache import DvecCache, cache_key, reference_path
+from utils.speakers import audio_files
+from datasets.shards import is_sharded
+from model.embedder import SpeechEmbedder
+
+_hp = None
+_audio = None
+
+
+def init_worker(conf_file):
+    global _hp, _audio
+    torch.set_num_threads(1)
+    _hp = HParam(conf_file)
+    _audio = Audio(_hp)
+
+
+def reference_mel(path):
+    """Returns (path, mel or error)."""
+    try:
+        wav, _ = librosa.load(path, sr=_hp.audio.sample_rate)
+        mel = _audio.get_mel(wav).astype(np.float32)
+        if mel.shape[1] < _hp.embedder.window:
+            return path, 'too short'
+        return path, mel
+    except Exception as error:
+        return path, repr(error)
+
+
+def main(args):
+    hp = HParam(args.config)
+    cache_dir = args.cache_dir or hp.data.get('dvec_cache') or 'dvec_cache'
+    key = cache_key(args.embedder_path, hp)
+    cache = DvecCache(cache_dir, key)
+
+    references = []
+    for data_dir in (hp.data.train_dir, hp.data.test_dir):
+        if data_dir:
+            references.extend(map(reference_path, glob.glob(os.path.join(data_dir, hp.form.dvec))))
+    shard_dir = os.path.join(hp.data.train_dir, 'shards')
+    if hp.data.train_dir and is_sharded(shard_dir):
+        with open(os.path.join(shard_dir, 'meta.json')) as fp:
+            references.extend(json.load(fp)['dvec'])
+    if hp.data.get('mix_source'):
+        references.extend(audio_files(hp.data.mix_source))
+    todo = cache.missing(references)
+    print("{} references, {} cached, {} to compute".format(len(set(references)), len(cache), len(todo)))
+    if not todo:
+        return
+
+    pool = multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(args.config,))
+    embedder = SpeechEmbedder(hp)
+    embedder.load_state_dict(torch.load(args.embedder_path, map_location='cpu'))
+    embedder.eval()
+    if torch.cuda.is_available():
+        embedder.cuda()
+    device = next(embedder.parameters()).device
+
+    paths, dvecs, batch, batch_windows = [], [], [], 0
+    start = time.time()
+
+    def flush():
+        with torch.no_grad():
+            dvecs.append(embedder.forward_batch([torch.from_numpy(mel).to(device) for _, mel in batch]).cpu().numpy())
+        paths.extend(path for path, _ in batch)
+        print("{}/{} references, {:.1f}/s".format(len(paths), len(todo), len(paths) / (time.time() - start)))
+
+    try:
+        for path, mel in pool.imap(reference_mel, todo, chunksize=args.chunksize):
+            if isinstance(mel, str):
+                print("Skipped {}: {}".format(path, mel))
+                continue
+            batch.append((path, mel))
+            batch_windows += (mel.shape[1] - hp.embedder.window) // hp.embedder.stride + 1
+            if batch_windows >= args.batch_windows:
+                flush()
+                batch, batch_windows = [], 0
+        if batch:
+            flush()
+    finally:
+        pool.close()
+        pool.join()
+    if paths:
+        cache.extend(paths, np.concatenate(dvecs, axis=0))
+    print("{} d-vectors in {}".format(len(cache), cache.base + '.npy'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help="yaml file for configuration")
+    parser.add_argument('-e', '--embedder_path', type=str, required=True,
+                        help="path of embedder model pt file")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="overrides data.dvec_cache of the config")
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help="decoding/mel processes")
+    parser.add_argument('--chunksize', type=int, default=8)
+    parser.add_argument('--batch_windows', type=int, default=2048,
+                        help="embedder windows per forward pass")
+    main(parser.parse_args())
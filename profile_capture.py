@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Starts a profiling capture in every running server (main.py workers and stream_server.py)
+that watches the same profile folder, without going through the HTTP endpoint.
+
+    python3 profile_capture.py --requests 50
+    python3 profile_capture.py --seconds 20 --no_torch
+"""
+import os
+import time
+import argparse
+from utils import profiling
+
+
+def main(args):
+    capture_id = profiling.request_capture(args.profile_dir, requests=args.requests, seconds=args.seconds,
+                                           interval=args.interval, torch_trace=not args.no_torch)
+    path = os.path.join(args.profile_dir, capture_id)
+    print("Capture {} requested, results in {}".format(capture_id, path))
+    if args.wait:
+        # every process that picked it up writes <pid>/summary.json when done
+        time.sleep(profiling.POLL_INTERVAL * 2)
+        while not os.path.isdir(path) or not all(
+                os.path.isfile(os.path.join(path, pid, 'summary.json')) for pid in os.listdir(path)):
+            time.sleep(1.0)
+        print("Done: {}".format(', '.join(sorted(os.listdir(path)))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile_dir', type=str, default=profiling.PROFILE_DIR,
+                        help="folder the servers watch (PROFILE_DIR)")
+    parser.add_argument('--requests', type=int, default=None,
+                        help="requests traced per process")
+    parser.add_argument('--seconds', type=float, default=None,
+                        help="capture length, default 30 s if --requests is not given")
+    parser.add_argument('--interval', type=float, default=0.005,
+                        help="stack sampling interval (seconds)")
+    parser.add_argument('--no_torch', action='store_true',
+                        help="only sample stacks, no torch profiler traces")
+    parser.add_argument('--wait', action='store_true',
+                        help="wait until every process has written its summary")
+    main(parser.parse_args())
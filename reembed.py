@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Rebuilds the gallery for a new embedder and switches the servers to it.
+
+Every enrollment keeps its audio in the enrollment store (<speaker>/<channel>/). The store is
+re-embedded with the batched pipeline of enroll.py into galleries/<fingerprint>/embeddings/, next
+to a copy of the embedder, while the servers keep answering with the current version. Speakers
+enrolled or removed in the meantime are caught up, then the version file is rewritten: every
+serving process loads the new embedder and gallery in the background and switches between two
+requests. A last catch-up pass picks up what was enrolled while the processes were switching.
+Every tenant (.tenants/<tenant>/ in the store and the galleries) is rebuilt the same way.
+Re-running the command after a crash resumes where it stopped.
+"""
+import os
+import time
+import shutil
+import argparse
+import multiprocessing
+from utils.hparams import HParam
+from utils.speakers import speaker_channels
+from voice_authentication import read_version, activate_version, model_fingerprint, gallery_tag, tag_gallery, \
+    bump_generation, tenant_path, tenant_names, enrollment_folder, cur_dir, VERSION_POLL
+from enroll import enroll_speakers, load_progress
+
+
+def enrolled(embeddings_path):
+    if not os.path.isdir(embeddings_path):
+        return set()
+    return set(x[:-4] for x in os.listdir(embeddings_path) if x.endswith('.pth'))
+
+
+def stored(store):
+    return speaker_channels(store) if os.path.isdir(store) else {}
+
+
+def scopes(args, served, version_dir):
+    """
+    The args of the default tenant and of every tenant, each with its own store,
+    served gallery, new gallery and progress file.
+    """
+    result = []
+    for tenant in [None] + sorted(set(tenant_names(args.store)) | set(tenant_names(served.gallery))):
+        scoped = argparse.Namespace(**vars(args))
+        scoped.tenant = tenant
+        scoped.store = tenant_path(args.store, tenant)
+        scoped.served = tenant_path(served.gallery, tenant)
+        scoped.embeddings_path = tenant_path(os.path.join(version_dir, 'embeddings'), tenant)
+        scoped.progress = os.path.join(version_dir, 'progress-{}.txt'.format(tenant) if tenant else 'progress.txt')
+        result.append(scoped)
+    return result
+
+
+def start_time(version_dir):
+    """When the first run for this version started; audio changed since then is caught up."""
+    path = os.path.join(version_dir, 'started')
+    if not os.path.isfile(path):
+        with open(path, 'w') as fp:
+            fp.write(str(time.time()))
+    with open(path) as fp:
+        return float(fp.read())
+
+
+def catch_up(args, since):
+    """
+    Re-embeds the speakers whose audio changed at or after `since` and drops the ones whose
+    audio is gone. Returns (the time this pass started, number of speakers changed).
+    """
+    start = time.time()
+    speakers = stored(args.store)
+    changed = {spk: channels for spk, channels in speakers.items()
+               if os.stat(os.path.join(args.store, spk)).st_mtime >= since}
+    enroll_speakers(args, changed)
+    removed = enrolled(args.embeddings_path) - set(speakers)
+    for spk in removed:
+        os.remove(os.path.join(args.embeddings_path, spk + '.pth'))
+    if removed:
+        bump_generation(args.embeddings_path)
+    print("Caught up {} changed and {} removed speakers".format(len(changed), len(removed)))
+    return start, len(changed) + len(removed)
+
+
+def main(args):
+    hp = HParam(args.config)
+    fingerprint = model_fingerprint(args.embedder_path, hp)
+    served = read_version()
+    if served.fingerprint == fingerprint and not args.force:
+        print("Embedder {} is already served (version {}).".format(fingerprint, served.serial))
+        return
+
+    if args.from_s3:
+        from s3_utils import download_s3_folder, BUCKET_NAME, ENROLLMENT_PREFIX
+        # local audio is newer than its S3 copy or was never uploaded
+        download_s3_folder(BUCKET_NAME, ENROLLMENT_PREFIX + '/', args.store, overwrite=False)
+    os.makedirs(args.store, exist_ok=True)
+    version_dir = os.path.join(args.galleries, fingerprint)
+    missing = [os.path.join(scope.tenant or '', spk) for scope in scopes(args, served, version_dir)
+               for spk in sorted(enrolled(scope.served) - set(stored(scope.store)))]
+    if missing:
+        print("{} enrolled speakers have no stored audio: {}".format(len(missing), ', '.join(missing[:10])))
+        if not args.allow_missing:
+            raise SystemExit("Re-enroll them, or pass --allow_missing to drop them from the new version.")
+
+    embedder_path = os.path.join(version_dir, 'embedder.pt')
+    os.makedirs(os.path.join(version_dir, 'embeddings'), exist_ok=True)
+    if not os.path.isfile(embedder_path):
+        # a version never changes under the servers, whatever happens to the source file
+        shutil.copy2(args.embedder_path, embedder_path + '.tmp')
+        os.replace(embedder_path + '.tmp', embedder_path)
+    since = start_time(version_dir)
+    args.embedder_path = embedder_path
+    args.store_audio = False
+    for scope in scopes(args, served, version_dir):
+        if scope.tenant:
+            print("Tenant {}".format(scope.tenant))
+        enroll_speakers(scope, stored(scope.store), load_progress(scope.progress))
+    for _ in range(args.catch_up):
+        # tenants created meanwhile are picked up too
+        passes = [catch_up(scope, since) for scope in scopes(args, served, version_dir)]
+        since = min(start for start, _ in passes)
+        if sum(changes for _, changes in passes) == 0:
+            break
+    gallery = os.path.join(version_dir, 'embeddings')
+    if gallery_tag(gallery) is None:
+        tag_gallery(gallery, fingerprint, embedder_path)
+    if args.no_activate:
+        print("Gallery {} is ready, not activated.".format(gallery))
+        return
+
+    version = activate_version(fingerprint, embedder_path, gallery)
+    print("Activated version {}: {}".format(version.serial, version.gallery))
+    # until every process has switched, enrollments still go to the old gallery
+    time.sleep(args.settle)
+    for scope in scopes(args, served, version_dir):
+        catch_up(scope, since)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/default.yaml',
+                        help="yaml file for configuration")
+    parser.add_argument('-e', '--embedder_path', type=str, required=True,
+                        help="the new embedder checkpoint")
+    parser.add_argument('--store', type=str, default=enrollment_folder,
+                        help="enrollment audio, <speaker>/<channel>/<files>")
+    parser.add_argument('--galleries', type=str, default=os.path.join(cur_dir, 'galleries'),
+                        help="folder the versions are written to")
+    parser.add_argument('--from_s3', action='store_true',
+                        help="first fetch the enrollment audio that is only in the S3 bucket")
+    parser.add_argument('--allow_missing', action='store_true',
+                        help="build the version even if some enrolled speakers have no stored audio")
+    parser.add_argument('--no_activate', action='store_true',
+                        help="build the gallery but keep serving the current version")
+    parser.add_argument('--force', action='store_true',
+                        help="rebuild even if this embedder is already served")
+    parser.add_argument('--catch_up', type=int, default=3,
+                        help="catch-up passes before activation at most")
+    parser.add_argument('--settle', type=float, default=3 * VERSION_POLL,
+                        help="seconds the servers are given to switch before the last catch-up")
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help="decoding/mel processes")
+    parser.add_argument('--chunksize', type=int, default=8,
+                        help="files handed to a decoding process at once")
+    parser.add_argument('--batch_windows', type=int, default=2048,
+                        help="embedder windows per forward pass")
+    parser.add_argument('--commit_every', type=int, default=256,
+                        help="speakers written per gallery transaction")
+    main(parser.parse_args())
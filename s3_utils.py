@@ -1,18 +1,22 @@
 import os
 from dotenv import load_dotenv
-import boto3
-from botocore.exceptions import NoCredentialsError
-from boto.s3.connection import S3Connection
 
+# boto3/boto are imported on the first transfer, not when the servers start
 load_dotenv()
 ACCESS_KEY = os.environ.get('ACCESS_KEY')
 SECRET_KEY = os.environ.get('SECRET_KEY')
 BUCKET_NAME = 'speaker-id-api'
+# e.g. http://127.0.0.1:9000 for a local stand-in (loadtest.py --start_server)
+ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+# enrollment audio, <prefix>/<speaker>/<file> like the local enrollment store
+ENROLLMENT_PREFIX = 'enrollments'
 
 
 def upload_to_bucket(local_file, remote_file):
+    import boto3
+    from botocore.exceptions import NoCredentialsError
     s3 = boto3.client('s3', aws_access_key_id=ACCESS_KEY,
-                      aws_secret_access_key=SECRET_KEY)
+                      aws_secret_access_key=SECRET_KEY, endpoint_url=ENDPOINT_URL)
     try:
         s3.upload_file(local_file, BUCKET_NAME, remote_file)
         return True
@@ -23,27 +27,30 @@ def upload_to_bucket(local_file, remote_file):
 
 
 def delete_from_bucket(remote_file):
+    from boto.s3.connection import S3Connection
     conn = S3Connection(ACCESS_KEY, SECRET_KEY, host='s3.us-west-2.amazonaws.com')
     bucket = conn.get_bucket(BUCKET_NAME)
     bucket.delete_key(remote_file)
 
 
 def download_from_bucket(remote_file, local_file):
+    import boto3
     s3 = boto3.client('s3', aws_access_key_id=ACCESS_KEY,
-                      aws_secret_access_key=SECRET_KEY)
+                      aws_secret_access_key=SECRET_KEY, endpoint_url=ENDPOINT_URL)
     s3.download_file(BUCKET_NAME, 'audio/{}'.format(remote_file),
                      local_file)
 
 
-def download_s3_folder(bucket_name, s3_folder, local_dir=None):
+def download_s3_folder(bucket_name, s3_folder, local_dir=None, overwrite=True):
+    import boto3
     s3 = boto3.resource('s3', aws_access_key_id=ACCESS_KEY,
-                        aws_secret_access_key=SECRET_KEY)
+                        aws_secret_access_key=SECRET_KEY, endpoint_url=ENDPOINT_URL)
     bucket = s3.Bucket(bucket_name)
     for obj in bucket.objects.filter(Prefix=s3_folder):
         target = obj.key if local_dir is None \
             else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
         if not os.path.exists(os.path.dirname(target)):
             os.makedirs(os.path.dirname(target))
-        if obj.key[-1] == '/':
+        if obj.key[-1] == '/' or (not overwrite and os.path.exists(target)):
             continue
         bucket.download_file(obj.key, target)
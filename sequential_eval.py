@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Offline harness for sequential (early-exit) verification.
+
+Enrolls every speaker of --enroll_path, then runs each file of --test_path against its
+own speaker (genuine trial) and --impostors other speakers (impostor trials), both with
+the full-length decision and with SequentialVerifier, and reports the average audio
+consumed against the error rates of both.
+"""
+import argparse
+import json
+import random
+import numpy as np
+import torch
+import torch.nn.functional as F
+from voice_authentication import load_model, load_wav, get_embeddings_batch, min_samples
+from voice_service import THRESHOLD, SEQ_MIN_DURATION, SEQ_MAX_DURATION, SEQ_Z
+from utils.speakers import speaker_files
+from utils.stream import WindowEmbeddingStream, SequentialVerifier
+
+
+def enroll_gallery(spk_paths, audio, embedder):
+    names = sorted(spk_paths)
+    dvecs = []
+    for spk in names:
+        wavs = [load_wav(path) for path in spk_paths[spk]]
+        dvecs.append(get_embeddings_batch(wavs, audio, embedder).mean(0))
+    return names, F.normalize(torch.stack(dvecs, dim=0), p=2, dim=1)
+
+
+def window_trace(wav, hp, audio, embedder):
+    """Pushes a clip in window-step chunks, returns [(duration, new_windows), ...]."""
+    stream = WindowEmbeddingStream(hp, audio, embedder)
+    step = hp.embedder.stride * hp.audio.hop_length
+    trace = []
+    for start in range(0, len(wav), step):
+        windows = stream.push(wav[start:start + step])
+        trace.append((stream.duration, windows))
+    return trace
+
+
+def run_sequential(hp, template, trace, args):
+    verifier = SequentialVerifier(hp, template, threshold=args.threshold, min_duration=args.min_duration,
+                                  max_duration=args.max_duration, z=args.z)
+    for duration, windows in trace:
+        if verifier.update(windows, duration) is not None:
+            break
+    return verifier.finish(), verifier.duration
+
+
+def error_rates(trials, key):
+    genuine = [t for t in trials if t['genuine']]
+    impostor = [t for t in trials if not t['genuine']]
+    frr = sum(not t[key] for t in genuine) / max(1, len(genuine))
+    far = sum(t[key] for t in impostor) / max(1, len(impostor))
+    errors = sum(t[key] != t['genuine'] for t in trials) / max(1, len(trials))
+    return {'far': far, 'frr': frr, 'error_rate': errors}
+
+
+def main(args):
+    hp, audio, embedder = load_model(args.config, args.embedder_path)
+    names, matrix = enroll_gallery(speaker_files(args.enroll_path), audio, embedder)
+    rng = random.Random(args.seed)
+
+    trials = []
+    for spk, paths in speaker_files(args.test_path).items():
+        for path in paths:
+            wav = load_wav(path)
+            if len(wav) < min_samples(hp):
+                continue
+            full_score = torch.mv(matrix, F.normalize(get_embeddings_batch([wav], audio, embedder), dim=1)[0])
+            trace = window_trace(wav, hp, audio, embedder)
+            others = [x for x in names if x != spk]
+            claims = ([spk] if spk in names else []) + rng.sample(others, min(args.impostors, len(others)))
+            for claim in claims:
+                i = names.index(claim)
+                decision, consumed = run_sequential(hp, matrix[i], trace, args)
+                trials.append({
+                    'genuine': claim == spk,
+                    'full': full_score[i].item() >= args.threshold,
+                    'sequential': decision == 'Accepted',
+                    'consumed': consumed,
+                    'length': len(wav) / hp.audio.sample_rate,
+                })
+
+    consumed = np.array([t['consumed'] for t in trials])
+    length = np.array([t['length'] for t in trials])
+    report = {
+        'trials': len(trials),
+        'genuine_trials': sum(t['genuine'] for t in trials),
+        'threshold': args.threshold,
+        'min_duration': args.min_duration,
+        'max_duration': args.max_duration,
+        'z': args.z,
+        'full': error_rates(trials, 'full'),
+        'sequential': error_rates(trials, 'sequential'),
+        'disagreement': sum(t['full'] != t['sequential'] for t in trials) / max(1, len(trials)),
+        'avg_audio_full': float(length.mean()) if len(trials) else 0.0,
+        'avg_audio_sequential': float(consumed.mean()) if len(trials) else 0.0,
+        'avg_audio_fraction': float((consumed / length).mean()) if len(trials) else 0.0,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='config/default.yaml')
+    parser.add_argument('--embedder_path', type=str, default='embedder.pt')
+    parser.add_argument('--enroll_path', type=str, required=True,
+                        help='folder per speaker with the enrollment audio')
+    parser.add_argument('--test_path', type=str, required=True,
+                        help='folder per speaker with the test audio')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--min_duration', type=float, default=SEQ_MIN_DURATION)
+    parser.add_argument('--max_duration', type=float, default=SEQ_MAX_DURATION)
+    parser.add_argument('--z', type=float, default=SEQ_Z)
+    parser.add_argument('--impostors', type=int, default=5,
+                        help='impostor claims per test file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the report as JSON')
+    main(parser.parse_args())
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Startup time of a cold serving process, phase by phase, with the heavy modules each
+phase imported:
+
+    python3 startup_report.py
+    python3 startup_report.py --json startup.json
+
+Runs what a gunicorn worker does before its first request: import the app, parse the
+hparams, map the embedder weights, build the mel front-end, map the gallery, and embeds
+one second of audio.
+"""
+import json
+import argparse
+from utils import startup
+
+
+def main(args):
+    with startup.phase('import main'):
+        import main # noqa: F401, the app module gunicorn preloads
+    from voice_authentication import load_model, load_gallery, get_embeddings_batch
+    hp, audio, embedder = load_model()
+    with startup.phase('gallery'):
+        load_gallery()
+    with startup.phase('first embedding'):
+        import numpy as np
+        get_embeddings_batch([np.zeros(hp.audio.sample_rate, dtype=np.float32)], audio, embedder)
+    print(startup.report())
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'hparams_fingerprint': hp.fingerprint, 'phases': startup.phases()}, fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', type=str, default=None, help="write the phases as JSON")
+    main(parser.parse_args())
@@ -20,6 +20,13 @@ var socket;
 //vars
 let streamStreaming = false;
 
+// compressed transport: MediaRecorder output is sent as binary messages and decoded by the
+// server, about 24 kbit/s instead of the JSON int16 chunks. Falls back to PCM if unsupported.
+const OPUS_TYPES = ['audio/webm;codecs=opus', 'audio/ogg;codecs=opus'];
+const OPUS_BITRATE = 24000;
+const OPUS_TIMESLICE = 100; // ms of audio per binary message
+var recorder = null;
+
 function btn_show_stop() {
     start_btn.disabled = true;
     stop_btn.disabled = false;
@@ -115,12 +122,72 @@ socket.onmessage = function(evt) {
         $("#msg_txt").val(msg.message);
     } else if (msg.task == "enroll") {
         $("#msg_txt").val(msg.message);
+    } else if (msg.task == "identify" && msg.partial) {
+        // partial results replace each other until the final decision arrives
+        var lines = [msg.message + ' (' + msg.duration.toFixed(1) + 's)'];
+        for (const cand of msg.top_k || []) {
+            lines.push(cand.spk_name + ': ' + cand.confidence.toFixed(3));
+        }
+        $("#msg_txt").val(lines.join('\r\n'));
     } else if (msg.task == "verify" || msg.task == "identify") {
         $("#msg_txt").val($("#msg_txt").val() + '\r\n' + msg.message);
         //$("#msg_txt").value += msg.message + '\r\n';
     }
 };
 
+// the "identify_continuous" option is the identify task in continuous mode
+function selected_command() {
+    var task = document.getElementById('enrollment').value;
+    if (task == "identify_continuous") {
+        return {'task': 'identify', 'mode': 'continuous'};
+    }
+    return {'task': task};
+}
+
+function opus_mime_type() {
+    if (document.getElementById('transport').value != 'opus' || !window.MediaRecorder
+        || !MediaRecorder.isTypeSupported) {
+        return null;
+    }
+    for (const type of OPUS_TYPES) {
+        if (MediaRecorder.isTypeSupported(type)) {
+            return type;
+        }
+    }
+    return null;
+}
+
+function start_opus(mimeType) {
+    var ws_command = selected_command();
+    var task = ws_command['task'];
+    var spkname = document.getElementById('spkname').value;
+    if (spkname == "" && (task == "verify" || task == "enroll")) {
+        alert("Please input speaker name to be enrolled or verified.");
+        btn_show_start();
+        return;
+    }
+
+    navigator.mediaDevices.getUserMedia({audio: true, video: false}).then(function (stream) {
+        globalStream = stream;
+        recorder = new MediaRecorder(stream, {mimeType: mimeType, audioBitsPerSecond: OPUS_BITRATE});
+        // announces the recording, the audio follows as binary messages
+        ws_command['record'] = 'start';
+        ws_command['spk_name'] = spkname;
+        ws_command['codec'] = mimeType;
+        ws_command['data'] = [];
+        socket.send(JSON.stringify(ws_command));
+        recorder.ondataavailable = function (e) {
+            if (e.data.size > 0) {
+                socket.send(e.data);
+            }
+        };
+        recorder.start(OPUS_TIMESLICE);
+    }, function (err) {
+        console.log('Could not acquire media: ' + err);
+        btn_show_start();
+    });
+}
+
 function start() {
     if (navigator.mediaDevices) {
         console.log('getUserMedia supported.');
@@ -128,6 +195,12 @@ function start() {
         if (bConnected) {
             btn_show_stop();
 
+            var mimeType = opus_mime_type();
+            if (mimeType) {
+                start_opus(mimeType);
+                return;
+            }
+
             var constraints = {
                 audio: true,
                 video: false,
@@ -149,17 +222,15 @@ function start() {
                 var left = e.inputBuffer.getChannelData(0);
                 // var left16 = convertFloat32ToInt16(left); // old 32 to 16 function
                 var left16 = downsampleBuffer(left, 44100, 16000)
-                var task = document.getElementById('enrollment').value;
+                var ws_command = selected_command();
+                var task = ws_command['task'];
                 var spkname = document.getElementById('spkname').value;
                 if (spkname == "" && (task == "verify" || task == "enroll")) {
                     console.log("Please input speaker name to be enrolled or verified.");
                 } else {
-                    var ws_command = {
-                        'task': task,
-                        'record': 'start',
-                        'spk_name': spkname,
-                        'data': left16
-                    };
+                    ws_command['record'] = 'start';
+                    ws_command['spk_name'] = spkname;
+                    ws_command['data'] = left16;
                     socket.send(JSON.stringify(ws_command), json=true);
                 }
             }
@@ -188,6 +259,24 @@ function start() {
 function stop() {
 
     streamStreaming = false;
+    if (recorder) {
+        // the last chunk is delivered before 'stop' fires, the stop message must follow it
+        var active = recorder.state != 'inactive';
+        recorder.onstop = send_stop;
+        if (active) {
+            recorder.stop();
+        }
+        recorder = null;
+        if (globalStream) {
+            globalStream.getTracks()[0].stop();
+        }
+        btn_show_start();
+        if (!active) {
+            send_stop();
+        }
+        return;
+    }
+
     if (globalStream) {
         let track = globalStream.getTracks()[0];
         track.stop();
@@ -209,15 +298,15 @@ function stop() {
     }
 
     btn_show_start();
+    send_stop();
+}
 
-    var task = document.getElementById('enrollment').value;
-    var speaker_name = document.getElementById('spkname').value;
-    var ws_command = {
-        'task': task,
-        'record': 'stop',
-        'spk_name': speaker_name,
-        'data': []
-    };
+function send_stop() {
+    var ws_command = selected_command();
+    var task = ws_command['task'];
+    ws_command['record'] = 'stop';
+    ws_command['spk_name'] = document.getElementById('spkname').value;
+    ws_command['data'] = [];
     socket.send(JSON.stringify(ws_command), json=true);
 
     if (task == "enroll")
@@ -6,97 +6,330 @@ import websockets
 import pathlib
 import ssl
 import json
+import time
+import base64
 import datetime
-from voice_authentication import stream2wavfile_int16
-from voice_service import voice_database, remove_voice, enroll_voice, auth_voice
-from s3_utils import upload_to_bucket
+from contextlib import ExitStack
+from http import HTTPStatus
+import numpy as np
+from voice_authentication import stream2wavfile_int16, load_model, pcm2float, print_log, current_version, \
+    watch_version, speaker_name, SAMPLE_RATE
+from voice_service import voice_database, remove_voice, enroll_voice, auth_voice, identify_stream, \
+    sequential_verifier, sequential_result, speech_vad, VAD_ENABLED, DEFAULT_CHANNEL, tenant_path
+from s3_utils import upload_to_bucket, ENROLLMENT_PREFIX
+from utils.stream import WindowEmbeddingStream
+from utils.codec import StreamDecoder
+from utils import metrics, profiling, startup
+from utils.metrics import timed
 
 USERS = {}
-MAX_CONNECTION = 5
+MAX_CONNECTION = int(os.environ.get('MAX_CONNECTION', 5))
+WS_PORT = int(os.environ.get('WS_PORT', 5555))
+WS_SSL = os.environ.get('WS_SSL', '1') != '0'
+# when set, every incoming message is appended to <dir>/<session>.jsonl for loadtest.py --replay
+SESSION_RECORD_DIR = os.environ.get('SESSION_RECORD_DIR')
 MAX_ERROR_MESSAGE = 'The number of connected clients has reached the maximum. Please try again later.'
 
+# continuous identification defaults, each can be overridden per message
+STREAM_MIN_SPEECH = 1.0  # seconds buffered before the first partial result
+STREAM_INTERVAL = 0.5  # seconds of audio between partial results
+STREAM_WINDOW = 3.0  # sliding window the partial results are pooled over
+STREAM_TOP_K = 3
+
+# one-shot enroll/verify/identify recordings are decided after this much compressed audio (seconds)
+RECORD_SECONDS = 7.0
+
+
+def client_key(websocket):
+    # one session per connection, so several clients behind one address do not collide
+    return '{}:{}'.format(*websocket.remote_address[:2])
+
+
+def open_recording(websocket):
+    if not SESSION_RECORD_DIR:
+        return None
+    os.makedirs(SESSION_RECORD_DIR, exist_ok=True)
+    name = '{}_{}.jsonl'.format(datetime.datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S-%f'),
+                                client_key(websocket).replace(':', '_'))
+    return {'fp': open(os.path.join(SESSION_RECORD_DIR, name), 'w'), 'start': time.perf_counter()}
+
+
+def record_message(recording, message):
+    if recording is None:
+        return
+    entry = {'t': round(time.perf_counter() - recording['start'], 4)}
+    if isinstance(message, str):
+        entry['message'] = message
+    else:
+        entry['binary'] = base64.b64encode(message).decode('ascii')
+    recording['fp'].write(json.dumps(entry) + '\n')
+
+
+def invalid_name(ws_command):
+    """
+    The answer to an enroll, verify or remove_voice message whose spk_name cannot name a
+    speaker, the websocket counterpart of the HTTP 400. None if the message is fine.
+    """
+    if ws_command['task'] not in ('enroll', 'verify', 'remove_voice'):
+        return None
+    try:
+        speaker_name(ws_command.get('spk_name'))
+    except ValueError as error:
+        return json.dumps({
+            'status': 'false',
+            'task': ws_command['task'],
+            'code': HTTPStatus.BAD_REQUEST.value,
+            'message': repr(error)
+        }, indent=2)
+    return None
+
 
 async def notify_response(websocket, result):
     """
     result: string (json dumped)
     """
-    client_ip = websocket.remote_address[0]
-    if USERS and client_ip in USERS:  # asyncio.wait doesn't accept an empty list
-        await asyncio.wait([USERS[user]['ws'].send(result) for user in USERS if client_ip == user])
+    client_id = client_key(websocket)
+    if USERS and client_id in USERS:  # asyncio.wait doesn't accept an empty list
+        await asyncio.wait([USERS[user]['ws'].send(result) for user in USERS if client_id == user])
 
 
 async def register(websocket):
-    client_ip = websocket.remote_address[0]
-    if client_ip in USERS:
-        print('Reconnection: {}'.format(client_ip))
-        del USERS[client_ip]
+    client_id = client_key(websocket)
+    if client_id in USERS:
+        print_log('Reconnection: {}'.format(client_id))
+        abort_decoder(USERS[client_id])
+        del USERS[client_id]
 
     if len(USERS) >= MAX_CONNECTION:
-        print(client_ip, MAX_ERROR_MESSAGE)
+        print_log('{} {}'.format(client_id, MAX_ERROR_MESSAGE))
         await notify_response(websocket,
                               json.dumps({
                                   'task': 'alert',
                                   'message': MAX_ERROR_MESSAGE
                               }))
     else:
-        USERS[client_ip] = {
+        USERS[client_id] = {
             'ws': websocket,
             'rec_count': 0,
             'spk_name': '',
             'rec_data': [],
+            'stream': None,
+            'next_update': 0.0,
+            'verifier': None,
+            'vad': None,
+            'version': None,
+            'decoder': None,
+            'command': None,
         }
-        print('New connection from {}'.format(client_ip))
+        print_log('New connection from {}'.format(client_id))
+    metrics.SESSIONS.set(len(USERS))
 
 
 def refresh_buffer(websocket):
-    client_ip = websocket.remote_address[0]
-    if client_ip in USERS:
-        USERS[client_ip]['rec_count'] = 0
-        USERS[client_ip]['rec_data'] = []
+    client_id = client_key(websocket)
+    if client_id in USERS:
+        USERS[client_id]['rec_count'] = 0
+        USERS[client_id]['rec_data'] = []
+        USERS[client_id]['stream'] = None
+        USERS[client_id]['next_update'] = 0.0
+        USERS[client_id]['verifier'] = None
+        USERS[client_id]['vad'] = None
+        USERS[client_id]['version'] = None
 
 
 def set_speaker_name(websocket, speaker_name):
-    client_ip = websocket.remote_address[0]
-    if client_ip in USERS and speaker_name != '':
-        USERS[client_ip]['spk_name'] = speaker_name
+    client_id = client_key(websocket)
+    if client_id in USERS and speaker_name != '':
+        USERS[client_id]['spk_name'] = speaker_name
     else:
-        USERS[client_ip] = {
+        USERS[client_id] = {
             'ws': websocket,
             'rec_count': 0,
             'spk_name': speaker_name,
             'rec_data': [],
+            'stream': None,
+            'next_update': 0.0,
+            'verifier': None,
+            'vad': None,
+            'version': None,
+            'decoder': None,
+            'command': None,
         }
 
 
+def start_stream(user):
+    # a session keeps the embedder it started with, and the gallery that matches it
+    user['version'] = current_version()
+    hp, audio, embedder = load_model(embedder_path=user['version'].embedder)
+    user['stream'] = WindowEmbeddingStream(hp, audio, embedder)
+    user['vad'] = speech_vad() if VAD_ENABLED else None
+
+
+def speech_chunk(user, audio_buf):
+    """
+    Gates a live int16 chunk through the session's VAD, returns float32 speech samples.
+    """
+    pcm = np.asarray(audio_buf, dtype=np.int16)
+    if user['vad'] is not None:
+        pcm = user['vad'].gate(pcm)
+    return pcm2float(pcm, dtype='float32')
+
+
+def open_decoder(user, ws_command):
+    """
+    Starts a compressed recording: the JSON 'start' carrying 'codec' (the MediaRecorder
+    mime type) only announces it, the audio follows as binary messages until 'stop'.
+    """
+    abort_decoder(user)
+    user['decoder'] = StreamDecoder(ws_command['codec'], SAMPLE_RATE)
+    user['command'] = ws_command
+
+
+async def decode_chunk(user, data):
+    """Decodes a binary message of the session's compressed recording, returns int16 samples."""
+    decoder = user['decoder']
+    metrics.STREAM_BYTES.labels('opus').inc(len(data))
+    try:
+        with timed('opus_decode'):
+            pcm = await asyncio.get_event_loop().run_in_executor(None, decoder.push, data)
+    except ValueError:
+        abort_decoder(user)
+        raise
+    metrics.STREAM_AUDIO_SECONDS.labels('opus').inc(len(pcm) / SAMPLE_RATE)
+    return pcm.tolist()
+
+
+async def close_decoder(user):
+    """Ends the session's compressed recording, returns its last int16 samples."""
+    decoder, user['decoder'], user['command'] = user['decoder'], None, None
+    with timed('opus_decode'):
+        pcm = await asyncio.get_event_loop().run_in_executor(None, decoder.close)
+    metrics.STREAM_AUDIO_SECONDS.labels('opus').inc(len(pcm) / SAMPLE_RATE)
+    if decoder.duration > 0:
+        # ffmpeg CPU time per second of audio, the server-side price of the compressed transport
+        metrics.REAL_TIME_FACTOR.labels('opus_decode').observe(decoder.cpu_seconds / decoder.duration)
+    return pcm.tolist()
+
+
+def abort_decoder(user):
+    if user.get('decoder') is not None:
+        user['decoder'].abort()
+    user['decoder'], user['command'] = None, None
+
+
+def is_continuous(ws_command):
+    return ws_command['task'] == 'identify' and ws_command.get('mode') == 'continuous'
+
+
+async def stream_identify(websocket, ws_command, audio_buf):
+    """
+    Feeds a chunk of a continuous identification session into its window
+    embedding stream and pushes a partial top-k result at the requested cadence.
+    """
+    user = USERS[client_key(websocket)]
+    if user['stream'] is None:
+        start_stream(user)
+        user['next_update'] = float(ws_command.get('min_speech', STREAM_MIN_SPEECH))
+    stream = user['stream']
+
+    wav = speech_chunk(user, audio_buf)
+    await asyncio.get_event_loop().run_in_executor(None, profiling.in_span(stream.push), wav)
+
+    if stream.duration < user['next_update'] or stream.num_windows == 0:
+        return
+    user['next_update'] = stream.duration + float(ws_command.get('interval', STREAM_INTERVAL))
+    res = profiling.in_span(identify_stream)(stream,
+                                             top_k=int(ws_command.get('top_k', STREAM_TOP_K)),
+                                             window=float(ws_command.get('window', STREAM_WINDOW)),
+                                             vad=user['vad'], version=user['version'],
+                                             tenant=ws_command.get('tenant'))
+    await notify_response(websocket, res)
+
+
+def is_sequential(ws_command):
+    return ws_command['task'] == 'verify' and ws_command.get('mode') == 'sequential'
+
+
+async def stream_verify(websocket, ws_command, audio_buf):
+    """
+    Feeds a chunk of a sequential verification session into its window embedding
+    stream and answers as soon as the verifier reaches a decision.
+    """
+    user = USERS[client_key(websocket)]
+    spk_name = ws_command['spk_name']
+    if user['stream'] is None:
+        start_stream(user)
+        user['verifier'] = sequential_verifier(spk_name, version=user['version'], tenant=ws_command.get('tenant'))
+        if user['verifier'] is None:
+            await notify_response(websocket, sequential_result(None, spk_name))
+    stream, verifier = user['stream'], user['verifier']
+    if verifier is None or verifier.decision is not None:
+        return  # already answered, the rest of the recording is ignored
+
+    wav = speech_chunk(user, audio_buf)
+    windows = await asyncio.get_event_loop().run_in_executor(None, profiling.in_span(stream.push), wav)
+    if verifier.update(windows, stream.duration) is not None:
+        await notify_response(websocket, sequential_result(verifier, spk_name, user['vad']))
+
+
 async def unregister(websocket):
     try:
-        client_ip = websocket.remote_address[0]
-        if client_ip in USERS:
-            del USERS[client_ip]
-            print('Closed connection {}'.format(client_ip))
+        client_id = client_key(websocket)
+        if client_id in USERS:
+            abort_decoder(USERS[client_id])
+            del USERS[client_id]
+            print_log('Closed connection {}'.format(client_id))
+        metrics.SESSIONS.set(len(USERS))
     except Exception as error:
-        print('Unregister error: {}'.format(repr(error)))
+        metrics.ERRORS.labels('ws_unregister').inc()
+        print_log('Unregister error: {}'.format(repr(error)))
+
+
+def metrics_request(path, request_headers):
+    # plain HTTP GET /metrics on the websocket port, anything else is a websocket handshake
+    if path == '/metrics':
+        body, content_type = metrics.render()
+        return HTTPStatus.OK, [('Content-Type', content_type)], body
+    return None
 
 
 async def ws_server(websocket, path):
     # register(websocket) sends user_event() to websocket
     await register(websocket)
+    recording = open_recording(websocket)
 
     try:
         async for message in websocket:
-            client_ip = websocket.remote_address[0]
-            if client_ip not in USERS:
+            record_message(recording, message)
+            client_id = client_key(websocket)
+            if client_id not in USERS:
                 await notify_response(websocket,
                                       json.dumps({
                                           'task': 'alert',
                                           'message': MAX_ERROR_MESSAGE
                                       }))
             else:
-
+                start = time.perf_counter()
+                task = 'unknown'
+                span = ExitStack()
+                metrics.QUEUE_DEPTH.labels('ws').inc()
                 try:
-                    if isinstance(message, str):
+                    if isinstance(message, str) or USERS[client_id]['decoder'] is not None:
                         try:
-                            ws_command = json.loads(message)
+                            if isinstance(message, str):
+                                with timed('decode'):
+                                    ws_command = json.loads(message)
+                                audio_buf = None
+                            else:
+                                # compressed audio of the recording announced by the last 'start'
+                                ws_command = USERS[client_id]['command']
+                                audio_buf = await decode_chunk(USERS[client_id], message)
+                                if not audio_buf:
+                                    continue  # not decoded yet, comes out with the next chunk
+                            # other sessions run on this thread between awaits, so only the
+                            # model calls are traced, each through profiling.in_span
+                            span.enter_context(profiling.request_span(
+                                ws_command.get('request_id') or profiling.new_request_id(), trace=False))
                             """
                             'message' should be JSON like following:
                                 {
@@ -108,44 +341,84 @@ async def ws_server(websocket, path):
                             now = datetime.datetime.utcnow()
                             task = ws_command['task']
 
+                            tenant = ws_command.get('tenant')
+                            invalid = invalid_name(ws_command)
+                            if invalid is not None:
+                                await notify_response(websocket, invalid)
+                                continue
                             if task == 'get_voice_list':
-                                voice_list = voice_database()
+                                voice_list = voice_database(tenant)
                                 await notify_response(websocket, voice_list)
-                                print('Get voice list:\n{}'.format(voice_list))
+                                print_log('Get voice list:\n{}'.format(voice_list))
                                 continue
                             elif task == 'remove_voice':
                                 spk_name = ws_command['spk_name']
-                                result = remove_voice(spk_name)
+                                result = remove_voice(spk_name, tenant)
                                 await notify_response(websocket, result)
-                                print('Remove voice:\n{}'.format(result))
+                                print_log('Remove voice:\n{}'.format(result))
                                 continue
 
                             if task not in ['enroll', 'verify', 'identify']:
-                                print('task invalid.')
+                                print_log('task invalid.')
                                 continue
                             record_status = ws_command['record']
                             if record_status == 'start':
-                                audio_buf = list(ws_command['data'].values())
-                                USERS[client_ip]['rec_data'].extend(audio_buf)
-                                USERS[client_ip]['rec_count'] += 1
-                                if USERS[client_ip]['rec_count'] < 15 * 7:  # length is less than 7 seconds
+                                if audio_buf is None and ws_command.get('codec'):
+                                    open_decoder(USERS[client_id], ws_command)
+                                    continue
+                                compressed = audio_buf is not None
+                                if not compressed:
+                                    audio_buf = list(ws_command['data'].values())
+                                    metrics.STREAM_BYTES.labels('pcm').inc(len(message))
+                                    metrics.STREAM_AUDIO_SECONDS.labels('pcm').inc(len(audio_buf) / SAMPLE_RATE)
+                                USERS[client_id]['rec_data'].extend(audio_buf)
+                                USERS[client_id]['rec_count'] += 1
+                                if is_continuous(ws_command):  # results pushed until 'stop'
+                                    await stream_identify(websocket, ws_command, audio_buf)
                                     continue
+                                if is_sequential(ws_command):  # answered as soon as decisive
+                                    await stream_verify(websocket, ws_command, audio_buf)
+                                    continue
+                                if compressed:
+                                    if len(USERS[client_id]['rec_data']) < RECORD_SECONDS * SAMPLE_RATE:
+                                        continue
+                                elif USERS[client_id]['rec_count'] < 15 * 7:  # length is less than 7 seconds
+                                    continue
+                            elif USERS[client_id]['decoder'] is not None:
+                                # the audio ffmpeg still held when the recording stopped
+                                audio_buf = await close_decoder(USERS[client_id])
+                                USERS[client_id]['rec_data'].extend(audio_buf)
+                                if audio_buf and is_continuous(ws_command) and USERS[client_id]['stream'] is not None:
+                                    await stream_identify(websocket, ws_command, audio_buf)
+                                elif audio_buf and is_sequential(ws_command) and USERS[client_id]['stream'] is not None:
+                                    await stream_verify(websocket, ws_command, audio_buf)
 
                             spk_name = ws_command['spk_name']
                             # set_speaker_name(websocket, spk_name)
 
                             if task == 'enroll':
-                                tmp_audio_file = "./uploads/{}.wav".format(spk_name)
-                                remote_file = "{}_{}_{}.wav".format(task, spk_name,
-                                                                    now.strftime('%Y-%m-%d_%H-%M-%S'))
+                                tmp_audio_file = "./uploads/{}.wav".format(
+                                    '{}_{}'.format(tenant, spk_name) if tenant else spk_name)
+                                # mirrors the enrollment store, reembed.py --from_s3 reads it back
+                                channel = ws_command.get('channel') or DEFAULT_CHANNEL
+                                remote_file = "{}/{}/{}/enroll.wav".format(tenant_path(ENROLLMENT_PREFIX, tenant),
+                                                                            spk_name, channel)
                             else:
-                                tmp_audio_file = "./uploads/{}.wav".format(now.strftime('%Y-%m-%d_%H-%M-%S'))
+                                # per connection, concurrent sessions must not share the file
+                                tmp_audio_file = "./uploads/{}_{}.wav".format(now.strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                              client_id.replace(':', '_'))
                                 remote_file = "{}_{}.wav".format(task, now.strftime('%Y-%m-%d_%H-%M-%S'))
 
-                            audio_buf = USERS[client_ip]['rec_data']
+                            audio_buf = USERS[client_id]['rec_data']
+                            stream = USERS[client_id]['stream']
+                            verifier = USERS[client_id]['verifier']
+                            vad = USERS[client_id]['vad']
+                            version = USERS[client_id]['version']
                             refresh_buffer(websocket)
 
-                            if not stream2wavfile_int16(audio_buf, tmp_audio_file):
+                            with timed('wav_write'):
+                                written = stream2wavfile_int16(audio_buf, tmp_audio_file)
+                            if not written:
                                 result_json = {
                                     'status': 'false',
                                     'task': task,
@@ -155,17 +428,30 @@ async def ws_server(websocket, path):
                                 continue
 
                             # upload to s3 folder
-                            upload_to_bucket(tmp_audio_file, remote_file)
+                            with timed('s3_upload'):
+                                upload_to_bucket(tmp_audio_file, remote_file)
 
                             # TODO:
                             if task == 'enroll':
-                                res = enroll_voice(tmp_audio_file, spk_name)
+                                res = profiling.in_span(enroll_voice)(tmp_audio_file, spk_name, channel, tenant)
+                                await notify_response(websocket, res)
+                            elif is_continuous(ws_command) and stream is not None:
+                                # final decision over the whole session, from the windows already embedded
+                                res = profiling.in_span(identify_stream)(
+                                    stream, top_k=int(ws_command.get('top_k', STREAM_TOP_K)),
+                                    partial=False, vad=vad, version=version, tenant=tenant)
                                 await notify_response(websocket, res)
+                            elif is_sequential(ws_command) and stream is not None:
+                                # recording ended before a decisive point: decide on what was heard
+                                if verifier is not None and verifier.decision is None:
+                                    verifier.finish()
+                                    await notify_response(websocket, sequential_result(verifier, spk_name, vad))
                             else:
-                                res = auth_voice(tmp_audio_file, task, spk_name)
+                                res = profiling.in_span(auth_voice)(tmp_audio_file, task, spk_name, tenant)
                                 await notify_response(websocket, res)
 
                         except Exception as error:
+                            metrics.ERRORS.labels('ws_task').inc()
                             await notify_response(websocket,
                                                   json.dumps({
                                                       'status': 'false',
@@ -177,33 +463,46 @@ async def ws_server(websocket, path):
                         pass
 
                 except Exception as error:
+                    metrics.ERRORS.labels('ws_message').inc()
                     await notify_response(websocket,
                                           json.dumps({
                                               'status': 'false',
                                               'task': 'alert',
                                               'message': repr(error)
                                           }))
+                finally:
+                    span.close()
+                    metrics.QUEUE_DEPTH.labels('ws').dec()
+                    metrics.REQUEST_SECONDS.labels('ws', task).observe(time.perf_counter() - start)
 
     except websockets.ConnectionClosed as e:
-        print(e)
+        print_log(repr(e))
     except Exception as error:
-        print("WebSocket message error: {}".format(repr(error)))
+        metrics.ERRORS.labels('ws_connection').inc()
+        print_log("WebSocket message error: {}".format(repr(error)))
     finally:
+        if recording is not None:
+            recording['fp'].close()
         await unregister(websocket)
 
 
 if __name__ == '__main__':
-    ssl_option = True
-    if ssl_option:
+    profiling.watch()
+    # load before listening, so the first session does not pay for it
+    load_model()
+    watch_version()
+    print_log(startup.report())
+    if WS_SSL:
         # start Websockets server
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         certfile = pathlib.Path(__file__).with_name("fullchain1.pem")
         keyfile = pathlib.Path(__file__).with_name("privkey1.pem")
         ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile, password=None)
 
-        start_server = websockets.serve(ws_server, "0.0.0.0", 5555, ssl=ssl_context)
+        start_server = websockets.serve(ws_server, "0.0.0.0", WS_PORT, ssl=ssl_context,
+                                        process_request=metrics_request)
     else:
-        start_server = websockets.serve(ws_server, "0.0.0.0", 5555)
+        start_server = websockets.serve(ws_server, "0.0.0.0", WS_PORT, process_request=metrics_request)
 
     asyncio.get_event_loop().run_until_complete(start_server)
     asyncio.get_event_loop().run_forever()
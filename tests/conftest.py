@@ -0,0 +1,51 @@
+import os
+import sys
+import wave
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLE_RATE = 16000
+
+
+def voiced_pcm(seconds, sample_rate=SAMPLE_RATE, f0=140.0):
+    """int16 vowel-like signal: a harmonic source with a syllable-rate envelope."""
+    np = pytest.importorskip('numpy')
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    source = sum(np.sin(2 * np.pi * k * f0 * t) / k for k in range(1, 20))
+    envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4.0 * t)
+    wav = 0.5 * source / np.abs(source).max() * envelope
+    return (wav * 32767).astype(np.int16)
+
+
+def silence_pcm(seconds, sample_rate=SAMPLE_RATE):
+    np = pytest.importorskip('numpy')
+    return np.zeros(int(seconds * sample_rate), dtype=np.int16)
+
+
+def write_wav(path, pcm, sample_rate=SAMPLE_RATE):
+    with wave.open(str(path), 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(pcm.tobytes())
+    return str(path)
+
+
+@pytest.fixture
+def served_version(tmp_path, monkeypatch):
+    """A randomly initialised embedder and an empty gallery served in place of the deployed ones."""
+    for module in ('numpy', 'torch', 'yaml', 'librosa', 'webrtcvad', 'prometheus_client'):
+        pytest.importorskip(module)
+    import torch
+    import voice_authentication
+    from utils.hparams import cached_hparam
+    from model.embedder import SpeechEmbedder
+    torch.manual_seed(0)
+    embedder_path = str(tmp_path / 'embedder.pt')
+    torch.save(SpeechEmbedder(cached_hparam(voice_authentication.conf_path)).state_dict(), embedder_path)
+    version = voice_authentication.Version(0, None, embedder_path, str(tmp_path / 'embeddings'))
+    monkeypatch.setattr(voice_authentication, '_version', version)
+    monkeypatch.setattr(voice_authentication, 'enrollment_folder', str(tmp_path / 'enrollments'))
+    return version
@@ -0,0 +1,23 @@
+import json
+import argparse
+import pytest
+from conftest import ROOT
+
+for module in ('numpy', 'torch', 'scipy', 'librosa', 'yaml', 'webrtcvad', 'prometheus_client'):
+    pytest.importorskip(module)
+
+
+def test_every_case_runs(tmp_path, monkeypatch):
+    from benchmarks import run
+    monkeypatch.chdir(ROOT)
+    baseline = str(tmp_path / 'baseline.json')
+    args = argparse.Namespace(filter=None, threads=1, min_time=0.0, min_iters=1, max_iters=1,
+                              save=baseline, compare=None, tolerance=0.2, output=None)
+    run.main(args)
+    with open(baseline) as fp:
+        results = json.load(fp)['results']
+    assert 'vad_audio_segment[5s]' in results
+    assert not [key for key, result in results.items() if 'error' in result]
+
+    args.save, args.compare, args.tolerance = None, baseline, 1e9
+    run.main(args)
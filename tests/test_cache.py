@@ -0,0 +1,13 @@
+import pytest
+from conftest import voiced_pcm
+
+pytest.importorskip('torch')
+pytest.importorskip('prometheus_client')
+
+
+def test_decision_key_keeps_the_claimed_name():
+    from voice_service import decision_key
+    wav = voiced_pcm(1.0)
+    for task in ('identify', 'verify'):
+        assert decision_key(wav, task, 'alice') != decision_key(wav, task, 'bob')
+        assert decision_key(wav, task, 'alice') == decision_key(wav.copy(), task, 'alice')
@@ -0,0 +1,27 @@
+import os
+import socket
+import pytest
+
+torch = pytest.importorskip('torch')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def flag_on_rank_one(rank, port, results):
+    import torch.distributed as dist
+    from utils.distributed import any_rank
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    dist.init_process_group('gloo', init_method='env://', rank=rank, world_size=2)
+    results[rank] = (any_rank(rank == 1), any_rank(False))
+    dist.destroy_process_group()
+
+
+def test_any_rank_reaches_every_process():
+    import torch.multiprocessing as mp
+    results = mp.Manager().dict()
+    mp.spawn(flag_on_rank_one, args=(free_port(), results), nprocs=2)
+    assert dict(results) == {0: (True, False), 1: (True, False)}
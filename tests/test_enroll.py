@@ -0,0 +1,104 @@
+import os
+import argparse
+import pytest
+from conftest import voiced_pcm, silence_pcm, write_wav
+
+pytest.importorskip('torch')
+
+
+def enroll_args(version, tmp_path):
+    import voice_authentication
+    return argparse.Namespace(config=voice_authentication.conf_path, embedder_path=version.embedder,
+                              embeddings_path=version.gallery, tenant=None, store_audio=True,
+                              progress=str(tmp_path / 'progress.txt'), num_workers=1, chunksize=1,
+                              batch_windows=2048, commit_every=256)
+
+
+def test_enroll_one_wav(served_version, tmp_path):
+    from enroll import enroll_speakers
+    import voice_authentication
+    path = write_wav(tmp_path / 'alice.wav', voiced_pcm(3.0))
+    enroll_speakers(enroll_args(served_version, tmp_path), {'alice': {'default': [path]}})
+
+    assert os.path.isfile(os.path.join(served_version.gallery, 'alice.pth'))
+    assert voice_authentication.enrolled_channels('alice', served_version.gallery) == ['default']
+    assert os.listdir(os.path.join(voice_authentication.enrollment_folder, 'alice', 'default')) == ['0000_alice.wav']
+    with open(tmp_path / 'progress.txt') as fp:
+        assert fp.read() == 'alice\n'
+
+
+def test_enroll_aborts_when_nothing_is_usable(served_version, tmp_path):
+    from enroll import enroll_speakers
+    path = write_wav(tmp_path / 'quiet.wav', silence_pcm(3.0))
+    broken = tmp_path / 'broken.wav'
+    broken.write_bytes(b'not a wav')
+    with pytest.raises(SystemExit):
+        enroll_speakers(enroll_args(served_version, tmp_path), {'bob': {'default': [path, str(broken)]}})
+    assert not os.path.exists(os.path.join(served_version.gallery, 'bob.pth'))
+
+
+def test_failure_guard():
+    from enroll import FailureGuard, TOO_SHORT
+    guard = FailureGuard(limit=3)
+    guard.check('a', "Error('Error while processing frame')")
+    guard.check('b', TOO_SHORT)
+    guard.check('c', "Error('Error while processing frame')")
+    with pytest.raises(SystemExit):
+        guard.check('d', "Error('Error while processing frame')")
+
+    guard = FailureGuard(limit=3)
+    guard.check('a', "FileNotFoundError('a')")
+    guard.check('b', "FileNotFoundError('b')")
+    guard.check('c', "FileNotFoundError('c')")
+    with pytest.raises(SystemExit):
+        guard.finish()
+
+    guard = FailureGuard(limit=2)
+    guard.check('a', object())
+    for path in 'bcd':
+        guard.check(path, "Error('Error while processing frame')")
+    guard.finish()
+
+
+def test_speaker_without_usable_audio_is_retried(served_version, tmp_path):
+    from enroll import enroll_speakers
+    alice = write_wav(tmp_path / 'alice.wav', voiced_pcm(3.0))
+    carol = write_wav(tmp_path / 'carol.wav', silence_pcm(3.0))
+    enroll_speakers(enroll_args(served_version, tmp_path), {'alice': {'default': [alice]},
+                                                           'carol': {'default': [carol]}})
+    with open(tmp_path / 'progress.txt') as fp:
+        assert fp.read() == 'alice\n'
+
+
+def test_progress_is_kept_in_the_gallery_until_the_run_finishes(served_version, tmp_path):
+    from enroll import main, PROGRESS_FILE
+    data = tmp_path / 'data'
+    for spk in ('alice', 'bob'):
+        (data / spk).mkdir(parents=True)
+        write_wav(data / spk / 'a.wav', voiced_pcm(3.0, f0=110.0 if spk == 'alice' else 220.0))
+    args = enroll_args(served_version, tmp_path)
+    vars(args).update(spk_path=None, data_path=str(data), channels=False, no_store_audio=False,
+                      progress=None, restart=False)
+    progress = os.path.join(served_version.gallery, PROGRESS_FILE)
+    alice = os.path.join(served_version.gallery, 'alice.pth')
+
+    main(argparse.Namespace(**vars(args)))
+    assert os.path.isfile(alice) and not os.path.exists(progress)
+
+    # an unfinished run had written alice: resuming skips her, --restart does not
+    os.remove(alice)
+    with open(progress, 'w') as fp:
+        fp.write('alice\n')
+    main(argparse.Namespace(**vars(args)))
+    assert not os.path.exists(alice) and not os.path.exists(progress)
+    with open(progress, 'w') as fp:
+        fp.write('alice\n')
+    main(argparse.Namespace(**dict(vars(args), restart=True)))
+    assert os.path.isfile(alice)
+
+    # one speaker is always enrolled again
+    os.remove(alice)
+    with open(progress, 'w') as fp:
+        fp.write('alice\n')
+    main(argparse.Namespace(**dict(vars(args), data_path=None, spk_path=str(data / 'alice'))))
+    assert os.path.isfile(alice)
@@ -0,0 +1,15 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+
+
+def test_check_trials():
+    from evaluate import check_trials
+    check_trials(np.array([True, False, False]))
+    with pytest.raises(SystemExit):
+        check_trials(np.array([], dtype=bool))
+    with pytest.raises(SystemExit):
+        check_trials(np.array([False, False]))
+    with pytest.raises(SystemExit):
+        check_trials(np.array([True]))
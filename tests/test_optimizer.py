@@ -0,0 +1,22 @@
+import json
+import argparse
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('yaml')
+
+
+@pytest.mark.parametrize('amsbound,weight_decay', [(False, 0.0), (True, 1e-4)])
+def test_flat_update_matches_the_loop(amsbound, weight_decay, tmp_path, monkeypatch):
+    from conftest import ROOT
+    from benchmarks import optimizer
+    monkeypatch.chdir(ROOT)
+    output = str(tmp_path / 'optimizer.json')
+    args = argparse.Namespace(device='cpu', threads=1, amsbound=amsbound, weight_decay=weight_decay, lr=1e-3,
+                              final_lr=0.05, parity_steps=3, seed=0, exact=False, min_time=0.0, min_iters=1,
+                              max_iters=1, output=output)
+    optimizer.main(args)
+    with open(output) as fp:
+        report = json.load(fp)
+    assert report['max_difference'] < 1e-6
+    assert report['speedup'] > 0
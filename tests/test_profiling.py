@@ -0,0 +1,39 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import profiling
+
+
+def test_in_span_follows_the_request_to_an_executor_thread(tmp_path):
+    capture = profiling.start_capture('test', str(tmp_path), requests=1, torch_trace=False)
+    seen = []
+
+    def work():
+        seen.append(capture.thread_requests.get(threading.get_ident()))
+        profiling.record_stage('embed', 0.5)
+        return 'done'
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with profiling.request_span('abc', trace=False):
+            assert pool.submit(profiling.in_span(work)).result() == 'done'
+        assert pool.submit(profiling.in_span(work)).result() == 'done'  # outside any span
+
+    assert seen == ['abc', None]
+    capture.stop()
+    with open(os.path.join(capture.out_dir, 'summary.json')) as fp:
+        summary = json.load(fp)
+    [record] = summary['requests']
+    assert record['request_id'] == 'abc'
+    assert record['stages'] == [{'stage': 'embed', 'seconds': 0.5}]
+    assert record['traces'] == []
+
+
+def test_in_span_on_the_span_thread_keeps_its_tag(tmp_path):
+    capture = profiling.start_capture('test', str(tmp_path), requests=1, torch_trace=False)
+    ident = threading.get_ident()
+    with profiling.request_span('abc', trace=False):
+        profiling.in_span(lambda: None)()
+        assert capture.thread_requests[ident] == 'abc'
+    assert ident not in capture.thread_requests
+    capture.stop()
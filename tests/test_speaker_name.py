@@ -0,0 +1,50 @@
+import os
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('prometheus_client')
+import voice_authentication
+from voice_authentication import speaker_name, store_enrollment, delete_enrollment, delete_embedding, load_speaker
+
+INVALID = ['', '.', '..', '.hidden', 'a/b', '../x', None, 7]
+
+
+@pytest.mark.parametrize('name', INVALID)
+def test_invalid_names(name):
+    with pytest.raises(ValueError):
+        speaker_name(name)
+
+
+def test_valid_names():
+    for name in ('alice', 'Sreehari', 'spk_00001', 'a.b', 'a..b'):
+        assert speaker_name(name) == name
+
+
+@pytest.mark.parametrize('name', INVALID)
+def test_store_is_left_alone(name, tmp_path, monkeypatch):
+    store = tmp_path / 'enrollments'
+    (store / 'bob').mkdir(parents=True)
+    (tmp_path / 'keep.txt').write_text('x')
+    monkeypatch.setattr(voice_authentication, 'enrollment_folder', str(store))
+    gallery = str(tmp_path / 'embeddings')
+    for call in (lambda: store_enrollment(name, files=()), lambda: delete_enrollment(name),
+                 lambda: delete_embedding(name, gallery), lambda: load_speaker(name, gallery)):
+        with pytest.raises(ValueError):
+            call()
+    assert os.path.isdir(store / 'bob')
+    assert os.path.isfile(tmp_path / 'keep.txt')
+
+
+def test_default_channel_replaces_only_stored_audio(tmp_path, monkeypatch):
+    store = tmp_path / 'enrollments'
+    spk_dir = store / 'alice'
+    spk_dir.mkdir(parents=True)
+    for name in ('enroll.wav', '0000_a.wav', '0001_b.flac', 'notes.txt', '12_c.wav'):
+        (spk_dir / name).write_text('x')
+    source = tmp_path / 'new.wav'
+    source.write_text('y')
+    monkeypatch.setattr(voice_authentication, 'enrollment_folder', str(store))
+
+    target = store_enrollment('alice', files=[str(source)])
+    assert sorted(os.listdir(spk_dir)) == ['12_c.wav', 'default', 'notes.txt']
+    assert os.listdir(target) == ['0000_new.wav']
@@ -0,0 +1,41 @@
+import json
+import pytest
+from conftest import voiced_pcm, silence_pcm, write_wav, SAMPLE_RATE
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('webrtcvad')
+pytest.importorskip('prometheus_client')
+
+
+def test_vad_audio_segment(tmp_path):
+    from voice_service import vad_audio_segment
+    pcm = np.concatenate([silence_pcm(0.5), voiced_pcm(1.0), silence_pcm(1.0), voiced_pcm(1.0)])
+    segments = vad_audio_segment(write_wav(tmp_path / 'clip.wav', pcm), gap_size=0.5)
+    assert len(segments) == 2
+    assert segments[0][0] == pytest.approx(0.5, abs=0.1)
+    assert segments[1][0] == pytest.approx(2.5, abs=0.1)
+
+
+def test_speaker_timeline(served_version):
+    from voice_service import _speaker_timeline
+    from voice_authentication import enroll_wavs, pcm2float
+    enroll_wavs([pcm2float(voiced_pcm(3.0, f0=f0), dtype='float32') for f0 in (110.0, 220.0)], ['low', 'high'])
+
+    clip = np.concatenate([silence_pcm(0.5), voiced_pcm(2.0, f0=110.0), silence_pcm(1.5), voiced_pcm(2.0, f0=220.0)])
+    result = json.loads(_speaker_timeline(pcm2float(clip, dtype='float32'), threshold=-1.0))
+    assert result['status'] == 'true'
+    assert result['duration'] == pytest.approx(len(clip) / SAMPLE_RATE)
+    turns = result['message']
+    assert len(turns) >= 1
+    assert all(turn['spk_name'] in ('low', 'high') for turn in turns)
+    assert all(0.0 <= turn['start'] < turn['end'] <= result['duration'] for turn in turns)
+    assert turns[0]['start'] == pytest.approx(0.5, abs=0.1)
+    assert all(a['end'] <= b['start'] for a, b in zip(turns, turns[1:]))
+
+
+def test_speaker_timeline_empty_gallery(served_version):
+    from voice_service import _speaker_timeline
+    from voice_authentication import pcm2float
+    result = json.loads(_speaker_timeline(pcm2float(voiced_pcm(1.0), dtype='float32')))
+    assert result['status'] == 'false'
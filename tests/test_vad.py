@@ -0,0 +1,40 @@
+import pytest
+from conftest import voiced_pcm, silence_pcm, SAMPLE_RATE
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('webrtcvad')
+from utils.vad import StreamingVad
+
+
+def test_gate_keeps_voiced_frames():
+    vad = StreamingVad(SAMPLE_RATE, mode=3)
+    pcm = voiced_pcm(1.0)
+    speech = vad.gate(pcm)
+    assert speech.dtype == np.int16
+    assert 0 < len(speech) <= len(pcm)
+    assert len(speech) % vad.frame_len == 0
+    assert vad.stats()['vad_calls'] == len(pcm) // vad.frame_len
+
+
+def test_gate_drops_silence():
+    vad = StreamingVad(SAMPLE_RATE, mode=3)
+    assert len(vad.gate(silence_pcm(1.0))) == 0
+
+
+def test_gate_in_chunks_matches_whole():
+    pcm = np.concatenate([voiced_pcm(0.5), silence_pcm(0.5), voiced_pcm(0.5)])
+    whole = StreamingVad(SAMPLE_RATE, mode=3, hangover=0.1).gate(pcm)
+    vad = StreamingVad(SAMPLE_RATE, mode=3, hangover=0.1)
+    chunked = np.concatenate([vad.gate(pcm[i:i + 1234]) for i in range(0, len(pcm), 1234)])
+    assert np.array_equal(whole, chunked)
+
+
+def test_segments():
+    vad = StreamingVad(SAMPLE_RATE, mode=3)
+    assert vad.segments(silence_pcm(1.0)) == []
+
+    pcm = np.concatenate([silence_pcm(0.5), voiced_pcm(1.0), silence_pcm(1.0), voiced_pcm(1.0)])
+    segments = StreamingVad(SAMPLE_RATE, mode=3).segments(pcm, gap_size=0.5)
+    assert len(segments) == 2
+    assert segments[0][0] == pytest.approx(0.5, abs=0.1)
+    assert segments[1][0] == pytest.approx(2.5, abs=0.1)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+VoiceFilter training.
+
+    python3 trainer.py -c config/default.yaml -e embedder.pt -m my_model
+
+Data-parallel over 4 local processes (gloo, CPU or GPU), or over several nodes with
+torch.distributed.launch, which sets the rendezvous environment and --local_rank:
+
+    python3 trainer.py -c config/default.yaml -e embedder.pt -m my_model --nproc 4
+    python3 -m torch.distributed.launch --nnodes 2 --node_rank 0 --nproc_per_node 4 \\
+        --master_addr 10.0.0.1 --master_port 29500 trainer.py -c config/default.yaml -e embedder.pt -m my_model
+"""
+import os
+import time
+import socket
+import logging
+import argparse
+import torch
+import torch.multiprocessing as mp
+from utils.train import train
+from utils.hparams import HParam
+from utils.writer import MyWriter
+from utils.distributed import init_distributed, is_main
+from datasets.dataloader import create_dataloader
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run(local_rank, args):
+    if args.nproc > 1:
+        os.environ['RANK'] = str(local_rank)
+    hp = HParam(args.config)
+    with open(args.config, 'r') as f:
+        # store hparams as string
+        hp_str = ''.join(f.readlines())
+    if hp.train.get('threads'):
+        torch.set_num_threads(hp.train.threads)
+    device = init_distributed(hp, local_rank)
+
+    pt_dir = os.path.join(args.base_dir, hp.log.chkpt_dir, args.model)
+    os.makedirs(pt_dir, exist_ok=True)
+
+    log_dir = os.path.join(args.base_dir, hp.log.log_dir, args.model)
+    os.makedirs(log_dir, exist_ok=True)
+
+    # rank 0 logs and writes summaries, the other replicas only report problems
+    handlers = [logging.StreamHandler()]
+    if is_main():
+        handlers.append(logging.FileHandler(os.path.join(log_dir,
+            '%s-%d.log' % (args.model, time.time()))))
+    logging.basicConfig(
+        level=logging.INFO if is_main() else logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+    logger = logging.getLogger()
+
+    writer = MyWriter(hp, log_dir) if is_main() else None
+
+    assert hp.audio.hop_length == 160, \
+        'hp.audio.hop_length must be equal to 160, got %d' % hp.audio.hop_length
+
+    trainloader = create_dataloader(hp, args, train=True)
+    testloader = create_dataloader(hp, args, train=False) if is_main() else None
+
+    train(args, pt_dir, args.checkpoint_path, trainloader, testloader, writer, logger, hp, hp_str, log_dir,
+          device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--base_dir', type=str, default='.',
+                        help="Root directory of run.")
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help="yaml file for configuration")
+    parser.add_argument('-e', '--embedder_path', type=str, required=True,
+                        help="path of embedder model pt file")
+    parser.add_argument('--checkpoint_path', type=str, default=None,
+                        help="path of checkpoint pt file")
+    parser.add_argument('-m', '--model', type=str, required=True,
+                        help="Name of the model. Used for both logging and saving checkpoints.")
+    parser.add_argument('--nproc', type=int, default=1,
+                        help="data-parallel processes on this machine")
+    parser.add_argument('--local_rank', type=int, default=int(os.environ.get('LOCAL_RANK', 0)),
+                        help="set by torch.distributed.launch")
+    args = parser.parse_args()
+
+    if args.nproc > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(free_port()))
+        os.environ['WORLD_SIZE'] = str(args.nproc)
+        mp.spawn(run, args=(args,), nprocs=args.nproc)
+    else:
+        run(args.local_rank, args)
@@ -26,7 +26,7 @@ class AdaBound(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), final_lr=0.1, gamma=1e-3,
-                 eps=1e-8, weight_decay=0, amsbound=False):
+                 eps=1e-8, weight_decay=0, amsbound=False, multi_tensor=True):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -44,11 +44,25 @@ class AdaBound(Optimizer):
         super(AdaBound, self).__init__(params, defaults)
 
         self.base_lrs = list(map(lambda group: group['lr'], self.param_groups))
+        # multi_tensor: update each group as a few ops over flat buffers (see _step_flat)
+        self.multi_tensor = multi_tensor
+        self._flat = {}
 
     def __setstate__(self, state):
         super(AdaBound, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsbound', False)
+        self.__dict__.setdefault('multi_tensor', True)
+        self._flat = {}
+
+    def load_state_dict(self, state_dict):
+        super(AdaBound, self).load_state_dict(state_dict)
+        # loaded moments are separate tensors again, the flat buffers are rebuilt on the next step
+        self._flat = {}
+
+    def add_param_group(self, param_group):
+        super(AdaBound, self).add_param_group(param_group)
+        self._flat = {}
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -60,62 +74,164 @@ class AdaBound(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group, base_lr in zip(self.param_groups, self.base_lrs):
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError(
-                        'Adam does not support sparse gradients, please consider SparseAdam instead')
-                amsbound = group['amsbound']
-
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if amsbound:
-                        # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        for index, (group, base_lr) in enumerate(zip(self.param_groups, self.base_lrs)):
+            flat = self._flat_group(index, group) if self.multi_tensor else None
+            if flat is not None:
+                self._step_flat(group, base_lr, flat)
+            else:
+                # parameters may now be at different steps, the buffers are rebuilt when possible
+                self._flat.pop(index, None)
+                self._step_params(group, base_lr)
+
+        return loss
+
+    def _bounded_step(self, group, base_lr, step):
+        """(step_size, lower_bound, upper_bound) of a parameter at its `step`-th update."""
+        beta1, beta2 = group['betas']
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+        step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+
+        # Applies bounds on actual learning rate
+        # lr_scheduler cannot affect final_lr, this is a workaround to apply lr decay
+        final_lr = group['final_lr'] * group['lr'] / base_lr
+        lower_bound = final_lr * (1 - 1 / (group['gamma'] * step + 1))
+        upper_bound = final_lr * (1 + 1 / (group['gamma'] * step))
+        return step_size, lower_bound, upper_bound
+
+    def _step_params(self, group, base_lr):
+        """The original update, one parameter at a time."""
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            grad = p.grad.data
+            if grad.is_sparse:
+                raise RuntimeError(
+                    'Adam does not support sparse gradients, please consider SparseAdam instead')
+            amsbound = group['amsbound']
+
+            state = self.state[p]
+
+            # State initialization
+            if len(state) == 0:
+                state['step'] = 0
+                # Exponential moving average of gradient values
+                state['exp_avg'] = torch.zeros_like(p.data)
+                # Exponential moving average of squared gradient values
+                state['exp_avg_sq'] = torch.zeros_like(p.data)
                 if amsbound:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
-                beta1, beta2 = group['betas']
+                    # Maintains max of all exp. moving avg. of sq. grad. values
+                    state['max_exp_avg_sq'] = torch.zeros_like(p.data)
 
-                state['step'] += 1
+            exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+            if amsbound:
+                max_exp_avg_sq = state['max_exp_avg_sq']
+            beta1, beta2 = group['betas']
 
-                if group['weight_decay'] != 0:
-                    grad = grad.add(group['weight_decay'], p.data)
+            state['step'] += 1
 
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                if amsbound:
-                    # Maintains the maximum of all 2nd moment running avg. till now
-                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
-                    # Use the max. for normalizing running avg. of gradient
-                    denom = max_exp_avg_sq.sqrt().add_(group['eps'])
-                else:
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
-
-                # Applies bounds on actual learning rate
-                # lr_scheduler cannot affect final_lr, this is a workaround to apply lr decay
-                final_lr = group['final_lr'] * group['lr'] / base_lr
-                lower_bound = final_lr * (1 - 1 / (group['gamma'] * state['step'] + 1))
-                upper_bound = final_lr * (1 + 1 / (group['gamma'] * state['step']))
-                step_size = torch.full_like(denom, step_size)
-                step_size.div_(denom).clamp_(lower_bound, upper_bound).mul_(exp_avg)
-
-                p.data.add_(-step_size)
-
-        return loss
\ No newline at end of file
+            if group['weight_decay'] != 0:
+                grad = grad.add(p.data, alpha=group['weight_decay'])
+
+            # Decay the first and second moment running average coefficient
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            if amsbound:
+                # Maintains the maximum of all 2nd moment running avg. till now
+                torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+                # Use the max. for normalizing running avg. of gradient
+                denom = max_exp_avg_sq.sqrt().add_(group['eps'])
+            else:
+                denom = exp_avg_sq.sqrt().add_(group['eps'])
+
+            step_size, lower_bound, upper_bound = self._bounded_step(group, base_lr, state['step'])
+            step_size = torch.full_like(denom, step_size)
+            step_size.div_(denom).clamp_(lower_bound, upper_bound).mul_(exp_avg)
+
+            p.data.sub_(step_size)
+
+    def _flat_group(self, index, group):
+        """
+        Flat buffers of a group, or None when its parameters cannot be updated together:
+        a missing or sparse gradient, mixed devices/dtypes, or parameters at different steps.
+        The per-parameter moments in self.state are views into the flat moments, so
+        state_dict() is unchanged.
+        """
+        params = group['params']
+        for p in params:
+            if p.grad is None or p.grad.is_sparse:
+                return None
+        flat = self._flat.get(index)
+        if flat is not None:
+            return flat
+
+        first = params[0]
+        if any(p.device != first.device or p.dtype != first.dtype for p in params):
+            return None
+        steps = set(self.state[p].get('step', 0) for p in params)
+        if len(steps) != 1:
+            return None
+
+        names = ['exp_avg', 'exp_avg_sq'] + (['max_exp_avg_sq'] if group['amsbound'] else [])
+        total = sum(p.numel() for p in params)
+        flat = {name: torch.zeros(total, dtype=first.dtype, device=first.device) for name in names}
+        # work buffers: gradients (then the denominator) and the update
+        flat['grad'] = torch.empty_like(flat['exp_avg'])
+        flat['update'] = torch.empty_like(flat['exp_avg'])
+        flat['updates'] = []
+        flat['step'] = steps.pop()
+        offset = 0
+        for p in params:
+            state = self.state[p]
+            n = p.numel()
+            for name in names:
+                view = flat[name][offset:offset + n].view_as(p.data)
+                if name in state:
+                    view.copy_(state[name])
+                state[name] = view
+            state['step'] = flat['step']
+            flat['updates'].append(flat['update'][offset:offset + n].view_as(p.data))
+            offset += n
+        self._flat[index] = flat
+        return flat
+
+    def _step_flat(self, group, base_lr, flat):
+        """
+        The update of _step_params as one op per step over the whole group, into buffers
+        allocated once. Only gathering the gradients and applying the update touch every
+        parameter (a single op each when torch has _foreach kernels).
+        """
+        params = group['params']
+        grad, update = flat['grad'], flat['update']
+        exp_avg, exp_avg_sq = flat['exp_avg'], flat['exp_avg_sq']
+        beta1, beta2 = group['betas']
+
+        flat['step'] += 1
+        for p in params:
+            self.state[p]['step'] = flat['step']
+
+        torch.cat([p.grad.data.reshape(-1) for p in params], out=grad)
+        if group['weight_decay'] != 0:
+            torch.cat([p.data.reshape(-1) for p in params], out=update)
+            grad.add_(update, alpha=group['weight_decay'])
+
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        # the gradient is not needed anymore, its buffer takes the denominator
+        denom = grad
+        if group['amsbound']:
+            max_exp_avg_sq = flat['max_exp_avg_sq']
+            torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+            torch.sqrt(max_exp_avg_sq, out=denom)
+        else:
+            torch.sqrt(exp_avg_sq, out=denom)
+        denom.add_(group['eps'])
+
+        step_size, lower_bound, upper_bound = self._bounded_step(group, base_lr, flat['step'])
+        update.fill_(step_size).div_(denom).clamp_(lower_bound, upper_bound).mul_(exp_avg)
+
+        if hasattr(torch, '_foreach_sub_'):
+            torch._foreach_sub_([p.data for p in params], flat['updates'])
+        else:
+            for p, p_update in zip(params, flat['updates']):
+                p.data.sub_(p_update)
@@ -1,22 +1,26 @@
 # adapted from Keith Ito's tacotron implementation
 # https://github.com/keithito/tacotron/blob/master/util/audio.py
 
-import librosa
 import numpy as np
 
+# librosa (and numba behind it) takes seconds to import, so it is imported by the
+# methods that need it, i.e. once the service builds its front-end.
+
 
 class Audio():
     def __init__(self, hp):
+        import librosa
         self.hp = hp
         self.mel_basis = librosa.filters.mel(sr=hp.audio.sample_rate,
                                              n_fft=hp.embedder.n_fft,
                                              n_mels=hp.embedder.num_mels)
 
-    def get_mel(self, y):
+    def get_mel(self, y, center=True):
+        import librosa
         y = librosa.core.stft(y=y, n_fft=self.hp.embedder.n_fft,
                               hop_length=self.hp.audio.hop_length,
                               win_length=self.hp.audio.win_length,
-                              window='hann')
+                              window='hann', center=center)
         magnitudes = np.abs(y) ** 2
         mel = np.log10(np.dot(self.mel_basis, magnitudes) + 1e-6)
         return mel
@@ -28,6 +32,29 @@ class Audio():
         S, D = S.T, D.T # to make [time, freq]
         return S, D
 
+    def wav2spec_batch(self, ys, phase=False):
+        """
+        Normalized magnitudes of equal-length waveforms (B, samples) as a (B, time, freq)
+        float32 array, same values as wav2spec per row. The frames of all rows are taken
+        as strided views and go through a single FFT call. With phase=True, returns
+        (magnitudes, phases).
+        """
+        import librosa
+        from scipy.signal import get_window
+        n_fft, hop = self.hp.audio.n_fft, self.hp.audio.hop_length
+        window = get_window('hann', self.hp.audio.win_length, fftbins=True)
+        window = librosa.util.pad_center(window, n_fft).astype(np.float32)
+        ys = np.pad(np.asarray(ys, dtype=np.float32), ((0, 0), (n_fft // 2, n_fft // 2)), mode='reflect')
+        n_frames = 1 + (ys.shape[1] - n_fft) // hop
+        frames = np.lib.stride_tricks.as_strided(
+            ys, shape=(ys.shape[0], n_frames, n_fft),
+            strides=(ys.strides[0], hop * ys.strides[1], ys.strides[1]), writeable=False)
+        D = np.fft.rfft(frames * window, axis=2) # (B, time, freq)
+        S = self.normalize(self.amp_to_db(np.abs(D)) - self.hp.audio.ref_level_db)
+        if phase:
+            return S.astype(np.float32), np.angle(D)
+        return S.astype(np.float32)
+
     def spec2wav(self, spectrogram, phase):
         spectrogram, phase = spectrogram.T, phase.T
         # used during inference only
@@ -37,11 +64,13 @@ class Audio():
         return self.istft(S, phase)
 
     def stft(self, y):
+        import librosa
         return librosa.stft(y=y, n_fft=self.hp.audio.n_fft,
                             hop_length=self.hp.audio.hop_length,
                             win_length=self.hp.audio.win_length)
 
     def istft(self, mag, phase):
+        import librosa
         stft_matrix = mag * np.exp(1j*phase)
         return librosa.istft(stft_matrix,
                              hop_length=self.hp.audio.hop_length,
@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class DecisionCache():
+    """
+    Bounded LRU of responses tagged with the gallery generation they were computed
+    against. A newer generation (any enroll/remove) drops every entry, results for
+    an older generation are never stored, and identical requests that arrive while
+    one is being computed wait for that computation instead of repeating it.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _sync(self, generation):
+        # caller holds the lock; returns False if `generation` is older than the cache
+        if self.generation is None or generation > self.generation:
+            self.entries.clear()
+            self.generation = generation
+        return generation == self.generation
+
+    def get(self, key, generation):
+        with self.lock:
+            if not self._sync(generation) or key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, generation, value):
+        with self.lock:
+            if not self._sync(generation):
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, generation, compute):
+        """
+        Returns the cached value for key, or compute() it exactly once per process
+        however many identical requests are waiting.
+        """
+        with self.lock:
+            current = self._sync(generation)
+            if current and key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            future = self.inflight.get((key, generation))
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[(key, generation)] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as error:
+            with self.lock:
+                del self.inflight[(key, generation)]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            del self.inflight[(key, generation)]
+        self.put(key, generation, value)
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+            }
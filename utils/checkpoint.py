@@ -0,0 +1,145 @@
+import os
+import re
+import glob
+import queue
+import logging
+import threading
+import multiprocessing
+import torch
+
+from .audio import Audio
+from .writer import MyWriter
+from .hparams import HParam
+from .evaluation import validate
+from model.model import VoiceFilter
+from model.embedder import SpeechEmbedder
+from datasets.dataloader import create_dataloader
+
+
+def snapshot(obj):
+    """Copy of a (nested) state dict with every tensor in host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def checkpoint_step(path):
+    match = re.search(r'chkpt_(\d+)\.pt$', path)
+    return int(match.group(1)) if match else -1
+
+
+class CheckpointWriter():
+    """
+    Saves checkpoints from a background thread. save() only copies the state to host
+    memory; serialization, the atomic rename, rotation to the newest `keep` files and
+    on_saved(path, step) happen on the writer thread. A save waits only when the
+    previous two snapshots are still being written.
+    """
+    def __init__(self, pt_dir, keep=0, logger=None, on_saved=None):
+        self.pt_dir = pt_dir
+        self.keep = keep # 0 keeps every checkpoint
+        self.logger = logger or logging.getLogger()
+        self.on_saved = on_saved
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, step):
+        self.queue.put((snapshot(state), step))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, step = item
+            try:
+                path = self.write(state, step)
+                self.rotate()
+                if self.on_saved is not None:
+                    self.on_saved(path, step)
+            except Exception as e:
+                self.logger.error("Failed to save checkpoint at step %d: %s" % (step, e))
+
+    def write(self, state, step):
+        path = os.path.join(self.pt_dir, 'chkpt_%d.pt' % step)
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.logger.info("Saved checkpoint to: %s" % path)
+        return path
+
+    def rotate(self):
+        if self.keep <= 0:
+            return
+        paths = sorted(glob.glob(os.path.join(self.pt_dir, 'chkpt_*.pt')), key=checkpoint_step)
+        for path in paths[:-self.keep]:
+            os.remove(path)
+
+    def close(self):
+        """Waits for the pending checkpoints to be written."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def validation_worker(args, log_dir, device, paths):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger()
+    hp = HParam(args.config)
+    audio = Audio(hp)
+    embedder = SpeechEmbedder(hp).to(device)
+    embedder.load_state_dict(torch.load(args.embedder_path, map_location=device))
+    embedder.eval()
+    model = VoiceFilter(hp).to(device)
+    testloader = create_dataloader(hp, args, train=False)
+    writer = MyWriter(hp, log_dir)
+
+    done = False
+    while not done:
+        items = [paths.get()]
+        # validate only the newest checkpoint when training got ahead
+        while items[-1] is not None:
+            try:
+                items.append(paths.get_nowait())
+            except queue.Empty:
+                break
+        if items[-1] is None:
+            done = True
+            items.pop()
+        if not items:
+            continue
+        path, step = items[-1]
+        try:
+            checkpoint = torch.load(path, map_location=device)
+        except FileNotFoundError:
+            logger.warning("Checkpoint %s was rotated out before validation" % path)
+            continue
+        model.load_state_dict(checkpoint['model'])
+        validate(audio, model, embedder, testloader, writer, step)
+        logger.info("Validated checkpoint of step %d" % step)
+    writer.close()
+
+
+class Validator():
+    """
+    Runs validate() in a spawned process on each saved checkpoint, with its own embedder,
+    test set and tensorboard writer on log_dir, so evaluation and plotting never stall
+    the training loop. When checkpoints arrive faster than they are validated, only the
+    newest is evaluated.
+    """
+    def __init__(self, args, log_dir, device):
+        context = multiprocessing.get_context('spawn')
+        self.paths = context.Queue()
+        self.process = context.Process(target=validation_worker, args=(args, log_dir, device, self.paths),
+                                       name='validation', daemon=True)
+        self.process.start()
+
+    def submit(self, path, step):
+        self.paths.put((path, step))
+
+    def close(self):
+        self.paths.put(None)
+        self.process.join()
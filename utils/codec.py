@@ -0,0 +1,94 @@
+import os
+import subprocess
+import threading
+import numpy as np
+
+# container of a compressed websocket stream (MediaRecorder mimeType) -> ffmpeg demuxer
+CONTAINERS = {
+    'audio/webm': 'matroska',
+    'audio/ogg': 'ogg',
+}
+READ_CHUNK = 64 * 1024
+
+
+def container_format(mime_type):
+    """ffmpeg input format of a 'audio/webm;codecs=opus' like mime type, ValueError if unsupported."""
+    container = (mime_type or '').split(';')[0].strip().lower()
+    if container not in CONTAINERS:
+        raise ValueError('Unsupported audio codec: {}'.format(mime_type))
+    return CONTAINERS[container]
+
+
+class StreamDecoder():
+    """
+    Incremental decoder of one compressed session (Opus in WebM/Ogg, as MediaRecorder
+    produces it) to int16 PCM. A single ffmpeg lives as long as the recording: chunks
+    are written to it as they arrive and a reader thread collects the PCM, which push()
+    hands out as soon as it is decoded. Decoding lags the input by about one chunk.
+    """
+    def __init__(self, mime_type, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self.proc = subprocess.Popen(['ffmpeg', '-loglevel', 'panic', '-fflags', 'nobuffer',
+                                      '-probesize', '4096', '-analyzeduration', '0',
+                                      '-f', container_format(mime_type), '-i', 'pipe:0',
+                                      '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1',
+                                      '-ar', str(sample_rate), '-flush_packets', '1', 'pipe:1'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.lock = threading.Lock()
+        self.pcm = bytearray()
+        self.bytes_in = 0
+        self.samples_out = 0
+        self.cpu_seconds = None # ffmpeg user+system time, known once closed
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        while True:
+            chunk = self.proc.stdout.read(READ_CHUNK)
+            if not chunk:
+                break
+            with self.lock:
+                self.pcm.extend(chunk)
+
+    def _take(self):
+        with self.lock:
+            n = len(self.pcm) // 2 * 2 # a sample may be split across reads
+            pcm = np.frombuffer(bytes(self.pcm[:n]), dtype=np.int16)
+            del self.pcm[:n]
+        self.samples_out += len(pcm)
+        return pcm
+
+    @property
+    def duration(self):
+        return self.samples_out / self.sample_rate
+
+    def push(self, data):
+        """Feeds a compressed chunk, returns the int16 samples decoded so far (maybe none)."""
+        self.bytes_in += len(data)
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            raise ValueError('Could not decode audio data.')
+        return self._take()
+
+    def close(self):
+        """Ends the stream and returns the remaining samples. ValueError if ffmpeg failed."""
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.reader.join()
+        # wait4 rather than wait(), for the decoder's own CPU time
+        _, status, usage = os.wait4(self.proc.pid, 0)
+        self.proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        self.cpu_seconds = usage.ru_utime + usage.ru_stime
+        pcm = self._take()
+        if self.proc.returncode != 0:
+            raise ValueError('Could not decode audio data.')
+        return pcm
+
+    def abort(self):
+        """Stops the decoder without waiting for the rest, e.g. when the client is gone."""
+        if self.proc.returncode is None:
+            self.proc.kill()
+            self.proc.wait()
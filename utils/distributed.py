@@ -0,0 +1,62 @@
+import os
+import torch
+import torch.distributed as dist
+
+# Data-parallel training is configured through the environment, as set by
+# `python -m torch.distributed.launch` (several nodes) or by trainer.py --nproc (one node):
+# MASTER_ADDR, MASTER_PORT, WORLD_SIZE and RANK.
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return rank() == 0
+
+
+def init_distributed(hp, local_rank=0):
+    """Joins the process group when WORLD_SIZE > 1. Returns the device of this process."""
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not is_distributed():
+        dist.init_process_group(backend=hp.train.get('dist_backend', 'gloo'), init_method='env://')
+    return train_device(hp, local_rank)
+
+
+def train_device(hp, local_rank=0):
+    name = hp.train.get('device', 'auto')
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(name)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', local_rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    return device
+
+
+def average(value):
+    """Mean of a python number over all processes."""
+    if not is_distributed():
+        return value
+    # nccl reduces cuda tensors only
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    tensor = torch.tensor([float(value)], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor)
+    return tensor.item() / world_size()
+
+
+def any_rank(flag):
+    """True on every process when flag is true on any of them."""
+    if not is_distributed():
+        return bool(flag)
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    tensor = torch.tensor([1.0 if flag else 0.0], device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return tensor.item() > 0
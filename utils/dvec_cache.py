@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def reference_path(dvec_txt):
+    """The reference wav a '*-dvec.txt' file points to."""
+    with open(dvec_txt, 'r') as f:
+        return f.readline().strip()
+
+
+def cache_key(embedder_path, hp):
+    """
+    Checksum of the embedder weights and of the settings its mels depend on. A cache
+    is only valid for the embedder and front-end it was computed with.
+    """
+    digest = hashlib.sha256()
+    with open(embedder_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(json.dumps({'audio': hp.audio, 'embedder': hp.embedder}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class DvecCache():
+    """
+    Precomputed reference d-vectors: one (N, emb_dim) float32 .npy mapped read-only and a
+    .json index of the reference paths, named after cache_key. Rows are served without
+    touching the embedder; the pages are shared by every dataloader worker.
+    """
+    def __init__(self, cache_dir, key):
+        self.base = os.path.join(cache_dir, 'dvec-{}'.format(key[:16]))
+        self.key = key
+        self.index = {}
+        self.dvecs = None
+        if os.path.isfile(self.base + '.json'):
+            with open(self.base + '.json') as fp:
+                meta = json.load(fp)
+            if meta['key'] != key:
+                raise ValueError('{} was computed with another embedder.'.format(self.base + '.json'))
+            self.index = {path: row for row, path in enumerate(meta['paths'])}
+            self.dvecs = np.load(self.base + '.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.index
+
+    def __getitem__(self, path):
+        """(emb_dim,) float32 array of a reference wav."""
+        return np.array(self.dvecs[self.index[os.path.abspath(path)]])
+
+    def missing(self, paths):
+        return sorted(set(os.path.abspath(path) for path in paths) - set(self.index))
+
+    def extend(self, paths, dvecs):
+        """
+        Adds (len(paths), emb_dim) d-vectors, rewriting both files. The index is
+        replaced last, so a reader never sees rows that are not written yet.
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        old = [] if self.dvecs is None else [np.asarray(self.dvecs)]
+        merged = np.concatenate(old + [np.asarray(dvecs, dtype=np.float32)], axis=0)
+        all_paths = sorted(self.index, key=self.index.get) + paths
+
+        os.makedirs(os.path.dirname(self.base) or '.', exist_ok=True)
+        with open(self.base + '.npy.tmp', 'wb') as fp:
+            np.save(fp, merged)
+        with open(self.base + '.json.tmp', 'w') as fp:
+            json.dump({'key': self.key, 'emb_dim': int(merged.shape[1]), 'paths': all_paths}, fp)
+        os.replace(self.base + '.npy.tmp', self.base + '.npy')
+        os.replace(self.base + '.json.tmp', self.base + '.json')
+        self.index = {path: row for row, path in enumerate(all_paths)}
+        self.dvecs = np.load(self.base + '.npy', mmap_mode='r')
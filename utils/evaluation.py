@@ -6,16 +6,18 @@ from mir_eval.separation import bss_eval_sources
 def validate(audio, model, embedder, testloader, writer, step):
     model.eval()
     
+    device = next(model.parameters()).device
     criterion = nn.MSELoss()
     with torch.no_grad():
         for batch in testloader:
             dvec_mel, target_wav, mixed_wav, target_mag, mixed_mag, mixed_phase = batch[0]
 
-            dvec_mel = dvec_mel.cuda()
-            target_mag = target_mag.unsqueeze(0).cuda()
-            mixed_mag = mixed_mag.unsqueeze(0).cuda()
+            dvec_mel = dvec_mel.to(device)
+            target_mag = target_mag.unsqueeze(0).to(device)
+            mixed_mag = mixed_mag.unsqueeze(0).to(device)
 
-            dvec = embedder(dvec_mel)
+            # a cached d-vector is (emb_dim,), a reference mel (num_mels, T)
+            dvec = dvec_mel if dvec_mel.dim() == 1 else embedder(dvec_mel)
             dvec = dvec.unsqueeze(0)
             est_mask = model(mixed_mag, dvec)
             est_mag = est_mask * mixed_mag
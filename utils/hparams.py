@@ -1,26 +1,54 @@
 # modified from https://github.com/HarryVolek/PyTorch_Speaker_Verification
 
 import os
+import json
+import hashlib
+import threading
 import yaml
 
-
-def load_hparam_str(hp_str):
-    path = os.path.join('config', 'temp-restore.yaml')
-    with open(path, 'w') as f:
-        f.write(hp_str)
-    return HParam(path)
+_cache_lock = threading.Lock()
+_cache = {} # (realpath, mtime, size) -> FrozenHParam
 
 
-def load_hparam(filename):
-    stream = open(filename, 'r')
-    docs = yaml.load_all(stream)
+def parse_hparam(text):
     hparam_dict = dict()
-    for doc in docs:
+    for doc in yaml.safe_load_all(text):
         for k, v in doc.items():
             hparam_dict[k] = v
     return hparam_dict
 
 
+def load_hparam_str(hp_str):
+    return HParam(hp_str, is_str=True)
+
+
+def load_hparam(filename):
+    with open(filename, 'r') as stream:
+        return parse_hparam(stream)
+
+
+def fingerprint(hparam_dict):
+    """Checksum of the values, independent of key order, comments and formatting."""
+    canonical = json.dumps(hparam_dict, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def cached_hparam(filename):
+    """
+    Read-only hparams of a config file, parsed once per process and content. Returns the
+    same FrozenHParam until the file changes; its `fingerprint` identifies the values.
+    """
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        hp = _cache.get(key)
+        if hp is None:
+            hp = FrozenHParam(load_hparam(path))
+            _cache[key] = hp
+        return hp
+
+
 def merge_dict(user, default):
     if isinstance(user, dict) and isinstance(default, dict):
         for k, v in default.items():
@@ -53,9 +81,9 @@ class Dotdict(dict):
 
 class HParam(Dotdict):
 
-    def __init__(self, file):
+    def __init__(self, file, is_str=False):
         super(Dotdict, self).__init__()
-        hp_dict = load_hparam(file)
+        hp_dict = parse_hparam(file) if is_str else load_hparam(file)
         hp_dotdict = Dotdict(hp_dict)
         for k, v in hp_dotdict.items():
             setattr(self, k, v)
@@ -63,3 +91,34 @@ class HParam(Dotdict):
     __getattr__ = Dotdict.__getitem__
     __setattr__ = Dotdict.__setitem__
     __delattr__ = Dotdict.__delitem__
+
+
+class FrozenDotdict(Dotdict):
+    """
+    A Dotdict that refuses changes, nested dicts included (lists become tuples), so one
+    instance can be cached and shared by every thread. Dotdict(hp) makes a mutable copy.
+    """
+    def __init__(self, dct=None):
+        dct = dict() if not dct else dct
+        for key, value in dct.items():
+            if hasattr(value, 'keys'):
+                value = FrozenDotdict(value)
+            elif isinstance(value, list):
+                value = tuple(value)
+            dict.__setitem__(self, key, value)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('hparams are read-only, make a copy with Dotdict(hp)')
+
+    __setattr__ = __setitem__ = __delattr__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenHParam(FrozenDotdict):
+    """Read-only HParam with the `fingerprint` of its values, see cached_hparam."""
+    def __init__(self, hparam_dict):
+        super(FrozenHParam, self).__init__(hparam_dict)
+        object.__setattr__(self, 'fingerprint', fingerprint(hparam_dict))
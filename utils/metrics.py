@@ -0,0 +1,79 @@
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, \
+    generate_latest, multiprocess, CONTENT_TYPE_LATEST
+from utils import profiling
+
+# gunicorn workers share PROMETHEUS_MULTIPROC_DIR (set in gunicorn.conf.py) so that a scrape
+# of any worker reports the whole server; stream_server runs single-process without it.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram('speaker_id_stage_seconds',
+                          'Time spent in each processing stage.',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+REQUEST_SECONDS = Histogram('speaker_id_request_seconds',
+                            'End-to-end time per request or websocket decision.',
+                            ['server', 'task'], buckets=LATENCY_BUCKETS)
+DECISIONS = Counter('speaker_id_decisions_total',
+                    'Verify/identify decisions by outcome.',
+                    ['task', 'result'])
+ERRORS = Counter('speaker_id_errors_total',
+                 'Errors by the place they were caught.',
+                 ['where'])
+SESSIONS = Gauge('speaker_id_sessions',
+                 'Connected websocket sessions.',
+                 multiprocess_mode='livesum')
+REAL_TIME_FACTOR = Histogram('speaker_id_real_time_factor',
+                             'Processing time over audio duration, per request.',
+                             ['stage'], buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0))
+GALLERY_VERSION = Gauge('speaker_id_gallery_version',
+                        'Serial of the embedder/gallery version each serving process has switched to.',
+                        multiprocess_mode='liveall')
+GALLERY_LOOKUPS = Counter('speaker_id_gallery_lookups_total',
+                          'Gallery lookups per tenant: hit (mapped and current) or miss (mapped on demand).',
+                          ['tenant', 'result'])
+GALLERY_LOAD_SECONDS = Histogram('speaker_id_gallery_load_seconds',
+                                 'Time to map a tenant gallery on a miss.',
+                                 ['tenant'], buckets=LATENCY_BUCKETS)
+GALLERY_EVICTIONS = Counter('speaker_id_gallery_evictions_total',
+                            'Galleries unmapped to stay under the per-process byte budget, per tenant.',
+                            ['tenant'])
+GALLERY_CACHE_SIZE = Gauge('speaker_id_gallery_cache_bytes',
+                           'Bytes of galleries kept mapped, summed over the serving processes.',
+                           multiprocess_mode='livesum')
+STREAM_BYTES = Counter('speaker_id_stream_bytes_total',
+                       'Websocket audio payload received, by transport (pcm: JSON int16, opus: compressed).',
+                       ['codec'])
+STREAM_AUDIO_SECONDS = Counter('speaker_id_stream_audio_seconds_total',
+                               'Seconds of audio received over websockets, by transport.',
+                               ['codec'])
+QUEUE_DEPTH = Gauge('speaker_id_queue_depth',
+                    'Requests or websocket messages being processed or waiting.',
+                    ['server'], multiprocess_mode='livesum')
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        profiling.record_stage(stage, elapsed)
+
+
+def count_decision(result_json):
+    DECISIONS.labels(result_json['task'], 'accept' if result_json['status'] == 'true' else 'reject').inc()
+
+
+def render():
+    """Returns (body, content type) in the Prometheus text format."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
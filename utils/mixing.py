@@ -0,0 +1,55 @@
+import numpy as np
+import librosa
+
+
+def load_trimmed(path, hp):
+    wav, _ = librosa.load(path, sr=hp.audio.sample_rate)
+    # LibriSpeech has long silences, mixtures are made of the speech only
+    wav, _ = librosa.effects.trim(wav, top_db=20)
+    return wav
+
+
+def sample_triple(rng, speakers, names):
+    """
+    (reference, target, interferer) paths: two different files of one speaker and a
+    file of another. speakers is {speaker: files}, names the speakers with 2+ files.
+    """
+    spk1, spk2 = rng.choice(len(names), 2, replace=False)
+    ref, target = rng.choice(speakers[names[spk1]], 2, replace=False)
+    interferer = speakers[names[spk2]][rng.randint(len(speakers[names[spk2]]))]
+    return ref, target, interferer
+
+
+def mix(hp, w1, w2, snr=None):
+    """
+    Mixes the first data.audio_len seconds of target w1 and interferer w2, with w2
+    rescaled to `snr` dB below w1 (recorded levels if None). Returns the normalized
+    (target, mixed), or None if either is too short.
+    """
+    L = int(hp.audio.sample_rate * hp.data.audio_len)
+    if w1.shape[0] < L or w2.shape[0] < L:
+        return None
+    w1, w2 = w1[:L], w2[:L]
+    if snr is not None:
+        p1, p2 = np.mean(w1 ** 2), np.mean(w2 ** 2)
+        w2 = w2 * np.sqrt(p1 / max(p2, 1e-12) / 10.0 ** (snr / 10.0))
+    mixed = w1 + w2
+    norm = np.max(np.abs(mixed)) * 1.1
+    return w1 / norm, mixed / norm
+
+
+def random_mixture(hp, rng, speakers, names, snr_range=None, max_tries=20):
+    """
+    Draws triples until one mixes. Returns (reference path, target wav, mixed wav, snr).
+    """
+    min_ref = 1.1 * hp.embedder.window * hp.audio.hop_length
+    for _ in range(max_tries):
+        ref, target, interferer = sample_triple(rng, speakers, names)
+        snr = None if snr_range is None else float(rng.uniform(*snr_range))
+        # a reference too short for the embedder is discarded
+        if librosa.get_duration(filename=ref) * hp.audio.sample_rate < min_ref:
+            continue
+        mixture = mix(hp, load_trimmed(target, hp), load_trimmed(interferer, hp), snr)
+        if mixture is not None:
+            return (ref,) + mixture + (snr,)
+    raise RuntimeError('No usable mixture in {} tries, are the files long enough?'.format(max_tries))
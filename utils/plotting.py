@@ -5,7 +5,7 @@ import numpy as np
 
 
 def fig2np(fig):
-    data = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep='')
+    data = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
     data = data.reshape(fig.canvas.get_width_height()[::-1] + (3,))
     return data
 
@@ -20,5 +20,5 @@ def plot_spectrogram_to_numpy(spectrogram):
 
     fig.canvas.draw()
     data = fig2np(fig)
-    plt.close()
+    plt.close(fig)
     return data
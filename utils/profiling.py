@@ -0,0 +1,333 @@
+import os
+import gc
+import sys
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+
+# A capture is requested by writing CONTROL_FILE (POST /admin/profile or profile_capture.py).
+# Every serving process polls its mtime once a second and, for the next N requests or T
+# seconds, records into PROFILE_DIR/<capture id>/<pid>/:
+#   trace-<request id>.json  autograd profiler trace of the request (chrome://tracing, perfetto)
+#   stacks.txt               sampled Python stacks of every thread, folded (flamegraph.pl, speedscope)
+#   summary.json             per-request duration and stage timings, GC pauses
+# When no capture runs the only cost per request is one contextvar/global lookup.
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join('.', 'profiles'))
+CONTROL_FILE = 'capture.json'
+POLL_INTERVAL = 1.0 # seconds between checks of the control file
+
+_capture = None # running Capture, None when off
+_span = contextvars.ContextVar('profiling_span', default=None) # (capture, record) of the current request
+_watcher = None
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Capture():
+    """
+    One profiling capture in this process. Requests are traced one at a time by the
+    autograd profiler (it profiles the thread it is started on, so work a request hands
+    to another thread is traced there, see in_span), while a sampler thread records the
+    Python stacks of all threads, tagged with the request they serve.
+    """
+    def __init__(self, capture_id, out_dir, max_requests=None, duration=None,
+                 interval=0.005, torch_trace=True):
+        self.capture_id = capture_id
+        self.out_dir = out_dir
+        self.max_requests = max_requests
+        self.deadline = None if duration is None else time.time() + duration
+        self.interval = interval
+        self.torch_trace = torch_trace
+        self.lock = threading.Lock()
+        self.trace_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.claimed = 0
+        self.inflight = 0
+        self.written = False
+        self.requests = []
+        self.thread_requests = {} # thread ident -> request id
+        self.stacks = Counter()
+        self.samples = 0
+        self.gc_pauses = []
+        self.gc_start = None
+        self.started = time.time()
+        self.sampler = threading.Thread(target=self.sample, name='profiling-sampler', daemon=True)
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        gc.callbacks.append(self.on_gc)
+        self.sampler.start()
+
+    def stop(self):
+        global _capture
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            self.stopped.set()
+            if _capture is self:
+                _capture = None
+            write = self.inflight == 0
+        if self.on_gc in gc.callbacks:
+            gc.callbacks.remove(self.on_gc)
+        if threading.current_thread() is not self.sampler:
+            self.sampler.join()
+        if write:
+            self.write_summary()
+
+    def claim(self):
+        with self.lock:
+            if self.stopped.is_set() or (self.max_requests is not None and self.claimed >= self.max_requests):
+                return False
+            self.claimed += 1
+            self.inflight += 1
+            return True
+
+    def release(self, record):
+        with self.lock:
+            self.requests.append(record)
+            self.inflight -= 1
+            done = self.max_requests is not None and len(self.requests) >= self.max_requests
+            write = self.stopped.is_set() and self.inflight == 0
+        if done:
+            self.stop()
+        elif write:
+            self.write_summary()
+
+    @contextmanager
+    def span(self, request_id, trace=True):
+        if not self.claim():
+            yield
+            return
+        ident = threading.get_ident()
+        record = {'request_id': request_id, 'start': time.time(), 'thread': ident, 'stages': [], 'traces': []}
+        token = _span.set((self, record))
+        self.thread_requests[ident] = request_id
+        stack = ExitStack()
+        start = time.perf_counter()
+        try:
+            if trace:
+                stack.enter_context(self.traced(record))
+            yield
+        finally:
+            record['duration'] = time.perf_counter() - start
+            self.thread_requests.pop(ident, None)
+            _span.reset(token)
+            try:
+                stack.close()
+            finally:
+                self.release(record)
+
+    @contextmanager
+    def thread_span(self, record):
+        """Continues the span of a request on a thread running part of it, traced on its own."""
+        ident = threading.get_ident()
+        outer = self.thread_requests.get(ident)
+        token = _span.set((self, record))
+        self.thread_requests[ident] = record['request_id']
+        try:
+            with self.traced(record):
+                yield
+        finally:
+            if outer is None:
+                self.thread_requests.pop(ident, None)
+            else:
+                self.thread_requests[ident] = outer
+            _span.reset(token)
+
+    @contextmanager
+    def traced(self, record):
+        """Autograd profiler trace of the enclosed work on this thread, one trace at a time per process."""
+        if not self.torch_trace or not self.trace_lock.acquire(False):
+            yield
+            return
+        profiler = None
+        try:
+            from torch.autograd import profiler as autograd_profiler
+            with autograd_profiler.profile(record_shapes=True) as profiler:
+                with autograd_profiler.record_function('request {}'.format(record['request_id'])):
+                    yield
+        finally:
+            try:
+                if profiler is not None:
+                    # trace-<request id>.json, then -1, -2, ... for the request's other parts
+                    name = 'trace-{}{}.json'.format(record['request_id'], '-{}'.format(len(record['traces']))
+                                                    if record['traces'] else '')
+                    profiler.export_chrome_trace(os.path.join(self.out_dir, name))
+                    record['traces'].append(name)
+            finally:
+                self.trace_lock.release()
+
+    def sample(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     frame.f_lineno))
+                    frame = frame.f_back
+                request_id = self.thread_requests.get(ident)
+                root = 'request {}'.format(request_id) if request_id else 'thread {}'.format(ident)
+                self.stacks[';'.join([root] + names[::-1])] += 1
+            self.samples += 1
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.stop()
+                return
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            pause = time.perf_counter() - self.gc_start
+            self.gc_start = None
+            self.gc_pauses.append({'generation': info['generation'], 'seconds': pause,
+                                   'collected': info['collected']})
+            record_stage('gc', pause)
+
+    def write_summary(self):
+        with self.lock:
+            if self.written:
+                return
+            self.written = True
+        with open(os.path.join(self.out_dir, 'stacks.txt'), 'w') as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write('{} {}\n'.format(stack, count))
+        pauses = [p['seconds'] for p in self.gc_pauses]
+        summary = {
+            'capture_id': self.capture_id,
+            'pid': os.getpid(),
+            'started': self.started,
+            'elapsed': time.time() - self.started,
+            'samples': self.samples,
+            'sample_interval': self.interval,
+            'requests': sorted(self.requests, key=lambda r: r['start']),
+            'gc': {
+                'collections': len(pauses),
+                'total_seconds': sum(pauses),
+                'max_seconds': max(pauses) if pauses else 0.0,
+                'pauses': self.gc_pauses,
+            },
+        }
+        with open(os.path.join(self.out_dir, 'summary.json'), 'w') as fp:
+            json.dump(summary, fp, indent=2)
+
+
+@contextmanager
+def request_span(request_id, trace=True):
+    """
+    Marks one request, captured if a capture is running and still wants requests. With
+    trace=False the autograd profiler is left to the parts run through in_span(), e.g.
+    for a coroutine whose thread serves other requests between its awaits.
+    """
+    capture = _capture
+    if capture is None:
+        yield
+        return
+    with capture.span(request_id, trace):
+        yield
+
+
+def in_span(fn):
+    """
+    fn bound to the span of the calling request, for work handed to an executor thread
+    (the span only covers the thread it was opened on): the thread's stacks are tagged
+    with the request, its stages recorded and its torch ops traced.
+    """
+    span = _span.get()
+    if span is None:
+        return fn
+    capture, record = span
+
+    def run(*args, **kwargs):
+        with capture.thread_span(record):
+            return fn(*args, **kwargs)
+    return run
+
+
+def record_stage(stage, seconds):
+    """Adds a stage timing to the span of the current request, if it is being captured."""
+    span = _span.get()
+    if span is not None:
+        span[1]['stages'].append({'stage': stage, 'seconds': seconds})
+
+
+def start_capture(capture_id, profile_dir=PROFILE_DIR, requests=None, seconds=None,
+                  interval=0.005, torch_trace=True):
+    global _capture
+    if _capture is not None:
+        _capture.stop()
+    if requests is None and seconds is None:
+        seconds = 30.0
+    capture = Capture(capture_id, os.path.join(profile_dir, capture_id, str(os.getpid())),
+                      max_requests=requests, duration=seconds, interval=interval, torch_trace=torch_trace)
+    capture.start()
+    _capture = capture
+    return capture
+
+
+def request_capture(profile_dir=PROFILE_DIR, requests=None, seconds=None, interval=0.005, torch_trace=True):
+    """
+    Asks every process watching profile_dir to start a capture. Returns the capture id.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    control = {
+        'capture_id': time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6],
+        'requested': time.time(),
+        'requests': requests,
+        'seconds': seconds,
+        'interval': interval,
+        'torch': torch_trace,
+    }
+    path = os.path.join(profile_dir, CONTROL_FILE)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(control, fp)
+    os.replace(path + '.tmp', path)
+    return control['capture_id']
+
+
+def _watch(profile_dir):
+    path = os.path.join(profile_dir, CONTROL_FILE)
+    seen_mtime, seen_id = None, None
+    started = time.time()
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == seen_mtime:
+                continue
+            seen_mtime = mtime
+            with open(path) as fp:
+                control = json.load(fp)
+        except (OSError, ValueError):
+            continue
+        # requests written before this process started (or already served) are stale
+        if control['capture_id'] == seen_id or control['requested'] < started - POLL_INTERVAL:
+            continue
+        seen_id = control['capture_id']
+        start_capture(control['capture_id'], profile_dir, requests=control.get('requests'),
+                      seconds=control.get('seconds'), interval=control.get('interval', 0.005),
+                      torch_trace=control.get('torch', True))
+
+
+def watch(profile_dir=PROFILE_DIR):
+    """Starts polling for capture requests in this process and in every process forked from it."""
+
+    def start():
+        global _watcher
+        _watcher = threading.Thread(target=_watch, args=(profile_dir,), name='profiling-watch', daemon=True)
+        _watcher.start()
+
+    if _watcher is None:
+        start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=start)
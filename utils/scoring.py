@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def det_curve(scores, labels):
+    """
+    False accept / false reject rates when accepting every score >= each threshold.
+    scores, labels: flat arrays, labels 1 for target trials.
+    Returns (far, frr, thresholds) sorted by decreasing threshold.
+    """
+    order = np.argsort(-scores, kind='mergesort')
+    thresholds = scores[order]
+    labels = labels[order].astype(np.float64)
+    tp = np.cumsum(labels)
+    fp = np.cumsum(1.0 - labels)
+    far = fp / max(fp[-1], 1.0)
+    frr = 1.0 - tp / max(tp[-1], 1.0)
+    return far, frr, thresholds
+
+
+def compute_eer(scores, labels):
+    """Returns (equal error rate, threshold where it is reached)."""
+    far, frr, thresholds = det_curve(scores, labels)
+    i = int(np.argmin(np.abs(far - frr)))
+    return float((far[i] + frr[i]) / 2), float(thresholds[i])
+
+
+def compute_min_dcf(scores, labels, p_target=0.01, c_miss=1.0, c_fa=1.0):
+    """Returns (normalized minimum detection cost, threshold where it is reached)."""
+    far, frr, thresholds = det_curve(scores, labels)
+    dcf = c_miss * frr * p_target + c_fa * far * (1 - p_target)
+    i = int(np.argmin(dcf))
+    return float(dcf[i] / min(c_miss * p_target, c_fa * (1 - p_target))), float(thresholds[i])
+
+
+def error_rates(scores, labels, threshold):
+    """Returns (far, frr) when accepting scores >= threshold."""
+    accept = scores >= threshold
+    target = labels.astype(bool)
+    far = float(accept[~target].mean()) if (~target).any() else 0.0
+    frr = float((~accept[target]).mean()) if target.any() else 0.0
+    return far, frr
@@ -0,0 +1,80 @@
+import time
+import numpy as np
+import torch
+
+
+class ChunkedSeparator():
+    """
+    Target-speaker separation of arbitrarily long audio with VoiceFilter. The waveform
+    is cut into chunks of `chunk` seconds overlapping by `overlap` seconds; `batch`
+    chunks at a time go through one STFT, one model forward and their inverse STFTs,
+    and are overlap-added into the output with linear cross-fades. Memory beyond the
+    input and output waveforms is bounded by one batch of chunks.
+    """
+    def __init__(self, hp, audio, model, chunk=3.0, overlap=0.5, batch=8):
+        self.hp = hp
+        self.audio = audio
+        self.model = model
+        hop = hp.audio.hop_length
+        sr = hp.audio.sample_rate
+        # whole STFT frames, so a chunk's istft has exactly the chunk length
+        self.chunk = int(chunk * sr) // hop * hop
+        self.overlap = min(int(overlap * sr) // hop * hop, self.chunk // 2)
+        self.step = self.chunk - self.overlap
+        self.batch = batch
+        self.fade = np.ones(self.chunk, dtype=np.float32)
+        if self.overlap > 0:
+            ramp = (np.arange(self.overlap, dtype=np.float32) + 0.5) / self.overlap
+            self.fade[:self.overlap] = ramp
+            self.fade[-self.overlap:] = ramp[::-1]
+
+    def starts(self, length):
+        if length <= self.chunk:
+            return [0]
+        return list(range(0, length - self.overlap, self.step))
+
+    def separate(self, wav, dvec):
+        """
+        wav: (samples,) float32 at the service rate, dvec: (emb_dim,) d-vector of the target.
+        Returns (estimated wav, stats).
+        """
+        start_time = time.perf_counter()
+        wav = np.asarray(wav, dtype=np.float32)
+        length = len(wav)
+        out = np.zeros(length, dtype=np.float32)
+        weight = np.zeros(length, dtype=np.float32)
+        starts = self.starts(length)
+        device = next(self.model.parameters()).device
+        dvec = dvec.reshape(1, -1).to(device)
+
+        batches = 0
+        for first in range(0, len(starts), self.batch):
+            group = starts[first:first + self.batch]
+            chunks = np.zeros((len(group), self.chunk), dtype=np.float32)
+            for i, start in enumerate(group):
+                piece = wav[start:start + self.chunk]
+                chunks[i, :len(piece)] = piece # the last chunk is zero-padded
+            mags, phases = self.audio.wav2spec_batch(chunks, phase=True)
+            with torch.no_grad():
+                mixed = torch.from_numpy(mags).to(device)
+                mask = self.model(mixed, dvec.expand(len(group), -1))
+                est_mags = (mixed * mask).cpu().numpy()
+            for i, start in enumerate(group):
+                est = self.audio.spec2wav(est_mags[i], phases[i])[:self.chunk]
+                n = min(len(est), length - start)
+                out[start:start + n] += est[:n] * self.fade[:n]
+                weight[start:start + n] += self.fade[:n]
+            batches += 1
+
+        # samples covered by one chunk only come out unchanged
+        out /= np.maximum(weight, 1e-8)
+        elapsed = time.perf_counter() - start_time
+        seconds = length / self.hp.audio.sample_rate
+        stats = {
+            'seconds': round(seconds, 3),
+            'elapsed': round(elapsed, 3),
+            'real_time_factor': round(elapsed / seconds, 4) if seconds > 0 else None,
+            'chunks': len(starts),
+            'batches': batches,
+        }
+        return out, stats
@@ -0,0 +1,57 @@
+import os
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.m4a', '.opus', '.webm')
+
+
+def audio_files(folder):
+    """Sorted audio file paths anywhere under folder."""
+    files = []
+    for dirpath, _, filenames in os.walk(folder):
+        files.extend(os.path.join(dirpath, x) for x in filenames
+                     if x.lower().endswith(AUDIO_EXTENSIONS))
+    return sorted(files)
+
+
+def speaker_files(root):
+    """
+    Walks a folder-per-speaker tree (e.g. LibriSpeech speaker/chapter/file.flac).
+    The first folder level under root is the speaker id, hidden folders are skipped.
+    Returns {speaker id: sorted list of audio file paths}.
+    """
+    speakers = {}
+    for spk in sorted(os.listdir(root)):
+        spk_dir = os.path.join(root, spk)
+        if spk.startswith('.') or not os.path.isdir(spk_dir):
+            continue
+        files = audio_files(spk_dir)
+        if files:
+            speakers[spk] = files
+    return speakers
+
+
+def channel_files(spk_dir, default='default'):
+    """
+    {channel: sorted audio file paths} of one speaker folder, each sub-folder being a
+    channel and files directly in it belonging to `default`.
+    """
+    channels = {}
+    for path in audio_files(spk_dir):
+        parts = os.path.relpath(path, spk_dir).split(os.sep)
+        channels.setdefault(parts[0] if len(parts) > 1 else default, []).append(path)
+    return channels
+
+
+def speaker_channels(root, default='default'):
+    """
+    Like speaker_files for a <speaker>/<channel>/<files> tree.
+    Returns {speaker id: {channel: sorted list of audio file paths}}.
+    """
+    speakers = {}
+    for spk in sorted(os.listdir(root)):
+        spk_dir = os.path.join(root, spk)
+        if spk.startswith('.') or not os.path.isdir(spk_dir):
+            continue
+        channels = channel_files(spk_dir, default)
+        if channels:
+            speakers[spk] = channels
+    return speakers
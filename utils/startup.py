@@ -0,0 +1,37 @@
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Startup phases of a serving process and the heavy modules each one imported, logged
+# by gunicorn.conf.py and stream_server.py once the process is ready to serve.
+
+HEAVY_MODULES = ('torch', 'numpy', 'scipy', 'librosa', 'numba', 'webrtcvad', 'boto3', 'boto',
+                 'prometheus_client', 'flask', 'websockets')
+
+_phases = OrderedDict()
+
+
+@contextmanager
+def phase(name):
+    loaded = set(sys.modules)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = {
+            'seconds': time.perf_counter() - start,
+            'imported': [m for m in HEAVY_MODULES if m in sys.modules and m not in loaded],
+        }
+
+
+def phases():
+    return OrderedDict((name, dict(entry)) for name, entry in _phases.items())
+
+
+def report():
+    lines = ['Startup: {:.2f} s'.format(sum(entry['seconds'] for entry in _phases.values()))]
+    for name, entry in _phases.items():
+        imported = ', imported ' + ' '.join(entry['imported']) if entry['imported'] else ''
+        lines.append('  {:28s} {:7.3f} s{}'.format(name, entry['seconds'], imported))
+    return '\n'.join(lines)
@@ -0,0 +1,145 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils.metrics import timed
+
+
+def fuse_scores(scores, fusion='max'):
+    """(B, T) scores against the templates of one speaker to (B,): the best template or their mean."""
+    if fusion == 'max':
+        return scores.max(dim=1)[0]
+    if fusion == 'mean':
+        return scores.mean(dim=1)
+    raise ValueError("fusion must be 'max' or 'mean', not {!r}".format(fusion))
+
+
+class WindowEmbeddingStream():
+    """
+    Incrementally turns 16 kHz audio into the per-window d-vectors of SpeechEmbedder.
+    Each push only computes the mel frames and embedder windows it completes, so the
+    cost of an update does not grow with the length of the session.
+    """
+    def __init__(self, hp, audio, embedder, max_windows=None):
+        self.hp = hp
+        self.audio = audio
+        self.embedder = embedder
+        self.max_windows = max_windows
+        self.samples = np.zeros(0, dtype=np.float32) # not yet covered by a mel frame
+        self.mel = np.zeros((hp.embedder.num_mels, 0), dtype=np.float32) # not yet past a window start
+        self.windows = torch.zeros(0, hp.embedder.emb_dim) # (num_windows, emb_dim)
+        self.num_samples = 0
+        self.num_windows = 0
+
+    @property
+    def duration(self):
+        return self.num_samples / self.hp.audio.sample_rate
+
+    @property
+    def window_step(self):
+        """Seconds of audio between two consecutive windows."""
+        return self.hp.embedder.stride * self.hp.audio.hop_length / self.hp.audio.sample_rate
+
+    def push(self, wav):
+        """
+        Appends float32 samples and returns the (new_windows, emb_dim) d-vectors they complete.
+        """
+        n_fft, hop = self.hp.embedder.n_fft, self.hp.audio.hop_length
+        window, stride = self.hp.embedder.window, self.hp.embedder.stride
+
+        self.num_samples += len(wav)
+        self.samples = np.concatenate([self.samples, wav.astype(np.float32, copy=False)])
+        n_frames = 0 if len(self.samples) < n_fft else 1 + (len(self.samples) - n_fft) // hop
+        if n_frames > 0:
+            used = (n_frames - 1) * hop + n_fft
+            with timed('mel'):
+                mel = self.audio.get_mel(self.samples[:used], center=False).astype(np.float32)
+            self.samples = self.samples[n_frames * hop:]
+            self.mel = np.concatenate([self.mel, mel], axis=1)
+
+        n_windows = 0 if self.mel.shape[1] < window else 1 + (self.mel.shape[1] - window) // stride
+        if n_windows == 0:
+            return self.windows[:0]
+        mel = torch.from_numpy(self.mel[:, :(n_windows - 1) * stride + window])
+        self.mel = self.mel[:, n_windows * stride:]
+        with torch.no_grad(), timed('embed'):
+            new_windows = self.embedder.embed_frames(self.embedder.frames(mel))
+
+        self.windows = torch.cat([self.windows, new_windows], dim=0)
+        if self.max_windows is not None:
+            self.windows = self.windows[-self.max_windows:]
+        self.num_windows += n_windows
+        return new_windows
+
+    def embedding(self, last=None):
+        """
+        Average-pooled d-vector over the last `last` windows (all kept windows if None),
+        the same pooling as SpeechEmbedder.forward. Returns (1, emb_dim) or None.
+        """
+        windows = self.windows if last is None else self.windows[-last:]
+        if windows.size(0) == 0:
+            return None
+        return (windows.sum(0) / windows.size(0)).unsqueeze(0)
+
+
+class SequentialVerifier():
+    """
+    Scores window d-vectors against one claimed speaker as they arrive and stops as
+    soon as the pooled score and its confidence band are clearly on one side of the
+    threshold. The band is z standard errors of the per-window scores; windows
+    overlap, so only window/stride of them count as independent. A speaker with
+    several templates is scored with `fusion` over them.
+    """
+    def __init__(self, hp, template, threshold=0.84, min_duration=1.0, max_duration=7.0, z=2.0, fusion='max'):
+        self.templates = F.normalize(template.view(-1, template.size(-1)), p=2, dim=1) # (T, emb_dim)
+        self.fusion = fusion
+        self.threshold = threshold
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.z = z
+        self.overlap = hp.embedder.window / hp.embedder.stride
+        self.pooled = torch.zeros_like(self.templates[0])
+        self.window_scores = []
+        self.score = None
+        self.band = float('inf')
+        self.duration = 0.0
+        self.decision = None # 'Accepted' / 'Rejected' once decided
+        self.early_exit = False
+
+    def update(self, windows, duration):
+        """
+        windows: (n, emb_dim) new unit-norm window d-vectors, duration: seconds consumed so far.
+        Returns the decision, or None while more audio is needed.
+        """
+        if self.decision is not None:
+            return self.decision
+        self.duration = duration
+        if windows.size(0) > 0:
+            self.pooled += windows.sum(0)
+            self.window_scores.extend(fuse_scores(torch.mm(windows, self.templates.t()), self.fusion).tolist())
+        n = len(self.window_scores)
+        if n == 0:
+            return None
+
+        pooled = self.pooled.unsqueeze(0) / torch.norm(self.pooled, p=2)
+        self.score = fuse_scores(torch.mm(pooled, self.templates.t()), self.fusion).item()
+        if n > 1:
+            n_eff = max(1.0, n / self.overlap)
+            self.band = self.z * float(np.std(self.window_scores, ddof=1)) / np.sqrt(n_eff)
+
+        if duration >= self.max_duration:
+            return self.finish()
+        if duration >= self.min_duration:
+            if self.score - self.band >= self.threshold:
+                self.decision = 'Accepted'
+            elif self.score + self.band < self.threshold:
+                self.decision = 'Rejected'
+            self.early_exit = self.decision is not None
+        return self.decision
+
+    def finish(self):
+        """Forces a decision on the audio seen so far (end of recording or max_duration)."""
+        if self.decision is None:
+            if self.score is None:
+                return None
+            self.decision = 'Accepted' if self.score >= self.threshold else 'Rejected'
+        return self.decision
@@ -1,25 +1,45 @@
-import os
 import math
 import torch
 import torch.nn as nn
 import traceback
+from contextlib import nullcontext
+from torch.nn.parallel import DistributedDataParallel
 
 from .adabound import AdaBound
 from .audio import Audio
 from .evaluation import validate
+from .checkpoint import CheckpointWriter, Validator
+from .distributed import is_main, is_distributed, rank, world_size, average, any_rank, train_device
 from model.model import VoiceFilter
 from model.embedder import SpeechEmbedder
 
 
-def train(args, pt_dir, chkpt_path, trainloader, testloader, writer, logger, hp, hp_str):
+def batch_dvec(embedder, dvec_mels, device):
+    """
+    (B, emb_dim) reference d-vectors of a batch. Taken as is when the dataloader serves
+    them from the d-vector cache, otherwise all reference mels go through one forward.
+    """
+    if torch.is_tensor(dvec_mels):
+        return dvec_mels.to(device, non_blocking=True)
+    with torch.no_grad():
+        return embedder.forward_batch([mel.to(device, non_blocking=True) for mel in dvec_mels])
+
+
+def train(args, pt_dir, chkpt_path, trainloader, testloader, writer, logger, hp, hp_str, log_dir=None,
+          device=None):
+    # in data-parallel runs every process trains a replica; only rank 0 writes
+    # checkpoints, summaries (writer is None elsewhere) and validates
+    device = device or train_device(hp)
+    main = is_main()
+
     # load embedder
-    embedder_pt = torch.load(args.embedder_path)
-    embedder = SpeechEmbedder(hp).cuda()
+    embedder_pt = torch.load(args.embedder_path, map_location=device)
+    embedder = SpeechEmbedder(hp).to(device)
     embedder.load_state_dict(embedder_pt)
     embedder.eval()
 
     audio = Audio(hp)
-    model = VoiceFilter(hp).cuda()
+    model = VoiceFilter(hp).to(device)
     if hp.train.optimizer == 'adabound':
         optimizer = AdaBound(model.parameters(),
                              lr=hp.train.adabound.initial,
@@ -34,7 +54,7 @@ def train(args, pt_dir, chkpt_path, trainloader, testloader, writer, logger, hp,
 
     if chkpt_path is not None:
         logger.info("Resuming from checkpoint: %s" % chkpt_path)
-        checkpoint = torch.load(chkpt_path)
+        checkpoint = torch.load(chkpt_path, map_location=device)
         model.load_state_dict(checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         step = checkpoint['step']
@@ -45,56 +65,86 @@ def train(args, pt_dir, chkpt_path, trainloader, testloader, writer, logger, hp,
     else:
         logger.info("Starting new training run")
 
+    # replicas start from the weights of rank 0 and average their gradients
+    replica = model
+    if is_distributed():
+        replica = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+        logger.info("Training replica %d of %d on %s" % (rank(), world_size(), device))
+    accumulation = hp.train.get('grad_accumulation', 1)
+
+    # checkpoints are written in the background; validation runs on each saved
+    # checkpoint in its own process unless train.validation is 'inline'
+    validator = None
+    checkpointer = None
+    if main:
+        if hp.train.get('validation', 'process') == 'process' and log_dir is not None:
+            validator = Validator(args, log_dir, hp.train.get('validation_device') or str(device))
+        checkpointer = CheckpointWriter(pt_dir, keep=hp.train.get('checkpoint_keep', 0), logger=logger,
+                                        on_saved=validator.submit if validator is not None else None)
+
     try:
         criterion = nn.MSELoss()
+        epoch = 0
         while True:
             model.train()
-            for dvec_mels, target_mag, mixed_mag in trainloader:
-                target_mag = target_mag.cuda()
-                mixed_mag = mixed_mag.cuda()
+            # distributed samplers give every replica its own part of the epoch
+            if hasattr(trainloader.sampler, 'set_epoch'):
+                trainloader.sampler.set_epoch(epoch)
+            epoch += 1
+            optimizer.zero_grad()
+            for i, (dvec_mels, target_mag, mixed_mag) in enumerate(trainloader):
+                target_mag = target_mag.to(device, non_blocking=True)
+                mixed_mag = mixed_mag.to(device, non_blocking=True)
 
-                dvec_list = list()
-                for mel in dvec_mels:
-                    mel = mel.cuda()
-                    dvec = embedder(mel)
-                    dvec_list.append(dvec)
-                dvec = torch.stack(dvec_list, dim=0)
-                dvec = dvec.detach()
+                dvec = batch_dvec(embedder, dvec_mels, device)
 
-                mask = model(mixed_mag, dvec)
-                output = mixed_mag * mask
+                # gradients of accumulated batches are averaged across replicas once, on the last
+                update = (i + 1) % accumulation == 0
+                with replica.no_sync() if replica is not model and not update else nullcontext():
+                    mask = replica(mixed_mag, dvec)
+                    output = mixed_mag * mask
 
-                # output = torch.pow(torch.clamp(output, min=0.0), hp.audio.power)
-                # target_mag = torch.pow(torch.clamp(target_mag, min=0.0), hp.audio.power)
-                loss = criterion(output, target_mag)
+                    # output = torch.pow(torch.clamp(output, min=0.0), hp.audio.power)
+                    # target_mag = torch.pow(torch.clamp(target_mag, min=0.0), hp.audio.power)
+                    loss = criterion(output, target_mag)
+                    (loss / accumulation).backward()
+                if not update:
+                    continue
 
-                optimizer.zero_grad()
-                loss.backward()
                 optimizer.step()
+                optimizer.zero_grad()
                 step += 1
 
+                # every replica stops together: one raising alone leaves the others
+                # waiting in their next all-reduce
                 loss = loss.item()
-                if loss > 1e8 or math.isnan(loss):
-                    logger.error("Loss exploded to %.02f at step %d!" % (loss, step))
+                if any_rank(loss > 1e8 or math.isnan(loss)):
+                    logger.error("Loss exploded to %.02f on rank %d at step %d!" % (loss, rank(), step))
                     raise Exception("Loss exploded")
 
                 # write loss to tensorboard
                 if step % hp.train.summary_interval == 0:
-                    writer.log_training(loss, step)
-                    logger.info("Wrote summary at step %d" % step)
+                    loss = average(loss)
+                    if main:
+                        writer.log_training(loss, step)
+                        logger.info("Wrote summary at step %d" % step)
 
                 # 1. save checkpoint file to resume training
                 # 2. evaluate and save sample to tensorboard
-                if step % hp.train.checkpoint_interval == 0:
-                    save_path = os.path.join(pt_dir, 'chkpt_%d.pt' % step)
-                    torch.save({
+                if main and step % hp.train.checkpoint_interval == 0:
+                    checkpointer.save({
                         'model': model.state_dict(),
                         'optimizer': optimizer.state_dict(),
                         'step': step,
                         'hp_str': hp_str,
-                    }, save_path)
-                    logger.info("Saved checkpoint to: %s" % save_path)
-                    validate(audio, model, embedder, testloader, writer, step)
+                    }, step)
+                    if validator is None:
+                        validate(audio, model, embedder, testloader, writer, step)
     except Exception as e:
         logger.info("Exiting due to exception: %s" % e)
         traceback.print_exc()
+    finally:
+        if checkpointer is not None:
+            checkpointer.close()
+        if validator is not None:
+            validator.close()
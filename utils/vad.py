@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class StreamingVad():
+    """
+    Speech gate over 16-bit PCM held in numpy arrays, usable on whole files or on
+    the chunks of a live session. Frames are row views of the input, an optional
+    energy pre-gate rejects quiet frames in one vectorized pass, and webrtcvad is
+    only asked about the frames that pass it. Speech is extended by a causal
+    hangover so word endings are not clipped.
+    """
+    def __init__(self, sample_rate=16000, frame_duration=10, mode=3,
+                 energy_floor=None, hangover=0.0):
+        """
+        :param frame_duration: frame size (milli seconds), 10, 20 or 30
+        :param mode: webrtcvad aggressiveness, 0-3
+        :param energy_floor: frames quieter than this (dBFS) are non-speech, None disables the pre-gate
+        :param hangover: non-speech kept after each speech frame (seconds)
+        """
+        from webrtcvad import Vad
+        self.vad = Vad(mode)
+        self.sample_rate = sample_rate
+        self.frame_len = int(sample_rate * frame_duration / 1000)
+        self.energy_floor = energy_floor
+        self.hangover = int(round(hangover * 1000 / frame_duration))
+        self.pending = np.zeros(0, dtype=np.int16) # partial frame carried to the next push
+        self.num_frames = 0 # frames seen so far, i.e. index of the next frame
+        self.last_speech = -np.inf # index of the last raw speech frame
+        self.energy_rejected = 0
+        self.vad_calls = 0
+        self.speech_frames = 0
+
+    def push(self, pcm):
+        """
+        Classifies the complete frames available after appending `pcm` (int16).
+        Returns (frames, mask): a (n, frame_len) view of those frames and their speech mask.
+        """
+        pcm = np.asarray(pcm, dtype=np.int16)
+        if len(self.pending):
+            pcm = np.concatenate([self.pending, pcm])
+        n = len(pcm) // self.frame_len
+        self.pending = pcm[n * self.frame_len:]
+        frames = pcm[:n * self.frame_len].reshape(n, self.frame_len)
+        if n == 0:
+            return frames, np.zeros(0, dtype=bool)
+
+        candidates = np.ones(n, dtype=bool)
+        if self.energy_floor is not None:
+            power = np.mean(np.square(frames, dtype=np.float64), axis=1)
+            level = 10.0 * np.log10(power / 32768.0 ** 2 + 1e-12)
+            candidates = level >= self.energy_floor
+            self.energy_rejected += int(n - candidates.sum())
+
+        readonly = frames.view()
+        readonly.flags.writeable = False
+        raw = np.zeros(n, dtype=bool)
+        for i in np.flatnonzero(candidates):
+            # webrtcvad takes the frame length from len(buf) / 2, so hand it bytes, not int16 items
+            raw[i] = self.vad.is_speech(memoryview(readonly[i]).cast('B'), self.sample_rate)
+        self.vad_calls += int(candidates.sum())
+
+        # causal hangover: keep frames within `hangover` frames after a speech frame
+        index = np.arange(self.num_frames, self.num_frames + n)
+        last = np.maximum.accumulate(np.where(raw, index, -np.inf))
+        last = np.maximum(last, self.last_speech)
+        mask = index - last <= self.hangover
+        self.last_speech = last[-1]
+        self.num_frames += n
+        self.speech_frames += int(mask.sum())
+        return frames, mask
+
+    def gate(self, pcm):
+        """Returns only the speech samples of `pcm` (int16), contiguous."""
+        frames, mask = self.push(pcm)
+        return frames[mask].reshape(-1)
+
+    def segments(self, pcm, gap_size=0.5):
+        """
+        Speech segments of a whole recording as [[start, end], ...] in seconds,
+        merging neighbours closer than gap_size seconds.
+        """
+        offset = self.num_frames
+        _, mask = self.push(pcm)
+        if not mask.any():
+            return []
+        edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        frame_sec = self.frame_len / self.sample_rate
+        audio_segment = [[(offset + starts[0]) * frame_sec, (offset + ends[0]) * frame_sec]]
+        for s, e in zip(starts[1:], ends[1:]):
+            if (offset + s) * frame_sec <= audio_segment[-1][1] + gap_size:
+                audio_segment[-1][1] = (offset + e) * frame_sec
+            else:
+                audio_segment.append([(offset + s) * frame_sec, (offset + e) * frame_sec])
+        return audio_segment
+
+    def stats(self):
+        total = self.num_frames
+        return {
+            'total': total * self.frame_len / self.sample_rate,
+            'speech': self.speech_frames * self.frame_len / self.sample_rate,
+            'skipped': 1.0 - self.speech_frames / total if total else 0.0,
+            'energy_rejected': self.energy_rejected / total if total else 0.0,
+            'vad_calls': self.vad_calls,
+        }
@@ -0,0 +1,93 @@
+import os
+import json
+import fcntl
+import numpy as np
+import torch
+import torch.nn as nn
+
+# A checkpoint is converted once into '<checkpoint>.mapped/weights-<size>-<mtime>.bin', the raw
+# tensors back to back, plus an index (.json). Loading maps the file copy-on-write and wraps
+# each tensor around the mapped pages: nothing is unpickled or copied, pages are read on first
+# use, and every process serving the same checkpoint shares them through the page cache.
+
+ALIGN = 64 # bytes, offset alignment of every tensor
+
+
+def mapped_base(checkpoint_path):
+    st = os.stat(checkpoint_path)
+    folder = checkpoint_path + '.mapped'
+    return os.path.join(folder, 'weights-{}-{}'.format(st.st_size, st.st_mtime_ns))
+
+
+def export_mapped(state_dict, base):
+    index, offset = {}, 0
+    with open(base + '.bin.tmp', 'wb') as fp:
+        for name, tensor in state_dict.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            padding = -offset % ALIGN
+            fp.write(b'\0' * padding)
+            offset += padding
+            index[name] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+            fp.write(array.tobytes())
+            offset += array.nbytes
+    os.replace(base + '.bin.tmp', base + '.bin')
+    # the index is written last and marks the export as complete
+    with open(base + '.json.tmp', 'w') as fp:
+        json.dump(index, fp)
+    os.replace(base + '.json.tmp', base + '.json')
+
+
+def mapped_state_dict(checkpoint_path):
+    """
+    {name: tensor} of a checkpoint (a bare state dict or a trainer checkpoint's 'model'),
+    the tensors being views of a memory-mapped export built on first use.
+    """
+    base = mapped_base(checkpoint_path)
+    if not os.path.isfile(base + '.json'):
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        with open(os.path.join(os.path.dirname(base), '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(base + '.json'):
+                checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+                export_mapped(checkpoint.get('model', checkpoint), base)
+
+    with open(base + '.json') as fp:
+        index = json.load(fp)
+    data = np.memmap(base + '.bin', dtype=np.uint8, mode='c')
+    state = {}
+    for name, entry in index.items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = data[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype)
+        state[name] = torch.from_numpy(array.reshape(entry['shape']))
+    return state
+
+
+def load_mapped(module, checkpoint_path):
+    """
+    Points the parameters and buffers of an inference module at the mapped weights of
+    checkpoint_path instead of copying them in. Raises KeyError/ValueError on a mismatch.
+    """
+    state = mapped_state_dict(checkpoint_path)
+    expected = module.state_dict()
+    if set(state) != set(expected):
+        raise KeyError('Checkpoint keys do not match the module: {}'.format(
+            sorted(set(state) ^ set(expected))[:5]))
+    for name, tensor in state.items():
+        if tensor.shape != expected[name].shape:
+            raise ValueError('{}: checkpoint shape {} != module shape {}'.format(
+                name, tuple(tensor.shape), tuple(expected[name].shape)))
+        owner = module
+        path = name.split('.')
+        for attr in path[:-1]:
+            owner = getattr(owner, attr)
+        if path[-1] in owner._parameters:
+            owner._parameters[path[-1]] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            owner._buffers[path[-1]] = tensor
+    for m in module.modules():
+        # RNNs keep their own list of weight tensors
+        if isinstance(m, nn.RNNBase) and hasattr(m, '_flat_weights_names'):
+            m._flat_weights = [getattr(m, n) for n in m._flat_weights_names]
+    module.mapped_from = checkpoint_path # share_memory() would copy the weights out again
+    return module
@@ -1,36 +1,178 @@
 import os
 import sys
-import datetime
+import json
+import glob
+import warnings
+import time
+import queue
+import atexit
+import logging
+import threading
+import fcntl
+import shutil
+from collections import namedtuple, OrderedDict
+from logging.handlers import QueueHandler, QueueListener
 import numpy as np
 import torch
 import torch.nn.functional as F
-import librosa
-from scipy.io.wavfile import write
+from utils import startup
 from utils.audio import Audio
-from utils.hparams import HParam
+from utils.hparams import cached_hparam
+from utils.weights import load_mapped
+from utils.dvec_cache import cache_key
+from utils.stream import fuse_scores
 from model.embedder import SpeechEmbedder
+from model.model import VoiceFilter
+from utils.metrics import timed, ERRORS, GALLERY_VERSION, GALLERY_LOOKUPS, GALLERY_LOAD_SECONDS, \
+    GALLERY_EVICTIONS, GALLERY_CACHE_SIZE
 
 cur_dir = os.path.dirname(os.path.realpath(__file__))
 embedding_folder = os.path.join(cur_dir, 'embeddings')
 os.makedirs(embedding_folder, exist_ok=True)
 sys.path.append(cur_dir)
 
+conf_path = os.path.join(cur_dir, "config", "default.yaml")
+embedder_checkpoint = os.path.join(cur_dir, "embedder.pt")
+# on CPU, weights are memory-mapped from an export of the checkpoint instead of unpickled
+MMAP_WEIGHTS = os.environ.get('MMAP_WEIGHTS', '1') != '0'
+voicefilter_checkpoint = os.environ.get('VOICEFILTER_CHECKPOINT', os.path.join(cur_dir, "voicefilter.pt"))
+# the audio of every enrollment, one folder per speaker, so galleries can be rebuilt for a new embedder
+enrollment_folder = os.environ.get('ENROLLMENT_FOLDER', os.path.join(cur_dir, 'enrollments'))
+# the embedder and gallery being served, written by reembed.py; embedder.pt and embeddings/ without it
+version_file = os.environ.get('GALLERY_VERSION_FILE', os.path.join(cur_dir, 'gallery_version.json'))
+VERSION_POLL = float(os.environ.get('GALLERY_VERSION_POLL', 5.0))  # seconds between checks for a swap
+SAMPLE_RATE = 16000
+GENERATION_FILE = '.generation'
+GALLERY_TAG = '.model.json'
+DEFAULT_CHANNEL = 'default'
+ENROLLMENT_WAV = 'enroll.wav'  # the clip of an API enrollment, bulk ones keep numbered copies
+MAX_TEMPLATES = 8  # per speaker, one per enrollment channel (device, microphone, ...)
+SPEAKER_CACHE_SIZE = 4096  # speaker models kept per process for verification
+# tenants have their own gallery (and enrollment store) in <gallery>/.tenants/<tenant>/
+TENANT_FOLDER = '.tenants'
+DEFAULT_TENANT = 'default'  # the gallery folder itself
+# mapped galleries kept per process, least recently used ones are unmapped beyond this
+GALLERY_CACHE_BYTES = int(float(os.environ.get('GALLERY_CACHE_MB', 512)) * 1024 * 1024)
+
+Version = namedtuple('Version', ['serial', 'fingerprint', 'embedder', 'gallery'])
+
+_model_lock = threading.Lock()
+_model_cache = {}
+_gallery_lock = threading.Lock()
+_gallery_cache = OrderedDict()
+_gallery_bytes = 0
+_version_lock = threading.Lock()
+_version = None  # served by this process
+_retired = None  # replaced by the last swap, still cached for requests that were running
+_watcher = None
+_fingerprints = {}
+_speaker_lock = threading.Lock()
+_speaker_cache = OrderedDict()
+
+
+def start_logger(log_file='server_message.log'):
+    """
+    Request threads only put records on a queue, a listener thread formats them
+    and writes to stdout and the log file, which stays open. Restarted with a
+    fresh queue in forked children, whose copy of the listener thread is gone.
+    """
+    global _log_listener
+    formatter = logging.Formatter('%(asctime)s: %(message)s', datefmt='%Y-%m-%d_%H-%M-%S')
+    formatter.converter = time.gmtime
+    handlers = [logging.StreamHandler(sys.stdout), logging.FileHandler(log_file, encoding='utf-8')]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    logger.handlers = [QueueHandler(log_queue)]
+    _log_listener = QueueListener(log_queue, *handlers)
+    _log_listener.start()
+
+
+def stop_logger():
+    # flushes what is still queued
+    if _log_listener is not None:
+        _log_listener.stop()
+
 
 def print_log(log_text):
-    now = datetime.datetime.utcnow()
-    log_file = 'server_message.log'
+    logger.info(log_text)
+
+
+logger = logging.getLogger('speaker_id')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_listener = None
+start_logger()
+atexit.register(stop_logger)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=start_logger)
+
+
+def load_model(conf_file=conf_path, embedder_path=None):
+    """
+    Loads hparams, the mel front-end and the embedder once per process, by default
+    the embedder of the served version. Returns (hp, audio, embedder).
+    """
+    if embedder_path is None:
+        embedder_path = current_version().embedder
+    key = (conf_file, embedder_path)
+    with _model_lock:
+        if key not in _model_cache:
+            with startup.phase('hparams'):
+                hp = cached_hparam(conf_file)
+            with startup.phase('embedder weights'):
+                embedder = load_weights(SpeechEmbedder(hp), embedder_path)
+            with startup.phase('mel front-end'):
+                audio = Audio(hp)
+            print_log("Embedder loaded.")
+            _model_cache[key] = (hp, audio, embedder)
+        return _model_cache[key]
+
+
+def load_weights(model, checkpoint_path):
+    """Inference weights of a bare state dict or a trainer checkpoint, mapped on CPU."""
+    if MMAP_WEIGHTS and not torch.cuda.is_available():
+        load_mapped(model, checkpoint_path)
+    else:
+        checkpoint = torch.load(checkpoint_path, map_location=None if torch.cuda.is_available() else 'cpu')
+        model.load_state_dict(checkpoint.get('model', checkpoint))
+    model.eval()
+    return model
+
+
+def load_separator(conf_file=conf_path, checkpoint_path=voicefilter_checkpoint):
+    """
+    Loads the VoiceFilter model once per process, from a trainer checkpoint or a bare
+    state dict. Raises FileNotFoundError when separation is not deployed.
+    """
+    key = ('voicefilter', conf_file, checkpoint_path)
+    with _model_lock:
+        if key not in _model_cache:
+            if not os.path.isfile(checkpoint_path):
+                raise FileNotFoundError(checkpoint_path)
+            with startup.phase('voicefilter weights'):
+                model = load_weights(VoiceFilter(cached_hparam(conf_file)), checkpoint_path)
+            print_log("VoiceFilter loaded.")
+            _model_cache[key] = model
+        return _model_cache[key]
+
+
+def min_samples(hp):
+    """Shortest waveform that yields at least one embedder window."""
+    return (hp.embedder.window - 1) * hp.audio.hop_length
 
-    log_message = "{}: {}".format(now.strftime('%Y-%m-%d_%H-%M-%S'), log_text)
-    print(log_message)
-    with open(log_file, 'a', encoding='utf-8') as logfp:
-        logfp.write("{}\n".format(log_message))
+
+def load_wav(file_path):
+    import librosa
+    dvec_wav, _ = librosa.load(file_path, sr=SAMPLE_RATE)
+    return dvec_wav
 
 
 def get_embeddings(file_path, audio, embedder):
     """
     Produces de d-vector for each audio file
     """
-    dvec_wav, _ = librosa.load(file_path, sr=16000)
+    dvec_wav = load_wav(file_path)
     dvec_mel = audio.get_mel(dvec_wav)
     dvec_mel = torch.from_numpy(dvec_mel).float()
     dvec = embedder(dvec_mel)
@@ -38,15 +180,560 @@ def get_embeddings(file_path, audio, embedder):
     return dvec
 
 
-def load_embeddings(embeddings_path=embedding_folder):
+def get_embeddings_batch(wavs, audio, embedder):
+    """
+    Produces the d-vectors of several waveforms with a single embedder pass.
+    Returns a (len(wavs), emb_dim) tensor.
+    """
+    with timed('mel'):
+        mels = [torch.from_numpy(audio.get_mel(wav)).float() for wav in wavs]
+    with torch.no_grad(), timed('embed'):
+        return embedder.forward_batch(mels)
+
+
+def load_embeddings(embeddings_path=None):
+    embeddings_path = serving_gallery(embeddings_path)
     with torch.no_grad():
         embeddings = {}
         for file in os.listdir(embeddings_path):
-            embeddings[file] = torch.load(os.path.join(embeddings_path, file))
-        print("Embeddings loaded")
+            if not file.endswith('.pth'):
+                continue
+            embeddings[file] = torch.load(os.path.join(embeddings_path, file),
+                                          map_location=torch.device('cpu'))
+        print_log("Embeddings loaded")
     return embeddings
 
 
+def speaker_templates(model):
+    """
+    (channels, (T, emb_dim) templates) of a loaded speaker model, a bare d-vector
+    (the format before templates) being one default template.
+    """
+    if isinstance(model, dict):
+        return list(model['channels']), model['templates']
+    return [DEFAULT_CHANNEL], model.view(1, -1)
+
+
+def merge_templates(path, channels, templates):
+    """
+    The speaker model stored at `path` (if any) with the templates of `channels`
+    replaced or added, as the {'channels', 'templates'} dict to save.
+    """
+    try:
+        merged = OrderedDict(zip(*speaker_templates(torch.load(path, map_location=torch.device('cpu')))))
+    except FileNotFoundError:
+        merged = OrderedDict()
+    merged.update(zip(channels, templates))
+    if len(merged) > MAX_TEMPLATES:
+        raise ValueError('{} would have more than {} templates.'.format(
+            os.path.splitext(os.path.basename(path))[0], MAX_TEMPLATES))
+    return {'channels': list(merged), 'templates': torch.stack([t.view(-1) for t in merged.values()])}
+
+
+def stack_embeddings(embeddings):
+    """
+    Turns a {file: speaker model} dict into (names, (num_templates, emb_dim) unit-norm matrix),
+    names holding the speaker of every row: the best row of a speaker is its max-fused score.
+    """
+    names, rows = [], []
+    for spk, model in embeddings.items():
+        templates = speaker_templates(model)[1]
+        names.extend([os.path.splitext(spk)[0]] * templates.size(0))
+        rows.append(templates)
+    if len(names) == 0:
+        return names, torch.zeros(0, 0)
+    return names, F.normalize(torch.cat(rows, dim=0), p=2, dim=1)
+
+
+def gallery_generation(embeddings_path=None):
+    """
+    Changes on every enroll/remove. A counter file bumped by save_embedding and
+    delete_embedding, paired with the folder mtime so files copied in by hand are
+    noticed too. Shared by every process serving the same folder.
+    """
+    embeddings_path = serving_gallery(embeddings_path)
+    try:
+        with open(os.path.join(embeddings_path, GENERATION_FILE)) as fp:
+            counter = int(fp.read() or 0)
+    except FileNotFoundError:
+        counter = 0
+    try:
+        return counter, os.stat(embeddings_path).st_mtime_ns
+    except FileNotFoundError:
+        return counter, 0  # a tenant nobody enrolled in yet
+
+
+def bump_generation(embeddings_path=None):
+    path = os.path.join(serving_gallery(embeddings_path), GENERATION_FILE)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as fp:
+                counter = int(fp.read() or 0) + 1
+        except FileNotFoundError:
+            counter = 1
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            fp.write(str(counter))
+        os.replace(tmp_path, path)
+    return counter
+
+
+def share_model():
+    """
+    Loads the embedder of the served version and moves its weights to shared memory.
+    Called in the pre-fork master so that every worker maps the same pages.
+    """
+    hp, audio, embedder = load_model()
+    models = [embedder]
+    if os.path.isfile(voicefilter_checkpoint):
+        models.append(load_separator())
+    for model in models:
+        # mapped weights are shared through the page cache already
+        if getattr(model, 'mapped_from', None) is None:
+            model.share_memory()
+    return hp, audio, embedder
+
+
+def model_fingerprint(embedder_path, hp):
+    """
+    Identifies the d-vectors an embedder produces: a checksum of its weights and of the
+    mel settings, as for the d-vector cache. Galleries are only comparable with probes
+    embedded under the same fingerprint.
+    """
+    st = os.stat(embedder_path)
+    key = (os.path.realpath(embedder_path), st.st_size, st.st_mtime_ns,
+           json.dumps({'audio': hp.audio, 'embedder': hp.embedder}, sort_keys=True))
+    if key not in _fingerprints:
+        _fingerprints[key] = cache_key(embedder_path, hp)[:16]
+    return _fingerprints[key]
+
+
+def gallery_tag(embeddings_path):
+    """{'fingerprint', 'embedder', 'created'} of the embedder a gallery was built with, None if untagged."""
+    try:
+        with open(os.path.join(embeddings_path, GALLERY_TAG)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def tag_gallery(embeddings_path, fingerprint, embedder_path):
+    os.makedirs(embeddings_path, exist_ok=True)
+    path = os.path.join(embeddings_path, GALLERY_TAG)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump({'fingerprint': fingerprint, 'embedder': os.path.abspath(embedder_path),
+                   'created': time.time()}, fp, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_version():
+    """The version named by version_file, embedder.pt and embeddings/ (serial 0) when there is none."""
+    try:
+        with open(version_file) as fp:
+            meta = json.load(fp)
+    except FileNotFoundError:
+        return Version(0, None, embedder_checkpoint, embedding_folder)
+    return Version(*(meta[field] for field in Version._fields))
+
+
+def activate_version(fingerprint, embedder_path, embeddings_path):
+    """
+    Points every server at a new embedder and its gallery by rewriting version_file.
+    Each process switches once it has loaded both. Returns the new Version.
+    """
+    tag = gallery_tag(embeddings_path)
+    if tag is None or tag['fingerprint'] != fingerprint:
+        raise ValueError('{} was not built with embedder {}.'.format(embeddings_path, fingerprint))
+    with open(version_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        version = Version(read_version().serial + 1, fingerprint, os.path.abspath(embedder_path),
+                          os.path.abspath(embeddings_path))
+        tmp_path = '{}.tmp{}'.format(version_file, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(dict(version._asdict(), activated=time.time()), fp, indent=2)
+        os.replace(tmp_path, version_file)
+    return version
+
+
+def warm_version(version):
+    """
+    Loads the embedder and maps the gallery of a version. Raises ValueError when the
+    gallery was built with another embedder; an untagged gallery is only warned about.
+    """
+    with timed('version_warm'):
+        hp, _, _ = load_model(embedder_path=version.embedder)
+        fingerprint = model_fingerprint(version.embedder, hp)
+        if version.fingerprint is not None and version.fingerprint != fingerprint:
+            raise ValueError('{} changed after version {} was activated.'.format(version.embedder, version.serial))
+        tag = gallery_tag(version.gallery)
+        if tag is not None and tag['fingerprint'] != fingerprint:
+            if version.fingerprint is not None:
+                raise ValueError('{} was built with embedder {}, not {}.'.format(
+                    version.gallery, tag['fingerprint'], fingerprint))
+            print_log('Warning: {} was built with embedder {}, {} is {}. Run reembed.py.'.format(
+                version.gallery, tag['fingerprint'], version.embedder, fingerprint))
+        load_gallery(version.gallery)
+
+
+def current_version():
+    """
+    The version this process serves. Loaded on first use, then only changed by
+    refresh_version(), so a request that takes it once uses a matching embedder and gallery.
+    """
+    global _version
+    if _version is None:
+        with _version_lock:
+            if _version is None:
+                version = read_version()
+                warm_version(version)
+                _version = version
+    return _version
+
+
+def refresh_version():
+    """
+    Switches this process to the version in version_file once its embedder and gallery
+    are loaded, so no request waits for the swap. Requests already running finish on the
+    old version, which stays cached until the next swap. Returns True on a switch.
+    """
+    global _version, _retired
+    version = read_version()
+    if version == current_version():
+        return False
+    warm_version(version)
+    with _version_lock:
+        if _retired is not None:
+            evict_version(_retired, keep=(version, _version))
+        _retired, _version = _version, version
+    GALLERY_VERSION.set(version.serial)
+    print_log('Serving version {}: {} with gallery {}'.format(version.serial, version.embedder, version.gallery))
+    return True
+
+
+def evict_version(version, keep=()):
+    # a re-activation may point at the embedder or gallery of a kept version
+    if version.embedder not in [v.embedder for v in keep]:
+        with _model_lock:
+            _model_cache.pop((conf_path, version.embedder), None)
+    if version.gallery not in [v.gallery for v in keep]:
+        tenants = os.path.join(version.gallery, TENANT_FOLDER) + os.sep
+        evict_galleries(lambda path: path == version.gallery or path.startswith(tenants))
+
+
+def watch_version(interval=VERSION_POLL):
+    """
+    Starts the thread applying version swaps in this process. Called by every serving
+    process after it is forked, threads do not survive a fork.
+    """
+    global _watcher
+    if _watcher is not None and _watcher.is_alive():
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                refresh_version()
+            except Exception as error:
+                ERRORS.labels('version_swap').inc()
+                print_log('Version swap failed: {}'.format(repr(error)))
+
+    GALLERY_VERSION.set(current_version().serial)
+    _watcher = threading.Thread(target=run, name='version-watcher', daemon=True)
+    _watcher.start()
+
+
+def serving_gallery(embeddings_path=None):
+    return current_version().gallery if embeddings_path is None else embeddings_path
+
+
+def tenant_path(root, tenant=None):
+    """
+    The folder of a tenant under a gallery or the enrollment store, root itself for the
+    default tenant. A tenant only ever sees and scans its own speakers.
+    """
+    if not tenant or tenant == DEFAULT_TENANT:
+        return root
+    if tenant.startswith('.') or tenant.endswith('_snapshot') or os.sep in tenant:
+        raise ValueError('Invalid tenant name: {!r}.'.format(tenant))
+    return os.path.join(root, TENANT_FOLDER, tenant)
+
+
+def speaker_name(spk_name):
+    """
+    spk_name if it can name a gallery file and an enrollment folder: not empty, no path
+    separator and no leading '.', which also rules out '..' and the store's own files.
+    """
+    if not isinstance(spk_name, str) or not spk_name or spk_name.startswith('.') or os.sep in spk_name \
+            or (os.altsep and os.altsep in spk_name):
+        raise ValueError('Invalid speaker name: {!r}.'.format(spk_name))
+    return spk_name
+
+
+def tenant_names(root):
+    """The tenants with a folder under a gallery or the enrollment store."""
+    folder = os.path.join(root, TENANT_FOLDER)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(x for x in os.listdir(folder)
+                  if os.path.isdir(os.path.join(folder, x)) and not x.startswith('.') and not x.endswith('_snapshot'))
+
+
+def tenant_of(embeddings_path):
+    parent, name = os.path.split(os.path.normpath(embeddings_path))
+    return name if os.path.basename(parent) == TENANT_FOLDER else DEFAULT_TENANT
+
+
+def load_version(version=None, tenant=None):
+    """
+    (hp, audio, embedder, names, matrix) of one version, the served one by default,
+    with the gallery of `tenant`. Embedder and gallery always match, even across a swap.
+    """
+    version = version or current_version()
+    hp, audio, embedder = load_model(embedder_path=version.embedder)
+    names, matrix = load_gallery(tenant_path(version.gallery, tenant))
+    return hp, audio, embedder, names, matrix
+
+
+def gallery_snapshot_dir(embeddings_path):
+    # kept outside the gallery folder so writing it does not change the generation
+    return os.path.normpath(embeddings_path) + '_snapshot'
+
+
+def build_gallery_snapshot(embeddings_path, base):
+    names, matrix = stack_embeddings(load_embeddings(embeddings_path))
+    with open(base + '.npy.tmp', 'wb') as fp:
+        np.save(fp, matrix.numpy().astype(np.float32))
+    os.replace(base + '.npy.tmp', base + '.npy')
+    # the names file is written last and marks the snapshot as complete
+    with open(base + '.json.tmp', 'w') as fp:
+        json.dump({'names': names}, fp)
+    os.replace(base + '.json.tmp', base + '.json')
+    for old in glob.glob(os.path.join(os.path.dirname(base), 'gallery-*')):
+        if old not in (base + '.npy', base + '.json'):
+            os.remove(old)
+
+
+def map_gallery(embeddings_path, generation):
+    """
+    Returns (names, matrix) for one gallery generation, the matrix being a
+    read-only memory map of a snapshot file shared by every process. The first
+    process to see a new generation builds the snapshot under a file lock.
+    """
+    snapshot_dir = gallery_snapshot_dir(embeddings_path)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    base = os.path.join(snapshot_dir, 'gallery-{}-{}'.format(*generation))
+    if not os.path.isfile(base + '.json'):
+        with open(os.path.join(snapshot_dir, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(base + '.json'):
+                build_gallery_snapshot(embeddings_path, base)
+
+    with open(base + '.json') as fp:
+        names = json.load(fp)['names']
+    if len(names) == 0:
+        return names, torch.zeros(0, 0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # read-only map, never written through
+        matrix = torch.from_numpy(np.load(base + '.npy', mmap_mode='r'))
+    return names, matrix
+
+
+def gallery_bytes(names, matrix):
+    # the mapped matrix and the names that come with it
+    return matrix.numel() * matrix.element_size() + sys.getsizeof(names) + sum(sys.getsizeof(n) for n in names)
+
+
+def cache_gallery(embeddings_path, generation, names, matrix):
+    """
+    Keeps a mapped gallery, unmapping the least recently used others while the total
+    exceeds GALLERY_CACHE_BYTES. An evicted gallery is mapped again from its snapshot.
+    """
+    global _gallery_bytes
+    size = gallery_bytes(names, matrix)
+    with _gallery_lock:
+        cached = _gallery_cache.get(embeddings_path)
+        if cached is not None and cached[0] > generation:
+            return  # a newer generation was mapped meanwhile
+        if cached is not None:
+            _gallery_bytes -= _gallery_cache.pop(embeddings_path)[3]
+        _gallery_cache[embeddings_path] = (generation, names, matrix, size)
+        _gallery_bytes += size
+        while _gallery_bytes > GALLERY_CACHE_BYTES and len(_gallery_cache) > 1:
+            path, evicted = _gallery_cache.popitem(last=False)
+            _gallery_bytes -= evicted[3]
+            GALLERY_EVICTIONS.labels(tenant_of(path)).inc()
+        GALLERY_CACHE_SIZE.set(_gallery_bytes)
+
+
+def evict_galleries(match):
+    global _gallery_bytes
+    with _gallery_lock:
+        for path in [path for path in _gallery_cache if match(path)]:
+            _gallery_bytes -= _gallery_cache.pop(path)[3]
+        GALLERY_CACHE_SIZE.set(_gallery_bytes)
+
+
+def load_gallery(embeddings_path=None):
+    """
+    Returns (names, matrix) for every enrolled speaker, by default of the served
+    version. The matrix is a shared memory map, mapped on first use and remapped by
+    every process on its first call after the gallery generation changes or after
+    the gallery was evicted from the per-process LRU.
+    """
+    embeddings_path = serving_gallery(embeddings_path)
+    tenant = tenant_of(embeddings_path)
+    if not os.path.isdir(embeddings_path):
+        return [], torch.zeros(0, 0)  # a tenant nobody enrolled in yet
+    for attempt in range(3):
+        generation = gallery_generation(embeddings_path)
+        with _gallery_lock:
+            cached = _gallery_cache.get(embeddings_path)
+            if cached is not None and cached[0] == generation:
+                _gallery_cache.move_to_end(embeddings_path)
+                GALLERY_LOOKUPS.labels(tenant, 'hit').inc()
+                return cached[1], cached[2]
+        # mapped outside the lock, a cold tenant must not stall the others
+        start = time.perf_counter()
+        try:
+            with timed('gallery_load'):
+                names, matrix = map_gallery(embeddings_path, generation)
+        except FileNotFoundError:
+            continue  # superseded by a newer generation while mapping
+        GALLERY_LOOKUPS.labels(tenant, 'miss').inc()
+        GALLERY_LOAD_SECONDS.labels(tenant).observe(time.perf_counter() - start)
+        cache_gallery(embeddings_path, generation, names, matrix)
+        return names, matrix
+    return stack_embeddings(load_embeddings(embeddings_path))
+
+
+def score_gallery(test_embeddings, matrix):
+    """
+    Cosine similarity of (B, emb_dim) probes against the (N, emb_dim) gallery.
+    Returns a (B, N) tensor.
+    """
+    with torch.no_grad(), timed('scoring'):
+        return torch.mm(F.normalize(test_embeddings, p=2, dim=1), matrix.t())
+
+
+def score_speaker(test_embeddings, templates, fusion='max'):
+    """
+    Cosine similarity of (B, emb_dim) probes to the (T, emb_dim) templates of one speaker,
+    in one product, fused over the templates. Returns a (B,) tensor.
+    """
+    with torch.no_grad(), timed('scoring'):
+        return fuse_scores(torch.mm(F.normalize(test_embeddings, p=2, dim=1), templates.t()), fusion)
+
+
+def load_speaker(spk_name, embeddings_path=None):
+    """
+    (T, emb_dim) unit-norm templates of one speaker, read by key, or None if not enrolled.
+    Cached per process until the file is replaced, so a verification never reads the
+    rest of the gallery and costs the same however many speakers are enrolled.
+    """
+    path = os.path.join(serving_gallery(embeddings_path), "{}.pth".format(speaker_name(spk_name)))
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _speaker_lock:
+        cached = _speaker_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            _speaker_cache.move_to_end(path)
+            return cached[1]
+    try:
+        with timed('speaker_load'):
+            templates = speaker_templates(torch.load(path, map_location=torch.device('cpu')))[1]
+    except FileNotFoundError:
+        return None  # removed meanwhile
+    templates = F.normalize(templates, p=2, dim=1)
+    with _speaker_lock:
+        _speaker_cache[path] = (stamp, templates)
+        _speaker_cache.move_to_end(path)
+        while len(_speaker_cache) > SPEAKER_CACHE_SIZE:
+            _speaker_cache.popitem(last=False)
+    return templates
+
+
+def load_embedding(spk_name, embeddings_path=None):
+    """
+    An enrolled (emb_dim,) d-vector of one speaker as the embedder produced it: the
+    default channel's template, or the first one.
+    """
+    path = os.path.join(serving_gallery(embeddings_path), "{}.pth".format(speaker_name(spk_name)))
+    channels, templates = speaker_templates(torch.load(path, map_location=torch.device('cpu')))
+    return templates[channels.index(DEFAULT_CHANNEL) if DEFAULT_CHANNEL in channels else 0].view(-1)
+
+
+def save_embedding(embedding, path, bump=True):
+    # write-then-rename so concurrent readers never see a partial file
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    torch.save(embedding, tmp_path)
+    os.replace(tmp_path, path)
+    if bump:
+        bump_generation(os.path.dirname(path))
+
+
+def delete_embedding(spk_name, embeddings_path=None):
+    embeddings_path = serving_gallery(embeddings_path)
+    os.remove(os.path.join(embeddings_path, "{}.pth".format(speaker_name(spk_name))))
+    bump_generation(embeddings_path)
+
+
+def store_enrollment(spk_name, wav=None, files=(), channel=DEFAULT_CHANNEL, tenant=None):
+    """
+    Replaces the enrollment audio kept for one channel of spk_name in enrollment_folder
+    (<speaker>/<channel>/, under .tenants/<tenant>/ for a tenant): the decoded clip of an
+    API enrollment or the source files of a bulk one. A gallery for another embedder is
+    rebuilt from it (reembed.py). Returns the channel's folder.
+    """
+    speaker_name(spk_name)
+    if not channel or channel.startswith('.') or os.sep in channel:
+        raise ValueError('Invalid channel name: {!r}.'.format(channel))
+    store = tenant_path(enrollment_folder, tenant)
+    spk_dir = os.path.join(store, spk_name)
+    target = os.path.join(spk_dir, channel)
+    os.makedirs(store, exist_ok=True)
+    tmp_dir = os.path.join(store, '.{}.{}.tmp{}'.format(spk_name, channel, os.getpid()))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    if wav is not None and not stream2wavfile_int16(float2pcm(wav), os.path.join(tmp_dir, ENROLLMENT_WAV)):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise IOError('Could not write the enrollment audio of {}.'.format(spk_name))
+    for i, path in enumerate(files):
+        shutil.copy2(path, os.path.join(tmp_dir, '{:04d}_{}'.format(i, os.path.basename(path))))
+    os.makedirs(spk_dir, exist_ok=True)
+    if channel == DEFAULT_CHANNEL:
+        # audio stored directly under the speaker folder, before channels, belongs to the default one
+        for name in os.listdir(spk_dir):
+            if stored_audio(name) and os.path.isfile(os.path.join(spk_dir, name)):
+                os.remove(os.path.join(spk_dir, name))
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp_dir, target)
+    return target
+
+
+def stored_audio(name):
+    """Whether a file name is one store_enrollment writes: the API clip or a numbered bulk copy."""
+    return name == ENROLLMENT_WAV or (len(name) > 5 and name[:4].isdigit() and name[4] == '_')
+
+
+def enrolled_channels(spk_name, embeddings_path=None):
+    """Channels of the templates a speaker has, [] if not enrolled."""
+    path = os.path.join(serving_gallery(embeddings_path), "{}.pth".format(speaker_name(spk_name)))
+    try:
+        return speaker_templates(torch.load(path, map_location=torch.device('cpu')))[0]
+    except FileNotFoundError:
+        return []
+
+
+def delete_enrollment(spk_name, tenant=None):
+    shutil.rmtree(os.path.join(tenant_path(enrollment_folder, tenant), speaker_name(spk_name)), ignore_errors=True)
+
+
 def enroll(spk_path, audio, embedder, embeddings_path):
     """
     Takes the path to all the files to enroll.
@@ -55,47 +742,33 @@ def enroll(spk_path, audio, embedder, embeddings_path):
 
     if not os.path.exists(embeddings_path):
         os.makedirs(embeddings_path)
-        print("Created directory: {}".format(embeddings_path))
+        print_log("Created directory: {}".format(embeddings_path))
 
     basename = os.path.basename(spk_path)
-    spk_id = os.path.splitext(basename)[0]
+    spk_id = speaker_name(os.path.splitext(basename)[0])
 
     embedding = get_embeddings(spk_path, audio, embedder)
 
     path = os.path.join(embeddings_path, spk_id + '.pth')
-    torch.save(embedding, path)
+    save_embedding(merge_templates(path, [DEFAULT_CHANNEL], embedding), path)
 
-    print("Spk: {} aggregated".format(spk_id))
+    print_log("Spk: {} aggregated".format(spk_id))
 
     return path, embedding
 
 
 def extract_feature(spk_filepath):
     if not os.path.exists(spk_filepath):
-        print("No such file: {}".format(spk_filepath))
+        print_log("No such file: {}".format(spk_filepath))
         return ""
 
-    conf_file = os.path.join(cur_dir, "config", "default.yaml")
-    embeddings_path = os.path.join(cur_dir, "embeddings")
+    version = current_version()
+    embeddings_path = version.gallery
     os.makedirs(embeddings_path, exist_ok=True)
 
-    embedder_path = os.path.join(cur_dir, "embedder.pt")
-    hp = HParam(conf_file)
+    hp, audio, embedder = load_model(embedder_path=version.embedder)
 
     with torch.no_grad():
-        # Load model
-        embedder = SpeechEmbedder(hp)
-        if torch.cuda.is_available():
-            chkpt_embed = torch.load(embedder_path)
-        else:
-            chkpt_embed = torch.load(embedder_path, map_location=torch.device('cpu'))
-        embedder.load_state_dict(chkpt_embed)
-        embedder.eval()
-        print("Embedder loaded.")
-
-        # Create an audio object
-        audio = Audio(hp)
-
         # Get the embeddings (if embeddings_path exists it will load the file with the embeddings
         # and if it's not it will get the embeddings of spk_path)
         pth_path, pth_data = enroll(spk_filepath, audio, embedder, embeddings_path)
@@ -103,41 +776,55 @@ def extract_feature(spk_filepath):
         return pth_path
 
 
-def audio_authentication(test_audio_path, embeddings, threshold=0.84):
-    conf_file = os.path.join(cur_dir, "config", "default.yaml")
-    embedder_path = os.path.join(cur_dir, "embedder.pt")
-    hp = HParam(conf_file)
-    with torch.no_grad():
-        # Load model
-        embedder = SpeechEmbedder(hp)
-        if torch.cuda.is_available():
-            chkpt_embed = torch.load(embedder_path)
-        else:
-            chkpt_embed = torch.load(embedder_path, map_location=torch.device('cpu'))
-        embedder.load_state_dict(chkpt_embed)
-        embedder.eval()
-    audio = Audio(hp)
-    test_embedding = get_embeddings(test_audio_path, audio, embedder)
-    max_score = -10 ** 8
-    best_spk = None
-    spk_score = {}
-
-    for spk in embeddings:
-        score = F.cosine_similarity(test_embedding, embeddings[spk])
-        score = score.data.numpy()
-        spk_score[os.path.splitext(spk)[0]] = score
-        if score > max_score:
-            max_score = score
-            best_spk = spk
+def enroll_wavs(wavs, spk_names, version=None, channel=DEFAULT_CHANNEL, tenant=None):
+    """
+    Enrolls decoded waveforms in one batched embedder pass, with the embedder and into
+    the gallery of `version` (the served one by default) or of one of its tenants. Each
+    replaces the speaker's template for `channel` and keeps the others.
+    Returns the list of written .pth paths.
+    """
+    for spk_name in spk_names:
+        speaker_name(spk_name)
+    version = version or current_version()
+    hp, audio, embedder = load_model(embedder_path=version.embedder)
+    if gallery_tag(version.gallery) is None:
+        tag_gallery(version.gallery, model_fingerprint(version.embedder, hp), version.embedder)
+    gallery = tenant_path(version.gallery, tenant)
+    os.makedirs(gallery, exist_ok=True)
+    dvecs = get_embeddings_batch(wavs, audio, embedder)
+    paths = []
+    for spk_name, dvec in zip(spk_names, dvecs):
+        path = os.path.join(gallery, spk_name + '.pth')
+        save_embedding(merge_templates(path, [channel], dvec.unsqueeze(0)), path)
+        print_log("Spk: {} aggregated".format(spk_name))
+        paths.append(path)
+    return paths
+
+
+def decide(names, scores, threshold=0.84):
+    """
+    Picks the best speaker from one row of gallery scores.
+    Returns (score, best_spk, result, spk_score) like audio_authentication.
+    """
+    scores = scores.data.numpy()
+    best = int(np.argmax(scores))
+    max_score = scores[best:best + 1]
+    spk_score = {spk: scores[i:i + 1] for i, spk in enumerate(names)}
 
     if max_score < threshold:
         result = 'Rejected'
     else:
         result = 'Accepted'
+    return max_score, names[best], result, spk_score
+
 
-    best_spk = os.path.splitext(best_spk)[0]
-    score = max_score
-    return score, best_spk, result, spk_score
+def audio_authentication(test_audio_path, embeddings, threshold=0.84):
+    hp, audio, embedder = load_model()
+    with torch.no_grad():
+        test_embedding = get_embeddings(test_audio_path, audio, embedder)
+    names, matrix = stack_embeddings(embeddings)
+    scores = score_gallery(test_embedding, matrix)[0]
+    return decide(names, scores, threshold)
 
 
 def pcm2float(sig, dtype='float64'):
@@ -154,9 +841,24 @@ def pcm2float(sig, dtype='float64'):
     return (sig.astype(dtype) - offset) / abs_max
 
 
+def float2pcm(sig, dtype='int16'):
+    sig = np.asarray(sig)
+    if sig.dtype.kind != 'f':
+        raise TypeError("'sig' must be a float array")
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iu':
+        raise TypeError("'dtype' must be an integer type")
+
+    i = np.iinfo(dtype)
+    abs_max = 2 ** (i.bits - 1)
+    offset = i.min + abs_max
+    return (sig * abs_max + offset).clip(i.min, i.max).astype(dtype)
+
+
 def stream2wavfile(byte_stream, audio_file):
     try:
         # dvec_wav = pcm2float(np.frombuffer(byte_stream, dtype=np.int16), dtype='float32')
+        import librosa
         librosa.output.write_wav(audio_file, np.ndarray(byte_stream), 16000)
         if os.path.isfile(audio_file):
             return True
@@ -167,6 +869,7 @@ def stream2wavfile(byte_stream, audio_file):
 
 def stream2wavfile_int16(int_array, audio_file):
     try:
+        from scipy.io.wavfile import write
         write(audio_file, 16000, np.asarray(int_array).astype(np.int16))
         return True
     except Exception as error:
@@ -177,44 +880,8 @@ def stream2wavfile_int16(int_array, audio_file):
 def stream_auth(byte_stream, threshold=0.84):
     dvec_wav = pcm2float(np.frombuffer(byte_stream, dtype=np.int16), dtype='float32')
 
-    embedding_path = os.path.join(cur_dir, 'embeddings/')
-    embeddings = load_embeddings(embedding_path)
-    conf_file = os.path.join(cur_dir, "config", "default.yaml")
-    embedder_path = os.path.join(cur_dir, "embedder.pt")
-    hp = HParam(conf_file)
-    with torch.no_grad():
-        # Load model
-        embedder = SpeechEmbedder(hp)
-        if torch.cuda.is_available():
-            chkpt_embed = torch.load(embedder_path)
-        else:
-            chkpt_embed = torch.load(embedder_path, map_location=torch.device('cpu'))
-        embedder.load_state_dict(chkpt_embed)
-        embedder.eval()
-    audio = Audio(hp)
-
-    dvec_mel = audio.get_mel(dvec_wav)
-    dvec_mel = torch.from_numpy(dvec_mel).float()
-    dvec = embedder(dvec_mel)
-    test_embedding = dvec.unsqueeze(0)
-
-    max_score = -10 ** 8
-    best_spk = None
-    spk_score = {}
-
-    for spk in embeddings:
-        score = F.cosine_similarity(test_embedding, embeddings[spk])
-        score = score.data.numpy()
-        spk_score[os.path.splitext(spk)[0]] = score
-        if score > max_score:
-            max_score = score
-            best_spk = spk
-
-    if max_score < threshold:
-        result = 'Rejected'
-    else:
-        result = 'Accepted'
+    hp, audio, embedder, names, matrix = load_version()
 
-    best_spk = os.path.splitext(best_spk)[0]
-    score = max_score
-    return score, best_spk, result, spk_score
+    test_embedding = get_embeddings_batch([dvec_wav], audio, embedder)
+    scores = score_gallery(test_embedding, matrix)[0]
+    return decide(names, scores, threshold)
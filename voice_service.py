@@ -2,14 +2,57 @@ import os
 import json
 import contextlib
 import wave
-import shutil
-from webrtcvad import Vad
-from voice_authentication import extract_feature, load_embeddings, \
-    audio_authentication, embedding_folder
+import hashlib
+import subprocess
+import threading
+from collections import OrderedDict
+import numpy as np
+from voice_authentication import load_model, load_gallery, load_version, current_version, \
+    get_embeddings_batch, score_gallery, enroll_wavs, decide, min_samples, SAMPLE_RATE, \
+    pcm2float, float2pcm, print_log, gallery_generation, delete_embedding, load_separator, load_embedding, \
+    store_enrollment, delete_enrollment, load_speaker, score_speaker, enrolled_channels, DEFAULT_CHANNEL, \
+    MAX_TEMPLATES, tenant_path, DEFAULT_TENANT, speaker_name
+from utils.stream import WindowEmbeddingStream, SequentialVerifier
+from utils.vad import StreamingVad
+from utils.cache import DecisionCache
+from utils.separation import ChunkedSeparator
+from utils.metrics import timed, count_decision, ERRORS, REAL_TIME_FACTOR
 
 UPLOAD_FOLDER = os.path.join('.', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+THRESHOLD = 0.84
+# verification scores only the claimed speaker's templates, fused with 'max' (best channel) or 'mean'
+VERIFY_FUSION = 'max'
+DECODE_CHUNK = 64 * 1024
+
+# sequential verification bounds
+SEQ_MIN_DURATION = 1.0  # never decide on less audio (seconds)
+SEQ_MAX_DURATION = 7.0  # always decide after this much audio (seconds)
+SEQ_Z = 2.0  # width of the confidence band in standard errors
+
+# speech gate applied before mel/embedding
+VAD_ENABLED = True
+VAD_MODE = 3  # webrtcvad aggressiveness
+VAD_ENERGY_FLOOR = -55.0  # dBFS, quieter frames skip webrtcvad
+VAD_HANGOVER = 0.1  # seconds kept after each speech frame
+
+# who-spoke-when
+TIMELINE_GAP = 0.3  # VAD segments closer than this are one segment (seconds)
+TIMELINE_PIECE = 2.0  # long segments are embedded in pieces of this length (seconds)
+TIMELINE_MERGE_GAP = 1.0  # same-speaker turns closer than this are merged (seconds)
+
+# target-speaker separation (VoiceFilter)
+SEPARATION_CHUNK = 3.0  # seconds per chunk, the training length
+SEPARATION_OVERLAP = 0.5  # seconds shared by consecutive chunks
+SEPARATION_BATCH = 8  # chunks per model forward
+SEPARATE_BEFORE_VERIFY = False  # default of the 'separate' field of verify requests
+
+RESULT_CACHE_SIZE = 4096  # responses kept per process and tenant
+RESULT_CACHE_TENANTS = 256  # tenants with a result cache per process, the least recently used is dropped
+_result_lock = threading.Lock()
+_result_caches = OrderedDict()
+
 
 def trim_audio_ffmpeg(src_file, start_tm, end_tm, dst_file):
     if not os.path.exists(src_file):
@@ -23,10 +66,51 @@ def trim_audio_ffmpeg(src_file, start_tm, end_tm, dst_file):
         os.system(cmd)
         return True
     except Exception as error:
-        print('Error: {}'.format(repr(error)))
+        print_log('Error: {}'.format(repr(error)))
         return False
 
 
+def decode_audio(stream):
+    """
+    Decodes any ffmpeg-readable audio from a file-like object to 16 kHz mono float32.
+    The input is piped to ffmpeg chunk by chunk, so the upload is never buffered whole.
+    """
+    with timed('ffmpeg'):
+        return _decode_audio(stream)
+
+
+def _decode_audio(stream):
+    proc = subprocess.Popen(['ffmpeg', '-i', 'pipe:0', '-f', 's16le', '-acodec', 'pcm_s16le',
+                             '-ac', '1', '-ar', str(SAMPLE_RATE), 'pipe:1', '-loglevel', 'panic'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            while True:
+                chunk = stream.read(DECODE_CHUNK)
+                if not chunk:
+                    break
+                proc.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            proc.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    pcm = proc.stdout.read()
+    feeder.join()
+    proc.wait()
+    if proc.returncode != 0:
+        raise ValueError('Could not decode audio data.')
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def decode_audio_file(audio_file):
+    with open(audio_file, 'rb') as fp:
+        return decode_audio(fp)
+
+
 def read_wave(path):
     """Reads a .wav file.
     Takes the path, and returns (PCM audio data, sample rate).
@@ -42,28 +126,24 @@ def read_wave(path):
         return pcm_data, sample_rate
 
 
-class Frame(object):
-    """Represents a "frame" of audio data."""
-    def __init__(self, bytes, timestamp, duration):
-        self.bytes = bytes
-        self.timestamp = timestamp
-        self.duration = duration
+def speech_vad(energy_floor=VAD_ENERGY_FLOOR, hangover=VAD_HANGOVER):
+    return StreamingVad(SAMPLE_RATE, mode=VAD_MODE, energy_floor=energy_floor, hangover=hangover)
 
 
-def frame_generator(frame_duration_ms, audio, sample_rate):
-    """Generates audio frames from PCM audio data.
-    Takes the desired frame duration in milliseconds, the PCM data, and
-    the sample rate.
-    Yields Frames of the requested duration.
+def gate_speech(wav):
     """
-    n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
-    offset = 0
-    timestamp = 0.0
-    duration = (float(n) / sample_rate) / 2.0
-    while offset + n < len(audio):
-        yield Frame(audio[offset:offset + n], timestamp, duration)
-        timestamp += duration
-        offset += n
+    Drops the non-speech frames of a decoded waveform before it reaches the embedder.
+    Returns (speech waveform, vad stats).
+    """
+    if not VAD_ENABLED:
+        return wav, None
+    vad = speech_vad()
+    with timed('vad'):
+        speech = pcm2float(vad.gate(float2pcm(wav)), dtype='float32')
+    stats = vad.stats()
+    print_log('VAD: {:.2f}s of {:.2f}s kept ({:.0%} skipped)'.format(
+        stats['speech'], stats['total'], stats['skipped']))
+    return speech, stats
 
 
 def vad_audio_segment(audio_file, gap_size=0.5, frame_duration=10):
@@ -73,37 +153,61 @@ def vad_audio_segment(audio_file, gap_size=0.5, frame_duration=10):
     :param frame_duration: frame step (milli seconds)
     :return:
     """
-    vad = Vad(3)
-
     audio, sample_rate = read_wave(audio_file)
-    frames = frame_generator(frame_duration, audio, sample_rate)
-    frames = list(frames)
-
-    vad_segment = []
-    for i, frame in enumerate(frames):
-        is_speech = vad.is_speech(frame.bytes, sample_rate)
-        if is_speech:
-            vad_segment.append([frame.timestamp, frame.timestamp+frame.duration])
-
-    if len(vad_segment) == 0:
-        return []
-    audio_segment = [vad_segment[0]]
-    for x in vad_segment[1:]:
-        if x[0] <= audio_segment[-1][1] + gap_size:
-            audio_segment[-1][1] = x[1]
-        else:
-            audio_segment.append(x)
+    vad = StreamingVad(sample_rate, frame_duration=frame_duration, mode=VAD_MODE)
+    return vad.segments(np.frombuffer(audio, dtype=np.int16), gap_size)
+
+
+def audio_fingerprint(wav):
+    return hashlib.blake2b(np.ascontiguousarray(wav).tobytes(), digest_size=16).hexdigest()
 
-    return audio_segment
 
+def decision_key(wav, task, spk_name, threshold=THRESHOLD):
+    # every answer but the timeline's names the caller's spk_name in its message
+    return audio_fingerprint(wav), task, spk_name, threshold
 
-def voice_database():
+
+def tenant_gallery(tenant=None, version=None):
+    return tenant_path((version or current_version()).gallery, tenant)
+
+
+def serving_generation(version=None, tenant=None):
+    # a swap restarts the gallery counter, the version serial keeps the order
+    version = version or current_version()
+    return (version.serial,) + gallery_generation(tenant_gallery(tenant, version))
+
+
+def result_cache(tenant=None):
+    """The DecisionCache of a tenant, the generations of two galleries do not compare."""
+    tenant = tenant or DEFAULT_TENANT
+    with _result_lock:
+        cache = _result_caches.get(tenant)
+        if cache is None:
+            cache = _result_caches[tenant] = DecisionCache(RESULT_CACHE_SIZE)
+        _result_caches.move_to_end(tenant)
+        while len(_result_caches) > RESULT_CACHE_TENANTS:
+            _result_caches.popitem(last=False)
+    return cache
+
+
+def cached_decision(wav, task, spk_name, compute, tenant=None):
+    """
+    Serves a repeated request on the same audio from the tenant's result cache. Entries
+    are dropped as soon as the gallery generation changes (any enroll/remove or version
+    swap), and concurrent identical requests share one computation.
+    """
+    return result_cache(tenant).get_or_compute(decision_key(wav, task, spk_name),
+                                               serving_generation(tenant=tenant), compute)
+
+
+def voice_database(tenant=None):
     response_data = {
         'status': 'false',
         'task': 'get_voice_list'
     }
     try:
-        embedding_list = [x for x in os.listdir(embedding_folder) if x.endswith(".pth")]
+        gallery = tenant_gallery(tenant)
+        embedding_list = [x for x in os.listdir(gallery) if x.endswith(".pth")] if os.path.isdir(gallery) else []
         speaker_name_list = [x[:-4] for x in embedding_list]
         response_data["status"] = "true"
         response_data["message"] = speaker_name_list
@@ -114,120 +218,455 @@ def voice_database():
     return response
 
 
-def enroll_voice(audio_file, spk_name):
+def enroll_voice(audio_file, spk_name, channel=DEFAULT_CHANNEL, tenant=None):
+    print_log("Enroll request ...")
+    try:
+        wav = decode_audio_file(audio_file)
+    except Exception as error:
+        ERRORS.labels('decode').inc()
+        return json.dumps({
+            "status": "fail",
+            "task": "enroll",
+            "message": repr(error)
+        }, indent=2)
+    return enroll_voices([wav], [spk_name], channel, tenant)
+
+
+def enroll_voices(wavs, spk_names, channel=DEFAULT_CHANNEL, tenant=None):
+    """
+    Enrolls several decoded clips with one batched embedder pass. Each becomes the
+    speaker's template for `channel` (device, microphone, ...), other channels are kept.
+    """
     response_data = {
         "status": "fail",
         "task": "enroll",
         "message": "Invalid payload."
     }
+    version = current_version()
+    hp, _, _ = load_model(embedder_path=version.embedder)
+    gated = [gate_speech(wav)[0] for wav in wavs]
+    short = [spk for wav, spk in zip(gated, spk_names) if len(wav) < min_samples(hp)]
+    channels = {spk: enrolled_channels(spk, tenant_gallery(tenant, version)) for spk in set(spk_names)}
+    full = sorted(spk for spk, names in channels.items() if channel not in names and len(names) >= MAX_TEMPLATES)
+    if len(wavs) == 0 or short or full:
+        if short:
+            response_data["message"] = "Audio too short: {}.".format(', '.join(short))
+        elif full:
+            response_data["message"] = "Already {} templates: {}.".format(MAX_TEMPLATES, ', '.join(full))
+        return json.dumps(response_data, indent=2)
+
+    # the audio is kept before the .pth is written, so a re-embedding never misses a speaker
+    for wav, spk_name in zip(wavs, spk_names):
+        store_enrollment(spk_name, wav=wav, channel=channel, tenant=tenant)
+    enroll_wavs(gated, spk_names, version, channel, tenant)
+    response_data["status"] = 'success'
+    response_data["message"] = 'Voice has successfully registered with name: {}.'.format(
+        ', '.join(spk_names)
+    )
+    return json.dumps(response_data, indent=2)
 
-    print("Enroll request ...")
-    pth_path = extract_feature(audio_file)
-    if os.path.isfile(pth_path):
-        response_data["status"] = 'success'
-        response_data["message"] = 'Voice has successfully registered with name: {}.'.format(
-            spk_name
-        )
-    response = json.dumps(response_data, indent=2)
-    return response
 
+def verify_result(spk_name, score, threshold=THRESHOLD):
+    """
+    Builds the verify response from the fused score of the claimed speaker (None if not registered).
+    """
+    result_json = {
+        'status': 'false',
+        'task': 'verify',
+        'spk_name': spk_name,
+        'confidence': 0,
+        'message': 'not registered.'
+    }
+    if score is None:
+        return result_json
+    result_json['confidence'] = score
+    if score >= threshold:
+        result_json['status'] = 'true'
+        result_json['message'] = '{} verified as score {}.'.format(spk_name, score)
+    else:
+        result_json['message'] = '{} not verified as score {}.'.format(spk_name, score)
+    return result_json
+
+
+def build_auth_result(task, spk_name, names, scores, threshold=THRESHOLD):
+    """
+    Builds the identify response for one row of gallery scores (one per template).
+    """
+    result_json = {
+        'status': 'false',
+        'task': task,
+        'message': 'Invalid payload.'
+    }
+    score, best_spk, result, spk_score = decide(names, scores, threshold)
+    result_json['spk_name'] = best_spk
+    result_json['confidence'] = score.item(0)
+    result_json['message'] = '{}: could not find any matches.(score: {:.3f})'.format(spk_name, score.item(0))
+    if result == 'Accepted':
+        result_json['status'] = 'true'
+        result_json['message'] = '{}: Found a match with score {:.3f}.'.format(spk_name, score.item(0))
+    return result_json
 
-def auth_voice(audio_file, task, spk_name):
-    print("Authentication request ...")
+
+def auth_voices(wavs, task, spk_names, tenant=None):
+    """
+    Verifies/identifies many decoded clips in one batch: a single embedder pass, then
+    each clip against its claimed speaker only (verify) or a single (clips x templates)
+    score matrix (identify) over the tenant's gallery.
+    """
+    response_data = {
+        'status': 'false',
+        'task': task,
+        'message': 'Invalid payload.'
+    }
+    version = current_version()
+    if task == 'verify':
+        hp, audio, embedder = load_model(embedder_path=version.embedder)
+        templates = {spk: load_speaker(spk, tenant_gallery(tenant, version)) for spk in set(spk_names)}
+    else:
+        hp, audio, embedder, names, matrix = load_version(version, tenant)
+        if len(names) == 0:
+            response_data["message"] = "Not registered any voice. Please enroll, first."
+            return json.dumps(response_data, indent=2)
+
+    cache = result_cache(tenant)
+    generation = serving_generation(version, tenant)
+    keys = [decision_key(wav, task, spk_name) for wav, spk_name in zip(wavs, spk_names)]
+    results = [cache.get(key, generation) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    gated = {i: gate_speech(wavs[i]) for i in missing}
+    for i in missing:
+        results[i] = {'status': 'false', 'task': task, 'message': 'Empty audio data.'}
+    valid = [i for i in missing if len(gated[i][0]) >= min_samples(hp)]
+    if task == 'verify':
+        for i in valid:
+            if templates[spk_names[i]] is None:
+                results[i] = verify_result(spk_names[i], None)
+        valid = [i for i in valid if templates[spk_names[i]] is not None]
+    if valid:
+        dvecs = get_embeddings_batch([gated[i][0] for i in valid], audio, embedder)
+        if task == 'verify':
+            for row, i in enumerate(valid):
+                score = score_speaker(dvecs[row:row + 1], templates[spk_names[i]], VERIFY_FUSION).item()
+                results[i] = verify_result(spk_names[i], score)
+                count_decision(results[i])
+        else:
+            scores = score_gallery(dvecs, matrix)
+            for row, i in enumerate(valid):
+                results[i] = build_auth_result(task, spk_names[i], names, scores[row])
+                count_decision(results[i])
+    for i in missing:
+        stats = gated[i][1]
+        if stats is not None:
+            results[i]['vad_skipped'] = stats['skipped']
+        cache.put(keys[i], generation, results[i])
+
+    response_data['status'] = 'true'
+    response_data['message'] = results
+    return json.dumps(response_data, indent=2)
+
+
+def identify_stream(stream, top_k=3, window=None, partial=True, vad=None, version=None, tenant=None):
+    """
+    Identifies the speaker of a live session from the window d-vectors its
+    WindowEmbeddingStream has already computed, pooled over the last `window`
+    seconds (the whole session if None). Nothing is re-embedded. `version` is the
+    one whose embedder the stream uses, the served one if None.
+    """
+    result_json = {
+        'status': 'false',
+        'task': 'identify',
+        'partial': partial,
+        'message': 'Invalid payload.'
+    }
+    names, matrix = load_gallery(tenant_gallery(tenant, version))
+    if len(names) == 0:
+        result_json["message"] = "Not registered any voice. Please enroll, first."
+        return json.dumps(result_json, indent=2)
+
+    last = None if window is None else max(1, int(round(window / stream.window_step)))
+    dvec = stream.embedding(last)
+    if dvec is None:
+        result_json["message"] = "Empty audio data."
+        return json.dumps(result_json, indent=2)
+
+    scores = score_gallery(dvec, matrix)[0]
+    result_json = build_auth_result('identify', '', names, scores)
+    # a speaker has up to MAX_TEMPLATES rows, ranked by the best one
+    values, indices = scores.topk(min(top_k * MAX_TEMPLATES, len(names)))
+    if not partial:
+        count_decision(result_json)
+    result_json['partial'] = partial
+    result_json['duration'] = stream.duration
+    result_json['top_k'] = []
+    for v, i in zip(values.tolist(), indices.tolist()):
+        if len(result_json['top_k']) == top_k:
+            break
+        if all(entry['spk_name'] != names[i] for entry in result_json['top_k']):
+            result_json['top_k'].append({'spk_name': names[i], 'confidence': v})
+    if vad is not None:
+        result_json['vad_skipped'] = vad.stats()['skipped']
+    return json.dumps(result_json, indent=2)
+
+
+def sequential_verifier(spk_name, threshold=THRESHOLD, min_duration=SEQ_MIN_DURATION,
+                        max_duration=SEQ_MAX_DURATION, z=SEQ_Z, version=None, tenant=None):
+    """
+    Returns a SequentialVerifier for an enrolled speaker, or None if not registered.
+    """
+    version = version or current_version()
+    templates = load_speaker(spk_name, tenant_gallery(tenant, version))
+    if templates is None:
+        return None
+    hp, _, _ = load_model(embedder_path=version.embedder)
+    return SequentialVerifier(hp, templates, threshold=threshold, min_duration=min_duration,
+                              max_duration=max_duration, z=z, fusion=VERIFY_FUSION)
+
+
+def sequential_result(verifier, spk_name, vad=None):
+    result_json = {
+        'status': 'false',
+        'task': 'verify',
+        'spk_name': spk_name,
+        'confidence': 0,
+        'message': 'not registered.'
+    }
+    if verifier is None:
+        return json.dumps(result_json, indent=2)
+    if verifier.score is None:
+        result_json['message'] = 'Empty audio data.'
+        return json.dumps(result_json, indent=2)
+
+    score = verifier.score
+    result_json['confidence'] = score
+    result_json['duration'] = verifier.duration
+    result_json['early_exit'] = verifier.early_exit
+    if vad is not None:
+        result_json['vad_skipped'] = vad.stats()['skipped']
+    if verifier.decision == 'Accepted':
+        result_json['status'] = 'true'
+        result_json['message'] = '{} verified as score {}.'.format(spk_name, score)
+    else:
+        result_json['message'] = '{} not verified as score {}.'.format(spk_name, score)
+    count_decision(result_json)
+    return json.dumps(result_json, indent=2)
+
+
+def verify_sequential(wav, spk_name, tenant=None, **kwargs):
+    """
+    Verifies a decoded waveform window by window, stopping at the first decisive
+    point instead of embedding the whole clip.
+    """
+    if kwargs:
+        return _verify_sequential(wav, spk_name, tenant, **kwargs)
+    return cached_decision(wav, 'verify_sequential', spk_name,
+                           lambda: _verify_sequential(wav, spk_name, tenant), tenant)
+
+
+def _verify_sequential(wav, spk_name, tenant=None, **kwargs):
+    version = current_version()
+    verifier = sequential_verifier(spk_name, version=version, tenant=tenant, **kwargs)
+    if verifier is None:
+        return sequential_result(verifier, spk_name)
+
+    hp, audio, embedder = load_model(embedder_path=version.embedder)
+    wav, _ = gate_speech(wav)
+    stream = WindowEmbeddingStream(hp, audio, embedder)
+    step = hp.embedder.stride * hp.audio.hop_length
+    for start in range(0, len(wav), step):
+        windows = stream.push(wav[start:start + step])
+        if verifier.update(windows, stream.duration) is not None:
+            break
+    verifier.finish()
+    return sequential_result(verifier, spk_name)
+
+
+def auth_voice(audio_file, task, spk_name, tenant=None):
+    print_log("Authentication request ...")
     result_json = {
         'status': 'false',
         'task': task,
         'message': 'Invalid payload.'
     }
 
-    # check if there's pre-registered embeddings.
-    embedding_list = [x for x in os.listdir(embedding_folder) if x.endswith(".pth")]
-    if len(embedding_list) == 0:
+    # check if there's pre-registered embeddings, a verification only reads the claimed speaker's
+    if task != 'verify' and len(load_gallery(tenant_gallery(tenant))[0]) == 0:
         result_json["message"] = "Not registered any voice. Please enroll, first."
         response = json.dumps(result_json, indent=2)
         return response
 
-    # convert uploaded audio to standard format
-    convert_audio_file = os.path.join(UPLOAD_FOLDER, os.path.basename(audio_file)[:-4]+"_convert.wav")
-    convert_cmd = "ffmpeg -i \"{}\" -acodec pcm_s16le -ac 1 -ar 16000 \"{}\" -y -loglevel panic".format(
-        audio_file,
-        convert_audio_file
-    )
+    # decode uploaded audio to 16 kHz mono
     try:
-        os.system(convert_cmd)
+        wav = decode_audio_file(audio_file)
     except Exception as error:
+        ERRORS.labels('decode').inc()
         result_json["message"] = repr(error)
         response = json.dumps(result_json, indent=2)
         return response
+
+    return auth_wav(wav, task, spk_name, tenant=tenant)
+
+
+def auth_wav(wav, task, spk_name, separate=False, tenant=None):
     """
-    # segmentation
-    segments = vad_audio_segment(convert_audio_file)
-    if len(segments) == 0:
+    Verifies/identifies one decoded 16 kHz waveform. With separate=True, a verification
+    first keeps only the claimed speaker's voice (VoiceFilter).
+    """
+    separation = None
+    if separate and task == 'verify' and is_enrolled(spk_name, tenant):
+        wav, separation = separate_wav(wav, spk_name, tenant)
+    result_json = cached_decision(wav, task, spk_name, lambda: auth_result(wav, task, spk_name, tenant), tenant)
+    if separation is not None:
+        result_json = dict(result_json, separation=separation)
+    response = json.dumps(result_json, indent=2)
+
+    return response
+
+
+def auth_result(wav, task, spk_name, tenant=None):
+    result_json = {
+        'status': 'false',
+        'task': task,
+        'message': 'Invalid payload.'
+    }
+    version = current_version()
+    if task == 'verify':
+        # only the claimed speaker's templates are read, whatever the size of the gallery
+        templates = load_speaker(spk_name, tenant_gallery(tenant, version))
+        if templates is None:
+            return verify_result(spk_name, None)
+        hp, audio, embedder = load_model(embedder_path=version.embedder)
+    else:
+        hp, audio, embedder, names, matrix = load_version(version, tenant)
+        if len(names) == 0:
+            result_json["message"] = "Not registered any voice. Please enroll, first."
+            return result_json
+
+    wav, stats = gate_speech(wav)
+    if len(wav) < min_samples(hp):
         result_json["message"] = "Empty audio data."
-        response = json.dumps(result_json, indent=2)
-        os.remove(convert_audio_file)
-        return response
+        return result_json
+
+    dvec = get_embeddings_batch([wav], audio, embedder)
+    if task == 'verify':
+        result_json = verify_result(spk_name, score_speaker(dvec, templates, VERIFY_FUSION).item())
+    else:
+        result_json = build_auth_result(task, spk_name, names, score_gallery(dvec, matrix)[0])
+    count_decision(result_json)
+    if stats is not None:
+        result_json['vad_skipped'] = stats['skipped']
+    return result_json
+
+
+def speaker_timeline(wav, threshold=THRESHOLD, tenant=None):
+    """
+    Who-spoke-when for a long multi-speaker recording. VAD segments are cut into
+    pieces as array views, all pieces are embedded in one batched pass and scored
+    against the gallery as one matrix product, and adjacent same-speaker pieces are
+    merged into turns. Pieces below threshold are labelled 'unknown'.
+    """
+    key = decision_key(wav, 'timeline', '', threshold)
+    return result_cache(tenant).get_or_compute(key, serving_generation(tenant=tenant),
+                                               lambda: _speaker_timeline(wav, threshold, tenant))
 
-    os.makedirs('tmp', exist_ok=True)
-    id_result = []
-    for i, seg in enumerate(segments):
-        stime, etime = seg
-        tmp_file = os.path.join('tmp', '{}.wav'.format(i+1))
-        if not trim_audio_ffmpeg(convert_audio_file, stime, etime, tmp_file):
-            continue
-
-        embeddings = load_embeddings()
-        score, spk, result, spk_score = audio_authentication(convert_audio_file, embeddings)
-
-        if task == "verify":
-            score = spk_score[spk_name].item(0)
-            if score >= 0.84:
-                trans_text = "Verified as {} with score {:.3f}".format(spk_name, score)
-            else:
-                trans_text = "Rejected as score {:.3f}".format(score)
-        else:  # "identify"
-            if result == 'Accepted':
-                trans_text = "Identified as {} with score {:.3f}".format(best_spk, score.item(0))
-            else:
-                trans_text = "Rejected as score {:.3f}".format(score.item(0))
-
-    shutil.rmtree('tmp', ignore_errors=True)
-    """
-
-    spk_pth = '{}.pth'.format(spk_name)
-
-    embeddings = load_embeddings()
-    score, best_spk, result, spk_score = audio_authentication(convert_audio_file, embeddings)
-
-    if task == "verify":
-        if spk_pth not in embedding_list:
-            result_json['spk_name'] = spk_name
-            result_json['confidence'] = 0
-            result_json['message'] = 'not registered.'
+
+def _speaker_timeline(wav, threshold=THRESHOLD, tenant=None):
+    result_json = {
+        'status': 'false',
+        'task': 'timeline',
+        'message': 'Invalid payload.'
+    }
+    hp, audio, embedder, names, matrix = load_version(tenant=tenant)
+    if len(names) == 0:
+        result_json["message"] = "Not registered any voice. Please enroll, first."
+        return json.dumps(result_json, indent=2)
+
+    vad = speech_vad()
+    segments = vad.segments(float2pcm(wav), TIMELINE_GAP)
+    piece_len = int(TIMELINE_PIECE * SAMPLE_RATE)
+    shortest = min_samples(hp)
+    bounds = []
+    for start_tm, end_tm in segments:
+        start, end = int(start_tm * SAMPLE_RATE), min(len(wav), int(end_tm * SAMPLE_RATE))
+        cuts = list(range(start, end, piece_len)) + [end]
+        if len(cuts) > 2 and cuts[-1] - cuts[-2] < shortest:
+            del cuts[-2]  # fold a short tail into the previous piece
+        bounds.extend((a, b) for a, b in zip(cuts[:-1], cuts[1:]) if b - a >= shortest)
+    if len(bounds) == 0:
+        result_json["message"] = "Empty audio data."
+        return json.dumps(result_json, indent=2)
+
+    dvecs = get_embeddings_batch([wav[a:b] for a, b in bounds], audio, embedder)
+    best_scores, best = score_gallery(dvecs, matrix).max(dim=1)
+
+    timeline = []
+    for (a, b), score, i in zip(bounds, best_scores.tolist(), best.tolist()):
+        spk = names[i] if score >= threshold else 'unknown'
+        start_tm, end_tm = a / SAMPLE_RATE, b / SAMPLE_RATE
+        turn = timeline[-1] if timeline else None
+        if turn is not None and turn['spk_name'] == spk and start_tm - turn['end'] <= TIMELINE_MERGE_GAP:
+            spoken, piece = turn['end'] - turn['start'], end_tm - start_tm
+            turn['confidence'] = (turn['confidence'] * spoken + score * piece) / (spoken + piece)
+            turn['end'] = end_tm
         else:
-            score = spk_score[spk_name].item(0)
-            result_json['spk_name'] = spk_name
-            result_json['confidence'] = score
-            if score >= 0.84:
-                result_json['status'] = 'true'
-                result_json['message'] = '{} verified as score {}.'.format(spk_name, score)
-            else:
-                result_json['message'] = '{} not verified as score {}.'.format(spk_name, score)
-    else:  # "identify"
-        result_json['spk_name'] = best_spk
-        result_json['confidence'] = score.item(0)
-        result_json['message'] = '{}: could not find any matches.(score: {:.3f})'.format(spk_name, score.item(0))
-        if result == 'Accepted':
-            result_json['status'] = 'true'
-            result_json['message'] = '{}: Found a match with score {:.3f}.'.format(spk_name, score.item(0))
+            timeline.append({'start': start_tm, 'end': end_tm, 'spk_name': spk, 'confidence': score})
 
-    response = json.dumps(result_json, indent=2)
-    os.remove(convert_audio_file)
+    stats = vad.stats()
+    result_json['status'] = 'true'
+    result_json['duration'] = len(wav) / SAMPLE_RATE
+    result_json['vad_skipped'] = stats['skipped']
+    result_json['message'] = [dict(turn, start=round(turn['start'], 2), end=round(turn['end'], 2))
+                              for turn in timeline]
+    return json.dumps(result_json, indent=2)
 
-    return response
+
+def is_enrolled(spk_name, tenant=None):
+    return os.path.isfile(os.path.join(tenant_gallery(tenant), "{}.pth".format(speaker_name(spk_name))))
+
+
+def separate_wav(wav, spk_name, tenant=None):
+    """
+    Keeps the voice of an enrolled speaker in a waveform of any length.
+    Returns (wav, stats) with the latency and real-time factor.
+    """
+    hp, audio, _ = load_model()
+    separator = ChunkedSeparator(hp, audio, load_separator(), chunk=SEPARATION_CHUNK,
+                                 overlap=SEPARATION_OVERLAP, batch=SEPARATION_BATCH)
+    with timed('separate'):
+        wav, stats = separator.separate(wav, load_embedding(spk_name, tenant_gallery(tenant)))
+    if stats['real_time_factor'] is not None:
+        REAL_TIME_FACTOR.labels('separate').observe(stats['real_time_factor'])
+    return wav, stats
 
 
-def remove_voice(spk_name):
+def separate_voice(wav, spk_name, tenant=None):
+    """
+    Standalone separation. Returns (result_json, separated wav or None).
+    """
+    result_json = {
+        'status': 'false',
+        'task': 'separate',
+        'message': 'Invalid payload.'
+    }
+    if len(wav) == 0:
+        result_json['message'] = "Empty audio data."
+        return result_json, None
+    if not is_enrolled(spk_name, tenant):
+        result_json['message'] = "Speaker {} is not enrolled.".format(spk_name)
+        return result_json, None
+    try:
+        separated, stats = separate_wav(wav, spk_name, tenant)
+    except FileNotFoundError:
+        result_json['message'] = "Separation model is not deployed."
+        return result_json, None
+    print_log("Separated {:.1f} s for {}, real-time factor {}".format(
+        stats['seconds'], spk_name, stats['real_time_factor']))
+    result_json['status'] = 'true'
+    result_json['message'] = stats
+    return result_json, separated
+
+
+def remove_voice(spk_name, tenant=None):
     response_data = {
         "status": "false",
         "task": "remove_voice",
@@ -235,8 +674,8 @@ def remove_voice(spk_name):
     }
 
     try:
-        embedding_path = os.path.join(embedding_folder, "{}.pth".format(spk_name))
-        os.remove(embedding_path)
+        delete_embedding(spk_name, tenant_gallery(tenant))
+        delete_enrollment(spk_name, tenant)
 
         response_data["status"] = "true"
         response_data["message"] = "successfully removed."